@@ -1,12 +1,22 @@
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
 import pytz
-from typing import Optional, List
+from typing import Deque, Optional
 
+from google.genai import types
 
-from config import CHATBOT_TIMEZONE, CHATBOT_HISTORY_SIZE, OPENAI_ENABLED
+from bot.chatbot.llm_scheduler import estimate_tokens
+from config import (
+    CHATBOT_TIMEZONE,
+    CHATBOT_HISTORY_SIZE,
+    CHATBOT_HISTORY_TOKENS,
+    OPENAI_ENABLED,
+)
 from dataclasses import field
 
+FILE_TOKENS = 258  # Approximate tokens of an image or file in a prompt
+
 
 @dataclass
 class ChatbotMessage:
@@ -64,91 +74,104 @@ class ChatbotMessage:
         return message
 
 
+@dataclass
+class HistoryEntry:
+    """A message and its response, rendered once for each API."""
+
+    message: ChatbotMessage
+    gemini: tuple[types.Content, ...]  # User, model (if it responded)
+    openai: Optional[tuple[dict, ...]]  # User, assistant (if OpenAI is enabled)
+    tokens: int  # Approximate token count
+
+
+def openai_user_input(prompt: str, urls: Optional[list[str]] = None) -> dict:
+    content = [{"type": "input_text", "text": prompt}]
+    for url in urls or []:
+        content.append({"type": "input_image", "image_url": url})
+    return {"role": "user", "content": content}
+
+
 @dataclass
 class ChatbotHistory:
+    """Last messages and responses of a chat, trimmed from the oldest ones to
+    stay under `CHATBOT_HISTORY_TOKENS` (and `CHATBOT_HISTORY_SIZE` messages).
+    Each entry is rendered once when added: a prompt is assembled from the
+    existing Gemini contents or OpenAI inputs, plus the new message."""
+
     guild_id: int
-    messages: List[ChatbotMessage] = field(default_factory=list)
-    openai_input: List[str] = field(default_factory=list)
-    pinecone_history: List[ChatbotMessage] = field(default_factory=list)
-    # So 3 histories here:
-    # - messages is the standard one, used in vector recalls
-    # - openai input, used for openai compatibility
-    # - pinecone_history is used to analyse the messages, put new vectors in the Pinecone index, then
-    # messages used to generate it are removed from pinecone_history, to avoid superfluous vectors
+    entries: Deque[HistoryEntry] = field(default_factory=deque)
+    tokens: int = 0  # Approximate token count of the entries
     recalled_vector_ids: set[str] = field(default_factory=set)
     reset_i = 0
     # Every {CHATBOT_HISTORY_SIZE} messages (from user), reset the id set of recalled vectors
 
-    def __format__(self, format_spec):
-        if format_spec == "pinecone_last_3":
-            formatted_messages = [msg.content for msg in self.pinecone_history[-3:]]
-            return ", ".join(formatted_messages)
-        return str(self)
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def last_message(self) -> Optional[ChatbotMessage]:
+        return self.entries[-1].message if self.entries else None
 
-    def add(self, chatbot_message: ChatbotMessage) -> None:
-        """If OpenAI features are enabled, this method should be used after
-        the `store_recall` one, to save recalls in the OpenAI input."""
+    def add(self, chatbot_message: ChatbotMessage, parts: list[types.Part]) -> None:
+        """Add a message with its response, `parts` being the Gemini parts of
+        its prompt (text and files). This method should be used after the
+        `store_recall` one, to save recalls in the OpenAI input.
+        A filtered or empty response is not added (only the message), so the
+        model doesn't learn to repeat it."""
         msg = chatbot_message
         if not isinstance(msg, ChatbotMessage):
             raise TypeError("Not a ChatbotMessage class")
-        self.messages.append(msg)
-        self.pinecone_history.append(msg)
-
+        response = msg.response.strip()
+        if response == "*filtered*":
+            response = ""
+
+        gemini = (types.Content(role="user", parts=parts),)
+        if response:
+            gemini += (types.Content(role="model", parts=[types.Part(text=response)]),)
+        openai = None
         if OPENAI_ENABLED:
             recall = msg.format_recall_vectors()
             infos = [f"memory: {recall}"] if recall else []
             infos.append(f"**{msg.author} talks to you**")
             new_prompt = f"[{', '.join(infos)}]: {msg.content}"
-            self.openai_input = self.create_openai_input(new_prompt, msg.urls)
-
-        for h in self.messages, self.pinecone_history:
-            while len(h) > CHATBOT_HISTORY_SIZE:
-                h.pop(0)
+            openai = (openai_user_input(new_prompt, msg.urls),)
+            if response:
+                assistant = {
+                    "role": "assistant",
+                    "content": [{"type": "output_text", "text": response}],
+                }
+                openai += (assistant,)
+
+        tokens = (estimate_tokens(response) if response else 0) + sum(
+            estimate_tokens(part.text) if part.text else FILE_TOKENS for part in parts
+        )
+        self.entries.append(HistoryEntry(msg, gemini, openai, tokens))
+        self.tokens += tokens
 
-        while len(self.openai_input) > CHATBOT_HISTORY_SIZE * 2:  # Including Q&A
-            self.openai_input.pop(0)
+        # The new entry is always kept
+        while len(self.entries) > 1 and (
+            self.tokens > CHATBOT_HISTORY_TOKENS
+            or len(self.entries) > CHATBOT_HISTORY_SIZE
+        ):
+            self.tokens -= self.entries.popleft().tokens
 
         self.reset_i = (self.reset_i + 1) % CHATBOT_HISTORY_SIZE
         if self.reset_i == 0:
             self.reset_recalled_vector_ids_set()
 
-    def create_openai_input(
-        self, new_prompt: str, urls: Optional[list[str]] = None
-    ) -> List[str]:
-        """Return an input for OpenAI responses based on the history and a new message."""
-        new_entry = {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": new_prompt},
-            ],
-        }
-        if urls:
-            for url in urls:
-                new_entry["content"].append(
-                    {
-                        "type": "input_image",
-                        "image_url": url,
-                    }
-                )
-
-        return self.openai_input + [new_entry]
-
-    def add_openai_assistant_response(self, response: str) -> None:
-        self.openai_input.append(
-            {
-                "role": "assistant",
-                "content": [
-                    {"type": "output_text", "text": response},
-                ],
-            }
-        )
-        if len(self.openai_input) > CHATBOT_HISTORY_SIZE * 2:  # Including Q&A
-            self.openai_input.pop(0)
+    def gemini_contents(self, parts: list[types.Part]) -> list[types.Content]:
+        """Contents for Gemini: the history and a new message."""
+        contents = [content for entry in self.entries for content in entry.gemini]
+        contents.append(types.Content(role="user", parts=parts))
+        return contents
 
-    def pinecone_remove_last_three(self) -> None:
-        for _ in range(3):
-            if self.pinecone_history:
-                self.pinecone_history.pop()
+    def openai_input(self, new_prompt: str, urls: Optional[list[str]] = None) -> list:
+        """Input for OpenAI responses: the history and a new message."""
+        inputs = [
+            item for entry in self.entries if entry.openai for item in entry.openai
+        ]
+        inputs.append(openai_user_input(new_prompt, urls))
+        return inputs
 
     def store_recall(self, vectors: list) -> None:
         for vector in vectors:
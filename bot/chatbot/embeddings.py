@@ -0,0 +1,247 @@
+from array import array
+import asyncio
+from collections import OrderedDict
+from hashlib import sha256
+import logging
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from time import time
+from typing import Callable, Optional
+import unicodedata
+
+from config import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_WINDOW,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_DB_PATH,
+    EMBEDDING_STORE_SIZE,
+)
+
+Vector = list[float]
+
+
+def embedding_key(text: str, model: str) -> str:
+    """Hash of the normalized text: same Unicode forms, no extra whitespace."""
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingStore:
+    """Embeddings kept in SQLite (as float32 blobs), keyed by text hash.
+    The least recently used ones are evicted above `max_size` entries."""
+
+    def __init__(
+        self, path: Path = EMBEDDING_DB_PATH, max_size: int = EMBEDDING_STORE_SIZE
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, in a worker thread
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Shared by the processes started by launcher.py
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA busy_timeout = 5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+                "ON embeddings (last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _get_many(self, keys: list[str]) -> dict[str, Vector]:
+        with self._lock:
+            conn = self._connect()
+            placeholders = ", ".join("?" * len(keys))
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                keys,
+            ).fetchall()
+            if rows:
+                now = time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, row[0]) for row in rows],
+                )
+                conn.commit()
+        return {key: array("f", blob).tolist() for key, blob in rows}
+
+    def _put_many(self, vectors: dict[str, Vector]) -> None:
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(key, array("f", v).tobytes(), now) for key, v in vectors.items()],
+            )
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            conn.commit()
+
+    async def get_many(self, keys: list[str]) -> dict[str, Vector]:
+        try:
+            return await asyncio.to_thread(self._get_many, keys)
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error getting embeddings: {e}", exc_info=True)
+            return {}
+
+    async def put_many(self, vectors: dict[str, Vector]) -> None:
+        try:
+            await asyncio.to_thread(self._put_many, vectors)
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error storing embeddings: {e}", exc_info=True)
+
+
+class EmbeddingStats:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_texts = 0
+
+    def summary(self) -> dict:
+        total = self.memory_hits + self.store_hits + self.misses
+        return {
+            "requests": total,
+            "hit_rate": round((total - self.misses) / total, 3) if total else None,
+            "memory_hits": self.memory_hits,
+            "store_hits": self.store_hits,
+            "batches": self.batches,
+            "avg_batch_size": (
+                round(self.batched_texts / self.batches, 2) if self.batches else None
+            ),
+        }
+
+    def log(self) -> None:
+        logging.info(f"Embeddings: {self.summary()}")
+        self.reset()
+
+
+class EmbeddingService:
+    """Embeddings of texts, from an in-memory LRU, then from the SQLite store.
+    The missing ones, from any server, are grouped for `EMBEDDING_BATCH_WINDOW`
+    seconds and computed in a single inference call."""
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], list[Vector]],
+        model: str,
+        max_size: int = EMBEDDING_CACHE_SIZE,
+    ) -> None:
+        self.embed = embed  # Blocking, called in a thread
+        self.model = model
+        self.max_size = max_size
+        self.memory: OrderedDict[str, Vector] = OrderedDict()
+        self.store = EmbeddingStore()
+        # Key: future of the embedding, and the text waiting for the next batch
+        self.pending: dict[str, asyncio.Future] = {}
+        self.queued: dict[str, str] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.stats = EmbeddingStats()
+
+    def _remember(self, key: str, vector: Vector) -> None:
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    async def _cached(self, keys: list[str]) -> dict[str, Vector]:
+        vectors: dict[str, Vector] = {}
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                vectors[key] = vector
+                self.stats.memory_hits += 1
+
+        missing = list(dict.fromkeys(k for k in keys if k not in vectors))
+        if missing:
+            stored = await self.store.get_many(missing)
+            for key, vector in stored.items():
+                self._remember(key, vector)
+                self.stats.store_hits += 1
+            vectors.update(stored)
+        return vectors
+
+    async def get_cached(self, text: str) -> Optional[Vector]:
+        """Embedding of a text if it has already been computed, without
+        calling the embedding model."""
+        key = embedding_key(text, self.model)
+        return (await self._cached([key])).get(key)
+
+    async def get(self, texts: list[str]) -> list[Vector]:
+        keys = [embedding_key(text, self.model) for text in texts]
+        vectors = await self._cached(keys)
+
+        futures = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in futures:
+                continue
+            self.stats.misses += 1
+            futures[key] = self._queue(key, text)
+        for key, future in futures.items():
+            # Shared with the other callers: cancelling this one doesn't cancel it
+            vectors[key] = await asyncio.shield(future)
+
+        return [vectors[key] for key in keys]
+
+    def _queue(self, key: str, text: str) -> asyncio.Future:
+        """Join the computation of an embedding, or add it to the next batch."""
+        future = self.pending.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[key] = future
+        self.queued[key] = text
+        if len(self.queued) >= EMBEDDING_BATCH_SIZE:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(EMBEDDING_BATCH_WINDOW, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.queued = self.queued, {}
+        if batch:
+            asyncio.create_task(self._compute(batch))
+
+    async def _compute(self, batch: dict[str, str]) -> None:
+        self.stats.batches += 1
+        self.stats.batched_texts += len(batch)
+        try:
+            vectors = await asyncio.to_thread(self.embed, list(batch.values()))
+        except Exception as e:
+            for key in batch:
+                future = self.pending.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        computed = dict(zip(batch, vectors))
+        for key, vector in computed.items():
+            self._remember(key, vector)
+            future = self.pending.pop(key)
+            if not future.done():
+                future.set_result(vector)
+        await self.store.put_many(computed)
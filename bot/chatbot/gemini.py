@@ -6,12 +6,12 @@ import io
 import logging
 from openai import AsyncOpenAI, BadRequestError
 from random import random
-from typing import Optional, List, Union, Literal
+from time import perf_counter
+from typing import Callable, Optional, List, Union, Literal
 from datetime import datetime, timedelta
 from config import (
     GEMINI_MODEL,
     GEMINI_SAFETY_SETTINGS,
-    CHATBOT_HISTORY_SIZE,
     GEMINI_ENABLED,
     CHATBOT_TIMEOUT,
     CHATBOT_PREFIX,
@@ -22,6 +22,7 @@ from config import (
     CHATBOT_EMOTE_FREQUENCY,
     ALLOW_CHATBOT_IN_DMS,
     PINECONE_RECALL_WINDOW,
+    PINECONE_RECALL_BUDGET,
     OPENAI_ENABLED,
     OPENAI_MODEL,
     PINECONE_INDEX_NAME,
@@ -31,19 +32,23 @@ from config import (
     GEMINI_THINKING_LEVEL,
 )
 import urllib3
-from PIL import Image
 
 import discord
 from google.genai import types, errors
 from google.genai.types import Tool, GoogleSearch
 
 from bot.chatbot.chat_dataclass import ChatbotMessage, ChatbotHistory
-from bot.chatbot.gemini_client import client, utils_models_manager
+from bot.chatbot.gemini_client import client, llm_scheduler
+from bot.chatbot.llm_scheduler import ModelsExhausted, Priority, estimate_tokens
+from bot.chatbot.prompt_cache import PromptKey, prompt_cache
 from bot.chatbot.prompts import Prompts
+from bot.chatbot.tracing import Trace
 from bot.chatbot.vector_recall import memory
 from bot.config.sqlite_config_manager import get_all_chatbot_emotes, get_whitelist
 from bot.utils import url_grabber, parse_message_url, tenor_view_url_to_direct_url
 from bot import http_client
+from bot.http_cache import DO_NOT_CACHE
+from bot.sharding import ShardedDict, get_shard_id, shard_metrics
 
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -58,8 +63,11 @@ class Gembot:
         id_,
         gemini_model=GEMINI_MODEL,
         ugoku_chat: bool = False,
+        guild_id: Optional[int] = None,
     ) -> None:
         self.id_: int = id_
+        # None in DMs, where the chat is keyed by channel ID
+        self.guild_id = guild_id
         self.last_prompt = datetime.now()
         active_chats[id_] = self
 
@@ -70,8 +78,7 @@ class Gembot:
                 Prompts.system, bot_emotes=current_bot_emotes
             )
 
-            chat_client = client
-            chat_model = gemini_model
+            self.chat_model = gemini_model
             self.current_model_dn = (
                 OPENAI_MODEL_DISPLAY_NAME
                 if OPENAI_ENABLED
@@ -79,29 +86,28 @@ class Gembot:
             )
             self.default_api = "openai" if OPENAI_ENABLED else "gemini"
 
-            # Create the chat
-            self.chat = chat_client.aio.chats.create(
-                model=chat_model,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_prompt_text,
-                    candidate_count=1,
-                    temperature=CHATBOT_TEMPERATURE,
-                    max_output_tokens=CHATBOT_MAX_OUTPUT_TOKEN,
-                    safety_settings=GEMINI_SAFETY_SETTINGS,
-                    automatic_function_calling=types.AutomaticFunctionCallingConfig(
-                        disable=True
-                    ),
-                    tools=[google_search_tool] if ugoku_chat else [],
-                    thinking_config=types.ThinkingConfig(
-                        include_thoughts=False, thinking_level=GEMINI_THINKING_LEVEL
-                    ),
-                    service_tier="priority",
+            # The history is kept in self.history, sent with each message
+            self.chat_config = types.GenerateContentConfig(
+                system_instruction=system_prompt_text,
+                candidate_count=1,
+                temperature=CHATBOT_TEMPERATURE,
+                max_output_tokens=CHATBOT_MAX_OUTPUT_TOKEN,
+                safety_settings=GEMINI_SAFETY_SETTINGS,
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                    disable=True
+                ),
+                tools=[google_search_tool] if ugoku_chat else [],
+                thinking_config=types.ThinkingConfig(
+                    include_thoughts=False, thinking_level=GEMINI_THINKING_LEVEL
                 ),
+                service_tier="priority",
             )
             self.status = 0
             self.interacting = False
             self.chatters = []
             self.memory = memory
+            # (Author, query): start time and task of a recall started early
+            self.recall_tasks: dict[tuple[str, str], tuple[float, asyncio.Task]] = {}
             self.history = ChatbotHistory(id_)
             self.openai = (
                 AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_ENABLED else None
@@ -114,39 +120,53 @@ class Gembot:
         model: Optional[str] = None,
         temperature: float = 1.0,
         max_output_tokens: int = CHATBOT_MAX_OUTPUT_TOKEN,
+        priority: Priority = Priority.TRANSLATION,
+        cache_key: Optional[PromptKey] = None,
     ) -> Optional[str]:
-        try:
-            model = utils_models_manager.pick()
-            response: types.GenerateContentResponse = (
-                await client.aio.models.generate_content(
-                    model=model,
-                    contents=query,
-                    config=types.GenerateContentConfig(
-                        candidate_count=1,
-                        temperature=temperature,
-                        max_output_tokens=max_output_tokens,
-                        safety_settings=GEMINI_SAFETY_SETTINGS,
-                        automatic_function_calling=types.AutomaticFunctionCallingConfig(
-                            disable=True
-                        ),
+        """Prompt the first utility model with capacity (or `model`), queued
+        with the other LLM requests by priority.
+        If `cache_key` is given, the result is reused from the prompt cache."""
+        # The utility models may answer, any change of them invalidates the cache
+        cache_model = model or ",".join(llm_scheduler.models)
+        if cache_key:
+            cached = await prompt_cache.get(cache_key, cache_model)
+            if cached is not None:
+                return cached
+
+        async def generate(model: str) -> types.GenerateContentResponse:
+            return await client.aio.models.generate_content(
+                model=model,
+                contents=query,
+                config=types.GenerateContentConfig(
+                    candidate_count=1,
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                    safety_settings=GEMINI_SAFETY_SETTINGS,
+                    automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                        disable=True
                     ),
-                )
+                ),
             )
-            logging.info(
-                f"Gemini API call, simple prompt: {response.usage_metadata.total_token_count} tokens"
+
+        try:
+            response = await llm_scheduler.run(
+                generate,
+                priority,
+                tokens=estimate_tokens(query),
+                models=[model] if model else None,
             )
+        except ModelsExhausted:
+            return "Resource exhausted: please try again in a few minutes."
         except errors.APIError as e:
-            if e.code == 429:
-                utils_models_manager.add_down_model(model)
-                return await Gembot.simple_prompt(
-                    query, None, temperature, max_output_tokens
-                )
             logging.error(f"An error occured when generating a Gemini response: {e}")
             return
-        except RuntimeError as e:
-            if str(e) == "No more model available":
-                return "Resource exhausted: please try again in a few minutes."
 
+        token_count = response.usage_metadata.total_token_count
+        logging.info(f"Gemini API call, simple prompt: {token_count} tokens")
+        if cache_key and response.text:
+            await prompt_cache.put(
+                cache_key, cache_model, response.text, token_count or 0
+            )
         return response.text
 
     @staticmethod
@@ -192,28 +212,28 @@ class Gembot:
         r_contents: Optional[list] = None,
         message_id: Optional[int] = None,
         api: str = "openai" if OPENAI_ENABLED else "gemini",
+        on_text: Optional[Callable[[str], None]] = None,
     ) -> Optional[ChatbotMessage]:
+        """Generate a response to a message.
+        If `on_text` is given, the response is streamed and `on_text` is called
+        with the text generated so far after each chunk."""
         # Update variables
         self.last_prompt = datetime.now()
         self.message_count += 1
 
-        # Recall from memory
-        # Remove already prompted vectors + default value
-        recall_vectors = []
-        if PINECONE_ENABLED:
-            try:
-                results: list = await self.memory.get_vectors(
-                    f"{author}: {user_query}", id=self.id_, top_k=PINECONE_RECALL_WINDOW
-                )
-                for v in results:
-                    if v["id"] not in self.history.recalled_vector_ids:
-                        recall_vectors.append(v)
-            except urllib3.exceptions.ProtocolError:
-                logging.error(
-                    "Pinecone: An existing connection was forcibly closed by the remote host. "
-                    "Restarting Pinecone..."
-                )
-                await memory.init_pinecone(PINECONE_INDEX_NAME)
+        trace = Trace(f"Chat {self.id_}")
+        if on_text:
+            show_text = on_text
+
+            def on_text(text: str) -> None:
+                trace.mark("first token")
+                show_text(text)
+
+        # Attachments are fetched while recalling from memory
+        parts_task = asyncio.create_task(
+            trace.timed("attachments", self.get_url_parts(urls))
+        )
+        recall_vectors = await self.wait_for_recall(author, user_query, trace)
 
         # Create message
         message = ChatbotMessage(
@@ -228,33 +248,71 @@ class Gembot:
         )
 
         prompt = message.prompt()
-        parts = await self.request_chat_response(
-            message, prompt=prompt, urls=urls, api=api
-        )
+        url_parts = await parts_task
+        with trace.stage("generation"):
+            parts = await self.request_chat_response(
+                message,
+                prompt=prompt,
+                urls=urls,
+                api=api,
+                url_parts=url_parts,
+                on_text=on_text,
+            )
+        trace.log()
 
-        # Add to (custom) history if successful
+        # Add to the history, for both APIs
         self.history.store_recall(recall_vectors)
-        self.history.add(message)
-        if api == "openai":
-            self.history.add_openai_assistant_response(message.response)
-            # Add to Gemini history as well
-            user_input = types.Content(parts=parts, role="user")
-            model_output = types.Content(
-                parts=[types.Part(text=message.response)], role="model"
-            )
-            self.chat.record_history(
-                user_input=user_input,
-                model_output=[model_output],
-                automatic_function_calling_history=[],
-                is_valid=True,
-            )
-            self.limit_gemini_history()
+        self.history.add(message, parts)
 
         return message
 
-    def limit_gemini_history(self):
-        while len(self.chat._curated_history) > CHATBOT_HISTORY_SIZE * 2:
-            self.chat._curated_history.pop(0)
+    def prefetch_recall(self, author: str, user_query: str) -> None:
+        """Start recalling from memory while the rest of the message is processed."""
+        # Without Pinecone, the local copy can still be queried
+        if not PINECONE_ENABLED:
+            return
+        now = perf_counter()
+        for key, (start, task) in list(self.recall_tasks.items()):
+            if now - start > 60:
+                # The message has not been sent
+                task.cancel()
+                del self.recall_tasks[key]
+        if (author, user_query) not in self.recall_tasks:
+            task = asyncio.create_task(self.recall(author, user_query))
+            self.recall_tasks[(author, user_query)] = (now, task)
+
+    async def recall(self, author: str, user_query: str) -> list:
+        """Return the recalled vectors, without the ones already prompted."""
+        try:
+            results: list = await self.memory.get_vectors(
+                f"{author}: {user_query}", id=self.id_, top_k=PINECONE_RECALL_WINDOW
+            )
+        except urllib3.exceptions.ProtocolError:
+            logging.error(
+                "Pinecone: An existing connection was forcibly closed by the remote host. "
+                "Restarting Pinecone..."
+            )
+            await memory.init_pinecone(PINECONE_INDEX_NAME)
+            return []
+        return [v for v in results if v["id"] not in self.history.recalled_vector_ids]
+
+    async def wait_for_recall(self, author: str, user_query: str, trace: Trace) -> list:
+        """Recalled vectors, or none if the recall takes longer than
+        `PINECONE_RECALL_BUDGET` seconds (counted from its start)."""
+        self.prefetch_recall(author, user_query)
+        entry = self.recall_tasks.pop((author, user_query), None)
+        if entry is None:
+            return []
+        start, task = entry
+        timeout = max(PINECONE_RECALL_BUDGET - (perf_counter() - start), 0)
+        try:
+            vectors = await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            trace.stages["recall (skipped)"] = perf_counter() - start
+            logging.warning(f"Recall skipped in {self.id_}, over the latency budget")
+            return []
+        trace.stages["recall"] = perf_counter() - start
+        return vectors
 
     async def request_chat_response(
         self,
@@ -262,23 +320,45 @@ class Gembot:
         prompt: str,
         urls: Optional[list] = None,
         api: Literal["gemini", "openai"] = "gemini",
+        url_parts: Optional[list[types.Part]] = None,
+        on_text: Optional[Callable[[str], None]] = None,
     ) -> list[types.Part]:
         """Add a response to a given message based on the current message history.
-        urls is a list of URLs. Return a list of parts."""
+        urls is a list of URLs, fetched unless `url_parts` is given.
+        Return a list of parts. The response is streamed to `on_text` if given."""
         chatbot_message.response = "*filtered*"  # By default
         parts = [types.Part(text=prompt)]
-        if urls:
-            for url in urls:
-                part = await self.get_part_from_url(url)
-                if part:
-                    parts.append(part)
+        if url_parts is None:
+            url_parts = await self.get_url_parts(urls)
+        parts.extend(url_parts)
 
         if api == "gemini":
-            response = await self.chat.send_message(parts)
-            if response.text:
-                chatbot_message.response = response.text
+            contents = self.history.gemini_contents(parts)
+
+            async def generate(model: str) -> tuple:
+                if on_text:
+                    return await self.stream_gemini_response(model, contents, on_text)
+                response = await client.aio.models.generate_content(
+                    model=model, contents=contents, config=self.chat_config
+                )
+                return response.text, response
+
+            text, response = await llm_scheduler.run(
+                generate,
+                Priority.CHAT,
+                tokens=self.history.tokens + estimate_tokens(prompt),
+                models=[self.chat_model],
+                usage=lambda result: result[1],
+            )
+            if text:
+                chatbot_message.response = text
+            token_count = (
+                response.usage_metadata.total_token_count
+                if response and response.usage_metadata
+                else None
+            )
             logging.info(
-                f"Gemini API call, total token count: {response.usage_metadata.total_token_count}."
+                f"Gemini API call, total token count: {token_count}."
                 f" Prompt: {prompt}".replace("\n", ", ")
             )
 
@@ -286,7 +366,8 @@ class Gembot:
             # The checks needed are so stupid
             sources = []
             if (
-                response.candidates
+                response
+                and response.candidates
                 and response.candidates[0].grounding_metadata
                 and response.candidates[0].grounding_metadata.grounding_chunks
             ):
@@ -302,21 +383,23 @@ class Gembot:
                     [f"> -# {source}" for source in sources]
                 )
 
-            # Limit history length
-            self.limit_gemini_history()
-
         elif api == "openai":  # Text and images supported only
             if not self.openai:
                 raise ValueError("OpenAI not enabled")
 
-            openai_input = self.history.create_openai_input(prompt, urls)
+            openai_input = self.history.openai_input(prompt, urls)
             try:
-                response = await self.openai.responses.create(
-                    instructions=self.with_emotes(Prompts.system),
-                    model=OPENAI_MODEL,
-                    input=openai_input,
-                )
-                chatbot_message.response = response.output_text
+                if on_text:
+                    chatbot_message.response = await self.stream_openai_response(
+                        openai_input, on_text
+                    )
+                else:
+                    response = await self.openai.responses.create(
+                        instructions=self.with_emotes(Prompts.system),
+                        model=OPENAI_MODEL,
+                        input=openai_input,
+                    )
+                    chatbot_message.response = response.output_text
             except BadRequestError as e:
                 if e.status_code == 400:
                     logging.error(repr(e))
@@ -327,16 +410,61 @@ class Gembot:
                         chatbot_message,
                         prompt,
                         api="openai",
+                        on_text=on_text,
                     )
 
                 logging.error(repr(e))
 
         return parts
 
+    async def stream_gemini_response(
+        self,
+        model: str,
+        contents: list[types.Content],
+        on_text: Callable[[str], None],
+    ) -> tuple[str, Optional[types.GenerateContentResponse]]:
+        """Return the whole text and the last chunk of the response
+        (with the token count and the grounding metadata)."""
+        text = ""
+        chunk = None
+        stream = await client.aio.models.generate_content_stream(
+            model=model, contents=contents, config=self.chat_config
+        )
+        async for chunk in stream:
+            if chunk.text:
+                text += chunk.text
+                on_text(text)
+        return text, chunk
+
+    async def stream_openai_response(
+        self, openai_input: list, on_text: Callable[[str], None]
+    ) -> str:
+        stream = await self.openai.responses.create(
+            instructions=self.with_emotes(Prompts.system),
+            model=OPENAI_MODEL,
+            input=openai_input,
+            stream=True,
+        )
+        text = ""
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                text += event.delta
+                on_text(text)
+        return text
+
+    async def get_url_parts(self, urls: Optional[list]) -> list[types.Part]:
+        """Fetch the URLs concurrently, skipping the unsupported ones."""
+        if not urls:
+            return []
+        parts = await asyncio.gather(*(self.get_part_from_url(url) for url in urls))
+        return [part for part in parts if part]
+
     async def get_part_from_url(self, url: str) -> Optional[types.Part]:
         """Returns a dict containing the base64 bytes data and the mime_type from an URL."""
         try:
-            async with http_client.session.get(url) as response:
+            async with http_client.session.get(
+                url, expire_after=DO_NOT_CACHE
+            ) as response:
                 response.raise_for_status()
                 mime_type = response.headers.get("content-type", "")
                 # E.g: audio, text..
@@ -350,6 +478,8 @@ class Gembot:
 
                     # For GIFs: convert to png and take the frame at the middle
                     if ext == "gif":
+                        from PIL import Image
+
                         with Image.open(io.BytesIO(content)) as img:
                             num_frames = getattr(img, "n_frames", 1)
                             img.seek(num_frames // 2)
@@ -457,7 +587,7 @@ class Gembot:
             )
 
             # If the model has changed or there is no history, notify what model is used
-            if self.current_model_dn != selected_model_dn or not self.history.messages:
+            if self.current_model_dn != selected_model_dn or not self.history:
                 self.status = 4
                 self.current_model_dn = selected_model_dn
             # Don't otherwise
@@ -469,8 +599,10 @@ class Gembot:
 
         return False
 
-    def format_response(self, reply: str) -> str:
-        """Format the reply based on the current status."""
+    def format_response(self, reply: str, final: bool = True) -> str:
+        """Format the reply based on the current status.
+        While it is generated (not final), the emotes are hidden instead of
+        being randomly converted, so they don't change with each edit."""
         # Remove double skip lines
         parts = re.split(r"(```[\s\S]*?```)", reply)
         for i, part in enumerate(parts):
@@ -482,7 +614,10 @@ class Gembot:
         reply = emoticon_pattern.sub(r"", reply)
 
         # Add custom emote snowflakes (to properly show up in Discord)
-        reply = self.convert_emotes(reply)
+        if final:
+            reply = self.convert_emotes(reply)
+        else:
+            reply = re.sub(r":\w+:|:\w*$", "", reply).strip()
 
         # Add message status
         status = self.status
@@ -571,8 +706,6 @@ class Gembot:
             # Recursively parse discord message URLs in the referred message
             await parse_urls_in_msg_content(r_message.content)
 
-        await parse_urls_in_msg_content(mc)
-
         # Process custom emojis
         match = re.search(r"<:(?P<name>[^:]+):(?P<snowflake>\d+)>", mc)
         if match:
@@ -586,6 +719,11 @@ class Gembot:
             # Append the first emote to the image list
             urls.append(f"https://cdn.discordapp.com/emojis/{snowflake}.png")
 
+        # The query is known: recall while fetching the referred messages
+        self.prefetch_recall(context.author.global_name, mc)
+
+        await parse_urls_in_msg_content(mc)
+
         # Extra process only for normal messages, when /ask is not used
         if isinstance(context, discord.Message):
             id = context.id
@@ -673,6 +811,7 @@ class Gembot:
         query: str,
         language: str,
         nuance: str = "",
+        use_cache: bool = True,
     ) -> str:
         prompt = f"""
             Translate the following text to {nuance} {language}.
@@ -680,8 +819,21 @@ class Gembot:
             Don't change emoji strings (<:Example:1200797674031566958>).
             Don't add ANY extra text:
         """
-        response = await Gembot.simple_prompt(query=prompt + query)
+        response = await Gembot.simple_prompt(
+            query=prompt + query,
+            priority=Priority.TRANSLATION,
+            cache_key=(
+                PromptKey("translate", query, f"{nuance} {language}")
+                if use_cache
+                else None
+            ),
+        )
         return response
 
 
-active_chats: dict[int, Gembot] = {}
+# Chat ID (server ID, or channel ID in DMs): chat
+# Chat ID: chat, in the shard of its server (shard 0 for DMs)
+active_chats: ShardedDict = ShardedDict(
+    lambda id_, chat: get_shard_id(chat.guild_id)
+)
+shard_metrics.track("chats", active_chats)
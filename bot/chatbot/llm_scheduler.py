@@ -0,0 +1,398 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+import heapq
+from itertools import count
+import logging
+from time import monotonic
+from typing import Any, Awaitable, Callable, Mapping, Optional, TypeVar
+
+from config import (
+    GEMINI_MODEL_LIMITS,
+    LLM_CONCURRENCY,
+    LLM_GUESSED_LIMIT_TTL,
+    LLM_MAX_WAIT,
+)
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    """Lower values are served first."""
+
+    CHAT = 0
+    TRANSLATION = 1
+    LYRICS = 2
+    MEMORY = 3
+
+
+class ModelsExhausted(RuntimeError):
+    """No model had capacity before the max wait of the request."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a prompt, corrected with the usage of the response."""
+    return len(text) // 4 + 1
+
+
+def is_rate_limit(error: Exception) -> bool:
+    # google.genai APIError (code) or openai APIStatusError (status_code)
+    return 429 in (getattr(error, "code", None), getattr(error, "status_code", None))
+
+
+def parse_rate_limit(error: Exception) -> tuple[Optional[float], dict[str, int]]:
+    """Retry delay and per minute quotas ("requests", "tokens") given in the
+    details of a Gemini 429 error, if any."""
+    try:
+        items = error.details["error"]["details"]
+    except (AttributeError, KeyError, TypeError):
+        return None, {}
+
+    retry_delay = None
+    quotas = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        delay = item.get("retryDelay")
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                retry_delay = float(delay[:-1])
+            except ValueError:
+                pass
+        for violation in item.get("violations", []):
+            value = violation.get("quotaValue")
+            if not value or "PerMinute" not in violation.get("quotaId", ""):
+                continue
+            if "token" in violation.get("quotaMetric", ""):
+                quotas["tokens"] = int(value)
+            else:
+                quotas["requests"] = int(value)
+    return retry_delay, quotas
+
+
+class TokenBucket:
+    """`capacity` units per minute, refilled continuously.
+    No limit while the capacity is unknown (None)."""
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        self.capacity = capacity
+        self.level = float(capacity or 0)
+        self.updated = monotonic()
+
+    def refill(self) -> None:
+        now = monotonic()
+        if self.capacity is not None:
+            refilled = (now - self.updated) * self.capacity / 60
+            self.level = min(self.capacity, self.level + refilled)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        """Seconds before `amount` units are available."""
+        if self.capacity is None:
+            return 0.0
+        self.refill()
+        # A request bigger than the bucket only waits for a full one
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0) * 60 / self.capacity
+
+    def take(self, amount: int) -> None:
+        if self.capacity is None:
+            return
+        self.refill()
+        self.level -= amount  # Negative when the estimation was too low
+
+    def set_limit(
+        self, capacity: Optional[int], level: Optional[float] = None
+    ) -> None:
+        self.refill()
+        if capacity is None:
+            self.capacity = None
+            return
+        if level is None:
+            level = self.level if self.capacity is not None else capacity
+        self.capacity = capacity
+        self.level = min(level, capacity)
+
+
+class ModelState:
+    """Rate limits of a model: requests and input tokens per minute."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        rpm, tpm = GEMINI_MODEL_LIMITS.get(name, (None, None))
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.rpm = rpm  # Given in the config or by the API, None if unknown
+        # Last 429 while the requests limit is guessed (None if it isn't)
+        self.guessed_at: Optional[float] = None
+        self.paused_until = 0.0
+        self.started: deque[float] = deque()  # Requests of the last minute
+
+    def wait_time(self, tokens: int) -> float:
+        self.forget_guessed_limit()
+        return max(
+            self.paused_until - monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens),
+        )
+
+    def start(self, tokens: int) -> None:
+        now = monotonic()
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.started.append(now)
+        while now - self.started[0] > 60:
+            self.started.popleft()
+
+    def rate_limited(self, error: Exception, max_pause: Optional[float] = None) -> None:
+        """Pause the model (at most `max_pause` seconds), and learn its limits
+        from the error, or from the requests started in the last minute if the
+        error doesn't give them."""
+        retry_delay, quotas = parse_rate_limit(error)
+        now = monotonic()
+        pause = retry_delay or 60
+        if max_pause is not None:
+            pause = min(pause, max_pause)
+        self.paused_until = now + pause
+
+        # The buckets are full again when the pause ends
+        refilled = max(1 - pause / 60, 0)
+        if quotas.get("requests"):
+            self.rpm = quotas["requests"]
+            self.guessed_at = None
+            self.requests.set_limit(self.rpm, level=self.rpm * refilled)
+        else:
+            # Guessed from the requests of the last minute: the 429 can come
+            # from a short burst, so the guess is forgotten after a while
+            recent = sum(1 for start in self.started if now - start <= 60)
+            rpm = max(recent - 1, 1)
+            if self.requests.capacity is None or rpm < self.requests.capacity:
+                self.requests.set_limit(rpm, level=rpm * refilled)
+                self.guessed_at = now
+            elif self.guessed_at is not None:
+                self.guessed_at = now
+        if "tokens" in quotas:
+            self.tokens.set_limit(quotas["tokens"], level=quotas["tokens"] * refilled)
+        logging.info(
+            f"{self.name} has been rate limited: paused for {pause}s, "
+            f"{self.requests.capacity} requests/min"
+        )
+
+    def forget_guessed_limit(self) -> None:
+        """Go back to the known requests limit (if any) after
+        `LLM_GUESSED_LIMIT_TTL` seconds without 429."""
+        if self.guessed_at is None:
+            return
+        if monotonic() - self.guessed_at < LLM_GUESSED_LIMIT_TTL:
+            return
+        self.guessed_at = None
+        self.requests.set_limit(self.rpm)
+        logging.info(f"{self.name}: guessed requests limit forgotten")
+
+    def learn_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Limits sent in the `x-ratelimit-*` headers, by the APIs that do."""
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit and limit.isdigit():
+                level = float(remaining) if remaining and remaining.isdigit() else None
+                bucket.set_limit(int(limit), level)
+                if kind == "requests":
+                    self.rpm = int(limit)
+                    self.guessed_at = None
+
+
+@dataclass(order=True)
+class Request:
+    priority: Priority
+    seq: int
+    tokens: int = field(compare=False)
+    models: list[str] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued_at: float = field(compare=False, default_factory=monotonic)
+
+
+class SchedulerStats:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        # Priority: [requests, total wait, max wait]
+        self.waits = {priority: [0, 0.0, 0.0] for priority in Priority}
+        self.rate_limits = 0
+        self.exhausted = 0
+
+    def record_wait(self, priority: Priority, wait: float) -> None:
+        entry = self.waits[priority]
+        entry[0] += 1
+        entry[1] += wait
+        entry[2] = max(entry[2], wait)
+
+    def summary(self) -> dict:
+        waits = {
+            priority.name.lower(): (
+                f"{n} requests, avg wait {total / n * 1000:.0f}ms, "
+                f"max {longest * 1000:.0f}ms"
+            )
+            for priority, (n, total, longest) in self.waits.items()
+            if n
+        }
+        return {
+            **waits,
+            "rate_limits": self.rate_limits,
+            "exhausted": self.exhausted,
+        }
+
+    def log(self) -> None:
+        logging.info(f"LLM scheduler: {self.summary()}")
+        self.reset()
+
+
+class LLMScheduler:
+    """Queue of the LLM requests, served by priority (chat first, memory last)
+    when a model has capacity. Each model has token buckets for its requests
+    and input tokens per minute, given in `GEMINI_MODEL_LIMITS` or learned from
+    the rate limit errors. A request is sent to the first model of its list
+    with capacity, and goes back to the queue for another one after a 429.
+    Each priority has a max number of running requests (`LLM_CONCURRENCY`)
+    and a max wait (`LLM_MAX_WAIT`)."""
+
+    def __init__(self, models: list[str]) -> None:
+        assert models, "No Gemini model available"
+        self.models = models  # Default models, in order of preference
+        self.states: dict[str, ModelState] = {}
+        self.queue: list[Request] = []
+        self.seq = count()
+        self.running = {priority: 0 for priority in Priority}
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.stats = SchedulerStats()
+
+    def state(self, model: str) -> ModelState:
+        if model not in self.states:
+            self.states[model] = ModelState(model)
+        return self.states[model]
+
+    @property
+    def waiting(self) -> int:
+        return sum(not request.future.done() for request in self.queue)
+
+    async def run(
+        self,
+        call: Callable[[str], Awaitable[T]],
+        priority: Priority,
+        tokens: int = 1,
+        models: Optional[list[str]] = None,
+        usage: Callable[[T], Any] = lambda response: response,
+    ) -> T:
+        """Return `await call(model)`, with the first model of `models` (the
+        utility models by default) having capacity for `tokens` input tokens.
+        `usage` returns the response (with its usage metadata) from the result.
+        Raise ModelsExhausted after the max wait of the priority."""
+        models = models or self.models
+        max_wait = LLM_MAX_WAIT[priority.name.lower()]
+        deadline = monotonic() + max_wait
+        # The only model of a request (e.g. the chat model) is never paused
+        # longer than its max wait, the next requests can still use it
+        max_pause = max_wait if len(models) == 1 else None
+        while True:
+            model = await self.acquire(priority, tokens, models, deadline)
+            try:
+                result = await call(model)
+            except Exception as e:
+                if not is_rate_limit(e):
+                    raise
+                self.stats.rate_limits += 1
+                self.state(model).rate_limited(e, max_pause)
+                continue
+            finally:
+                self.release(priority)
+            self.record_usage(model, tokens, usage(result))
+            return result
+
+    async def acquire(
+        self, priority: Priority, tokens: int, models: list[str], deadline: float
+    ) -> str:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self.queue, Request(priority, next(self.seq), tokens, models, future)
+        )
+        self.dispatch()
+        try:
+            return await asyncio.wait_for(future, max(deadline - monotonic(), 0))
+        except asyncio.TimeoutError:
+            self.stats.exhausted += 1
+            raise ModelsExhausted("No more model available") from None
+        except asyncio.CancelledError:
+            # Given a model right before being cancelled
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            raise
+
+    def release(self, priority: Priority) -> None:
+        self.running[priority] -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """Give a model to the waiting requests that can run, by priority."""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        waiting: list[Request] = []
+        # Models a request with a higher priority is waiting for
+        reserved: set[str] = set()
+        next_check: Optional[float] = None
+        while self.queue:
+            request = heapq.heappop(self.queue)
+            if request.future.done():  # Timed out
+                continue
+            priority = request.priority
+            if self.running[priority] >= LLM_CONCURRENCY[priority.name.lower()]:
+                waiting.append(request)
+                continue
+
+            model, wait = self.pick(request, reserved)
+            if model is None:
+                waiting.append(request)
+                reserved.update(request.models)
+                if wait is not None:
+                    next_check = wait if next_check is None else min(next_check, wait)
+                continue
+
+            self.state(model).start(request.tokens)
+            self.running[priority] += 1
+            self.stats.record_wait(priority, monotonic() - request.queued_at)
+            request.future.set_result(model)
+
+        for request in waiting:
+            heapq.heappush(self.queue, request)
+        if next_check is not None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(next_check, self.dispatch)
+
+    def pick(
+        self, request: Request, reserved: set[str]
+    ) -> tuple[Optional[str], Optional[float]]:
+        """First model of the request with capacity, or the shortest wait for
+        one (None if they are all reserved)."""
+        shortest = None
+        for model in request.models:
+            if model in reserved:
+                continue
+            wait = self.state(model).wait_time(request.tokens)
+            if wait <= 0:
+                return model, None
+            shortest = wait if shortest is None else min(shortest, wait)
+        return None, shortest
+
+    def record_usage(self, model: str, estimated: int, response: Any) -> None:
+        """Correct the token estimation, and read the limits in the headers."""
+        state = self.state(model)
+        metadata = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(metadata, "prompt_token_count", None)
+        if prompt_tokens:
+            state.tokens.take(prompt_tokens - estimated)
+        headers = getattr(getattr(response, "sdk_http_response", None), "headers", None)
+        if headers:
+            state.learn_from_headers(headers)
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from config import LOCAL_VECTOR_FOLDER
+
+
+class GuildVectors:
+    """Vectors of a server: normalized rows of a matrix, with their IDs and
+    metadata in the same order."""
+
+    def __init__(self, ids: list[str], metadata: list[dict], matrix: np.ndarray):
+        self.ids = ids
+        self.metadata = metadata
+        self.matrix = matrix
+
+    @classmethod
+    def from_entries(cls, entries: list[tuple[str, list, dict]]) -> "GuildVectors":
+        if not entries:
+            return cls([], [], np.empty((0, 0), dtype=np.float32))
+        ids, values, metadata = (list(column) for column in zip(*entries))
+        return cls(ids, metadata, normalize(np.array(values, dtype=np.float32)))
+
+    def entries(self) -> list[tuple[str, np.ndarray, dict]]:
+        return list(zip(self.ids, self.matrix, self.metadata))
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class LocalVectorIndex:
+    """Copy of the Pinecone vectors of each server, queried in process
+    (cosine similarity). Each server is saved in `folder` as a .npy matrix
+    and a .json file with the IDs and metadata."""
+
+    def __init__(self, folder: Path = LOCAL_VECTOR_FOLDER) -> None:
+        self.folder = folder
+        self.guilds: dict[int, GuildVectors] = {}
+        # Servers synced with Pinecone since the start
+        self.synced: set[int] = set()
+        # Server ID: upserts and deletions (None) made during each running sync
+        self.changes: dict[int, list[dict[str, Optional[tuple]]]] = {}
+        self.lock = asyncio.Lock()
+
+    def paths(self, id: int) -> tuple[Path, Path]:
+        return self.folder / f"{id}.npy", self.folder / f"{id}.json"
+
+    def get(self, id: int) -> Optional[GuildVectors]:
+        """Vectors of a server, loaded from the disk on first use."""
+        if id in self.guilds:
+            return self.guilds[id]
+        matrix_path, metadata_path = self.paths(id)
+        if not (matrix_path.is_file() and metadata_path.is_file()):
+            return None
+        try:
+            with open(metadata_path, encoding="utf-8") as file:
+                saved = json.load(file)
+            # Not memory-mapped: the file is replaced when saving (fails on
+            # Windows while mapped)
+            matrix = np.load(matrix_path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to load the local vectors of {id}: {repr(e)}")
+            return None
+        guild = GuildVectors(saved["ids"], saved["metadata"], matrix)
+        self.guilds[id] = guild
+        return guild
+
+    def query(self, id: int, vector: list, top_k: int) -> list[dict]:
+        """Most similar vectors, as Pinecone matches (id, score, metadata)."""
+        guild = self.get(id)
+        if not guild or not guild.ids:
+            return []
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        scores = guild.matrix @ query
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            {
+                "id": guild.ids[i],
+                "score": float(scores[i]),
+                "metadata": guild.metadata[i],
+            }
+            for i in best
+        ]
+
+    def track_changes(self, id: int) -> dict[str, Optional[tuple]]:
+        """Record the upserts and deletions of a server while fetching its
+        vectors from Pinecone, until `replace()` or `untrack()`."""
+        changes: dict[str, Optional[tuple]] = {}
+        self.changes.setdefault(id, []).append(changes)
+        return changes
+
+    def untrack(self, id: int, changes: dict[str, Optional[tuple]]) -> None:
+        tracked = [c for c in self.changes.get(id, []) if c is not changes]
+        if tracked:
+            self.changes[id] = tracked
+        else:
+            self.changes.pop(id, None)
+
+    def _record(self, id: int, changes: dict[str, Optional[tuple]]) -> None:
+        for tracked in self.changes.get(id, []):
+            tracked.update(changes)
+
+    async def replace(
+        self,
+        id: int,
+        entries: list[tuple[str, list, dict]],
+        changes: dict[str, Optional[tuple]],
+    ) -> None:
+        """Replace the vectors of a server, after fetching them from Pinecone.
+        The `changes` made locally since `track_changes()` are kept."""
+        self.untrack(id, changes)
+        merged = [e for e in entries if e[0] not in changes]
+        merged += [entry for entry in changes.values() if entry is not None]
+        await self.save(id, GuildVectors.from_entries(merged))
+        self.synced.add(id)
+
+    async def upsert(self, id: int, entries: list[tuple[str, list, dict]]) -> None:
+        self._record(id, {entry[0]: entry for entry in entries})
+        guild = self.get(id)
+        new_ids = {entry[0] for entry in entries}
+        kept = [e for e in guild.entries() if e[0] not in new_ids] if guild else []
+        await self.save(id, GuildVectors.from_entries(kept + entries))
+
+    async def delete(self, id: int, vector_ids: list[str]) -> None:
+        self._record(id, dict.fromkeys(vector_ids))
+        guild = self.get(id)
+        if not guild:
+            return
+        removed = set(vector_ids)
+        kept = [e for e in guild.entries() if e[0] not in removed]
+        await self.save(id, GuildVectors.from_entries(kept))
+
+    async def save(self, id: int, guild: GuildVectors) -> None:
+        self.guilds[id] = guild
+        async with self.lock:
+            try:
+                await asyncio.to_thread(self._save, id, guild)
+            except OSError as e:
+                logging.error(f"Failed to save the local vectors of {id}: {repr(e)}")
+
+    def _save(self, id: int, guild: GuildVectors) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        matrix_path, metadata_path = self.paths(id)
+        # Written next to the files, then renamed
+        tmp_matrix = matrix_path.with_suffix(".tmp.npy")
+        tmp_metadata = metadata_path.with_suffix(".tmp.json")
+        np.save(tmp_matrix, guild.matrix)
+        with open(tmp_metadata, "w", encoding="utf-8") as file:
+            json.dump({"ids": guild.ids, "metadata": guild.metadata}, file)
+        os.replace(tmp_matrix, matrix_path)
+        os.replace(tmp_metadata, metadata_path)
+
+
+local_index = LocalVectorIndex()
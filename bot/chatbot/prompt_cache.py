@@ -0,0 +1,164 @@
+import asyncio
+from hashlib import sha256
+import logging
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from time import time
+from typing import NamedTuple, Optional
+import unicodedata
+
+from config import PROMPT_CACHE_PATH, PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL
+
+
+class PromptKey(NamedTuple):
+    """What a utility prompt depends on, apart from the model."""
+
+    task: str  # E.g. "translate"
+    text: str  # Input of the user
+    target: str = ""  # Target language or script
+
+
+def normalize_input(text: str) -> str:
+    """Same Unicode forms, no extra spaces, but the lines are kept."""
+    text = unicodedata.normalize("NFKC", text)
+    lines = (re.sub(r"[^\S\n]+", " ", line).strip() for line in text.split("\n"))
+    return "\n".join(lines).strip()
+
+
+def prompt_key_hash(key: PromptKey, model: str) -> str:
+    parts = (key.task, model, normalize_input(key.text), key.target.strip().lower())
+    return sha256("\0".join(parts).encode()).hexdigest()
+
+
+class PromptCacheStats:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.hits: dict[str, int] = {}  # Task: count
+        self.misses: dict[str, int] = {}
+        self.tokens_saved = 0
+
+    def summary(self) -> dict:
+        tasks = sorted(self.hits.keys() | self.misses.keys())
+        return {
+            **{
+                task: f"{self.hits.get(task, 0)} hits, "
+                f"{self.misses.get(task, 0)} misses"
+                for task in tasks
+            },
+            "tokens_saved": self.tokens_saved,
+        }
+
+    def log(self) -> None:
+        logging.info(f"Prompt cache: {self.summary()}")
+        self.reset()
+
+
+class PromptCache:
+    """Results of the utility prompts (translations, lyrics conversions,
+    example sentences) kept in SQLite with the tokens they used.
+    They expire after `PROMPT_CACHE_TTL` seconds, and the least recently used
+    ones are evicted above `PROMPT_CACHE_SIZE` entries."""
+
+    def __init__(
+        self,
+        path: Path = PROMPT_CACHE_PATH,
+        max_size: int = PROMPT_CACHE_SIZE,
+        ttl: float = PROMPT_CACHE_TTL,
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.stats = PromptCacheStats()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, in a worker thread
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Shared by the processes started by launcher.py
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA busy_timeout = 5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_results ("
+                "key TEXT PRIMARY KEY, task TEXT NOT NULL, result TEXT NOT NULL, "
+                "tokens INTEGER NOT NULL, created REAL NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS prompt_results_last_access "
+                "ON prompt_results (last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _get(self, key: str) -> Optional[tuple[str, int]]:
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT result, tokens, created FROM prompt_results WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            result, tokens, created = row
+            if now - created > self.ttl:
+                conn.execute("DELETE FROM prompt_results WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE prompt_results SET last_access = ? WHERE key = ?", (now, key)
+            )
+            conn.commit()
+        return result, tokens
+
+    def _put(self, key: str, task: str, result: str, tokens: int) -> None:
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO prompt_results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, task, result, tokens, now, now),
+            )
+            conn.execute(
+                "DELETE FROM prompt_results WHERE created < ?", (now - self.ttl,)
+            )
+            conn.execute(
+                "DELETE FROM prompt_results WHERE key IN ("
+                "SELECT key FROM prompt_results ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            conn.commit()
+
+    async def get(self, key: PromptKey, model: str) -> Optional[str]:
+        """Cached result of a prompt, counted in the stats."""
+        try:
+            cached = await asyncio.to_thread(self._get, prompt_key_hash(key, model))
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error getting a prompt result: {e}", exc_info=True)
+            cached = None
+
+        if cached is None:
+            self.stats.misses[key.task] = self.stats.misses.get(key.task, 0) + 1
+            return None
+        result, tokens = cached
+        self.stats.hits[key.task] = self.stats.hits.get(key.task, 0) + 1
+        self.stats.tokens_saved += tokens
+        return result
+
+    async def put(self, key: PromptKey, model: str, result: str, tokens: int) -> None:
+        try:
+            await asyncio.to_thread(
+                self._put, prompt_key_hash(key, model), key.task, result, tokens
+            )
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error storing a prompt result: {e}", exc_info=True)
+
+
+prompt_cache = PromptCache()
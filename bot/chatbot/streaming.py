@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from time import perf_counter
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+from bot.utils import split_into_chunks
+from config import CHATBOT_STREAM_EDIT_INTERVAL
+
+
+class StreamedReply:
+    """Discord messages of a chatbot reply, edited while it is generated.
+    The text is split with `split_into_chunks`, each chunk in its own message
+    (sent when the text reaches it), and only the changed messages are edited.
+    Edits are throttled: at most one round every `CHATBOT_STREAM_EDIT_INTERVAL`
+    seconds, or longer when Discord is slow to answer (rate limited)."""
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[discord.Message]],
+        max_messages: int = 4,
+    ) -> None:
+        self.send = send
+        self.max_messages = max_messages
+        self.messages: list[discord.Message] = []
+        self.contents: list[str] = []  # Content of each message
+        self.text = ""  # Latest text, not shown yet
+        self.changed = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, text: str) -> None:
+        """Show the text generated so far, on the next edit."""
+        self.text = text
+        self.changed.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while not self.finished.is_set():
+            await self.changed.wait()
+            if self.finished.is_set():
+                return
+            self.changed.clear()
+            start = perf_counter()
+            await self.render(self.text)
+            # Wait longer if the edits have been delayed by Discord
+            delay = max(CHATBOT_STREAM_EDIT_INTERVAL, perf_counter() - start)
+            try:
+                await asyncio.wait_for(self.finished.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def render(self, text: str) -> int:
+        """Return the number of chunks of the text."""
+        chunks = split_into_chunks(text, 2000)[: self.max_messages]
+        for i, chunk in enumerate(chunks):
+            try:
+                if i >= len(self.messages):
+                    self.messages.append(await self.send(chunk))
+                    self.contents.append(chunk)
+                elif self.contents[i] != chunk:
+                    await self.messages[i].edit(content=chunk)
+                    self.contents[i] = chunk
+            except discord.HTTPException as e:
+                logging.error(f"Failed to update a streamed reply: {repr(e)}")
+                break
+        return len(chunks)
+
+    async def finish(self, text: str) -> list[discord.Message]:
+        """Show the final text right away, and return the messages."""
+        self.finished.set()
+        self.changed.set()
+        if self.task:
+            # Let the running edit end
+            await self.task
+        chunk_count = await self.render(text)
+
+        # The final text can be shorter (e.g. without the emotes)
+        while len(self.messages) > max(chunk_count, 1):
+            message = self.messages.pop()
+            self.contents.pop()
+            try:
+                await message.delete()
+            except discord.HTTPException as e:
+                logging.error(f"Failed to delete a streamed message: {repr(e)}")
+        return self.messages
@@ -0,0 +1,36 @@
+from contextlib import contextmanager
+import logging
+from time import perf_counter
+from typing import Awaitable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class Trace:
+    """Duration of each stage of a chatbot reply, logged on a single line."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = perf_counter()
+        self.stages: dict[str, float] = {}  # Name: duration (in seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = perf_counter() - start
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.stage(name):
+            return await awaitable
+
+    def mark(self, name: str) -> None:
+        """Time elapsed since the start of the trace, only the first time."""
+        self.stages.setdefault(name, perf_counter() - self.start)
+
+    def log(self) -> None:
+        stages = ", ".join(f"{n} {d * 1000:.0f}ms" for n, d in self.stages.items())
+        total = (perf_counter() - self.start) * 1000
+        logging.info(f"{self.name}: {stages}, total {total:.0f}ms")
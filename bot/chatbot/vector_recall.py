@@ -4,42 +4,83 @@ import logging
 import uuid
 from datetime import datetime
 import json
+import re
+from time import perf_counter
+from typing import Optional
 
 from google.genai import types, errors
 from pinecone.grpc import PineconeGRPC as Pinecone
 from pinecone import ServerlessSpec
 import pytz
 
-from bot.chatbot.chat_dataclass import ChatbotHistory
-from bot.chatbot.gemini_client import client, utils_models_manager
+from bot.chatbot.chat_dataclass import ChatbotHistory, ChatbotMessage
+from bot.chatbot.embeddings import EmbeddingService
+from bot.chatbot.local_index import local_index
+from bot.chatbot.gemini_client import client, llm_scheduler
+from bot.chatbot.llm_scheduler import ModelsExhausted, Priority, estimate_tokens
 from config import (
     CHATBOT_TIMEZONE,
+    EMBEDDING_MODEL,
     PINECONE_ENABLED,
     GEMINI_SAFETY_SETTINGS,
+    LOCAL_VECTOR_SYNC_SIZE,
+    MEMORY_BATCH_SIZE,
+    MEMORY_BATCH_DELAY,
+    MEMORY_MIN_LENGTH,
 )
 
 
 # Init
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+# One item per message of the batch
 response_schema = {
-    "type": "object",
-    "properties": {
-        "query_type": {
-            "type": "string",
-            "enum": ["question", "info", "other", "important_caracteristic"],
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer"},
+            "query_type": {
+                "type": "string",
+                "enum": ["question", "info", "other", "important_caracteristic"],
+            },
+            "text": {"type": "string"},
         },
-        "text": {"type": "string"},
+        "required": ["index", "query_type", "text"],
     },
-    "required": ["query_type", "text"],
 }
 
+# Local pre-filter: messages that may be worth remembering
+first_person_cue = re.compile(
+    r"\b(?:i|i'm|im|i've|i'd|my|me|mine|myself|we|our|us|je|j'|mon|ma|mes|moi)\b"
+    r"|私|僕|俺|わたし|ぼく|おれ"
+)
+memory_cue = re.compile(
+    r"remember|forget|souviens|retiens|oublie|覚えて|忘れ", flags=re.IGNORECASE
+)
+
+
+def worth_remembering(content: str) -> bool:
+    """Cheap check before the classification by the LLM: skip the short
+    messages and the questions, keep the personal ones or the ones with
+    numbers (dates, ages...) and the explicit requests to remember."""
+    text = content.strip().lower()
+    if len(text) < MEMORY_MIN_LENGTH:
+        return False
+    if memory_cue.search(text):
+        return True
+    if text.endswith("?"):
+        return False
+    return bool(first_person_cue.search(text) or re.search(r"\d", text))
+
 
 class Memory:
     def __init__(self) -> None:
         self.timezone = pytz.timezone(CHATBOT_TIMEZONE)
         self.prompt = """
-Here a set of messages categorize and memorize.
+Here a set of numbered messages to categorize and memorize.
+Return one item per message, with the number of the message as index.
+The previous messages of the list can give context.
 Use these rules to define the type:
 - “important_caracteristic”: IF ANY OF THE MESSAGE countains an information about personal tastes (e.g. favorite food), 
 personal factual data (birthday, age, etc.), real-world facts (historical events, fun facts, life info) 
@@ -51,11 +92,25 @@ In the text field, add what info we should remember if the type == “important_
 but nothing otherwise.\n
 """
         self.active = False
+        self.embeddings = EmbeddingService(self._embed, model=EMBEDDING_MODEL)
+        self.local_index = local_index
+        # Server ID: messages waiting to be classified, and their futures
+        self.buffers: dict[int, list[tuple[ChatbotMessage, asyncio.Future]]] = {}
+        self.flush_handles: dict[int, asyncio.TimerHandle] = {}
+        self.skipped = 0  # Messages skipped by the pre-filter since the last log
+        # Batches to classify, stored one after the other in the background
+        self.store_queue: asyncio.Queue = asyncio.Queue()
+        self.store_task: Optional[asyncio.Task] = None
 
-    async def init_pinecone(self, index_name: str) -> None:
+    async def init_pinecone(self, index_name: str, pc=None) -> None:
+        """`pc` replaces the Pinecone client, e.g. with a local stand-in
+        (with `inference.embed`, `list_indexes`, `create_index` and `Index`)."""
         if not PINECONE_ENABLED:
             return
-        if not PINECONE_API_KEY:
+        if pc is not None:
+            self.pc = pc
+            self.active = True
+        elif not PINECONE_API_KEY:
             logging.warning(
                 "No valid Pinecone API key has been provided. "
                 "Disable Pinecone from the config file if you do not plan to use it."
@@ -68,7 +123,7 @@ but nothing otherwise.\n
                 self.pc = await asyncio.to_thread(Pinecone, api_key=PINECONE_API_KEY)
                 self.active = True
             except Exception as e:
-                await logging.error(
+                logging.error(
                     f"Connection to Pinecone API failed: {e}, trying again in 60 seconds."
                 )
                 await asyncio.sleep(60)
@@ -83,29 +138,95 @@ but nothing otherwise.\n
         self.index = self.pc.Index(index_name)
         logging.info("Pinecone has been initialized successfully")
 
-    async def generate_embeddings(self, inputs: list) -> list:
-        embeddings = await asyncio.to_thread(
-            self.pc.inference.embed,
-            model="multilingual-e5-large",
+    def _embed(self, inputs: list[str]) -> list:
+        # Blocking, batched by the embedding service
+        embeddings = self.pc.inference.embed(
+            model=EMBEDDING_MODEL,
             inputs=inputs,
             parameters={"input_type": "query", "truncate": "END"},
         )
-        vectors: list = [vector["values"] for vector in embeddings]
-        return vectors
+        return [vector["values"] for vector in embeddings]
+
+    async def generate_embeddings(self, inputs: list[str]) -> list:
+        """Embeddings of the texts, cached and batched with other requests."""
+        return await self.embeddings.get(inputs)
+
+    def queue_store(self, history: ChatbotHistory) -> asyncio.Future:
+        """Classify the last message of a history in the background, with the
+        next messages of the server. The future is set to True if a memory
+        has been stored from it."""
+        future = asyncio.get_running_loop().create_future()
+        message = history.last_message
+        if not self.active or message is None:
+            future.set_result(False)
+            return future
+
+        if not worth_remembering(message.content):
+            self.skipped += 1
+            future.set_result(False)
+            return future
 
-    # async def store(self, chatbot_message: ChatbotMessage) -> bool:
-    async def store(self, history: ChatbotHistory) -> bool:
-        """If relevant, store a Pinecone vector in the index based on the last 3 messages."""
-        if not self.active:
+        # Classified every MEMORY_BATCH_SIZE messages or MEMORY_BATCH_DELAY seconds
+        guild_id = message.guild_id
+        buffer = self.buffers.setdefault(guild_id, [])
+        buffer.append((message, future))
+        if len(buffer) >= MEMORY_BATCH_SIZE:
+            self.flush(guild_id)
+        elif guild_id not in self.flush_handles:
+            self.flush_handles[guild_id] = asyncio.get_running_loop().call_later(
+                MEMORY_BATCH_DELAY, self.flush, guild_id
+            )
+        return future
+
+    def flush(self, guild_id: int) -> None:
+        handle = self.flush_handles.pop(guild_id, None)
+        if handle:
+            handle.cancel()
+        batch = self.buffers.pop(guild_id, None)
+        if not batch:
             return
+        self.store_queue.put_nowait(batch)
+        if self.store_task is None or self.store_task.done():
+            self.store_task = asyncio.create_task(self.process_store_queue())
+
+    async def process_store_queue(self) -> None:
+        while True:
+            batch = await self.store_queue.get()
+            messages = [message for message, _ in batch]
+            start = perf_counter()
+            try:
+                stored = await self.store(messages)
+            except Exception as e:
+                logging.error(f"Failed to store memories: {repr(e)}")
+                stored = [False] * len(batch)
+            logging.info(
+                f"Memory of {messages[0].guild_id}: {sum(stored)} stored from "
+                f"{len(batch)} messages, {(perf_counter() - start) * 1000:.0f}ms "
+                f"({self.skipped} skipped by the pre-filter since the last batch, "
+                f"{self.store_queue.qsize()} batches waiting)"
+            )
+            self.skipped = 0
+            for (_, future), is_stored in zip(batch, stored):
+                if not future.done():
+                    future.set_result(is_stored)
+
+    async def store(self, messages: list[ChatbotMessage]) -> list[bool]:
+        """Classify messages of a server in a single call, and store a Pinecone
+        vector for each relevant one. Return whether each message has been stored."""
+        if not self.active or not messages:
+            return [False] * len(messages)
+        contents = "\n".join(
+            f"{i}. {message.author}: {message.content}"
+            for i, message in enumerate(messages)
+        )
 
         # Generate metadata using Gemini
         date: str = datetime.now(self.timezone).strftime("%Y-%m-%d")
-        model = utils_models_manager.pick()
-        try:
-            response = await client.aio.models.generate_content(
+
+        async def classify(model: str) -> types.GenerateContentResponse:
+            return await client.aio.models.generate_content(
                 model=model,
-                contents=f"{history:pinecone_last_3}",
+                contents=contents,
                 config=types.GenerateContentConfig(
                     system_instruction=self.prompt,
                     response_mime_type="application/json",
@@ -117,54 +238,110 @@ but nothing otherwise.\n
                     safety_settings=GEMINI_SAFETY_SETTINGS,
                 ),
             )
+
+        try:
+            response = await llm_scheduler.run(
+                classify,
+                Priority.MEMORY,
+                tokens=estimate_tokens(self.prompt + contents),
+            )
+        except ModelsExhausted as e:
+            logging.error(f"Memories not classified: {e}")
+            return [False] * len(messages)
         except errors.APIError as e:
-            if e.code == 429:
-                utils_models_manager.add_down_model(model)
-                return await self.store(history)
             logging.error(repr(e))
+            return [False] * len(messages)
 
-        metadata = json.loads(response.text)
-        last_message = history.messages[-1]
-        metadata["id"] = last_message.guild_id
-        metadata["text"] = f"{date}-{last_message.author}: {metadata['text']}"
-
-        if metadata["query_type"] in {"info", "question", "other"}:
-            return False
-
-        # Important carac: remove the messages from the Pinecone history
-        history.pinecone_remove_last_three()
+        # Important carac only, one per message
+        memories: dict[int, dict] = {}
+        for item in json.loads(response.text):
+            i = item.get("index")
+            if (
+                item.get("query_type") == "important_caracteristic"
+                and isinstance(i, int)
+                and 0 <= i < len(messages)
+            ):
+                message = messages[i]
+                memories[i] = {
+                    "query_type": item["query_type"],
+                    "id": message.guild_id,
+                    "text": f"{date}-{message.author}: {item['text']}",
+                }
+        if not memories:
+            return [False] * len(messages)
 
         # Create the embeddings/vectors
-        vector_values = await self.generate_embeddings(metadata["text"])
-        unique_id = str(uuid.uuid4())
-        vectors = [{"id": unique_id, "values": vector_values[0], "metadata": metadata}]
+        texts = [metadata["text"] for metadata in memories.values()]
+        vector_values = await self.generate_embeddings(texts)
+        vectors = [
+            {"id": str(uuid.uuid4()), "values": values, "metadata": metadata}
+            for values, metadata in zip(vector_values, memories.values())
+        ]
 
         # Add to db
         await asyncio.to_thread(self.index.upsert, vectors=vectors)
+        await self.local_index.upsert(
+            messages[0].guild_id,
+            [(v["id"], v["values"], v["metadata"]) for v in vectors],
+        )
 
-        logging.info(f"Added to Pinecone: {metadata['text']}")
-        return True
+        for text in texts:
+            logging.info(f"Added to Pinecone: {text}")
+        return [i in memories for i in range(len(messages))]
 
     async def get_vectors(self, text: str, id: int, top_k=999) -> list:
-        if not self.active:
-            raise RuntimeError("Pinecone class not active")
+        """Most similar vectors of a server (or DM), from the local index.
+        The server is synced with Pinecone the first time. If Pinecone is
+        unavailable, the local copy is used as it is, with the embedding of
+        the text if it is cached."""
+        vector = None
+        if self.active:
+            try:
+                vector = (await self.generate_embeddings([text]))[0]
+            except Exception as e:
+                logging.error(repr(e))
+        if vector is None:
+            vector = await self.embeddings.get_cached(text)
+            if vector is None:
+                return []
+
+        if self.active and id not in self.local_index.synced:
+            try:
+                await self.sync_local_index(id, vector)
+            except Exception as e:
+                logging.error(f"Failed to sync the vectors of {id}: {repr(e)}")
+
+        return self.local_index.query(id, vector, top_k)
+
+    async def sync_local_index(self, id: int, vector: list) -> None:
+        """Copy the vectors of a server from Pinecone (no listing by metadata,
+        so the closest `LOCAL_VECTOR_SYNC_SIZE` vectors are fetched)."""
+        # Memories stored or deleted meanwhile are merged
+        changes = self.local_index.track_changes(id)
         try:
-            vectors = await self.generate_embeddings([text])
             results = await asyncio.to_thread(
                 self.index.query,
-                vector=vectors[0],
+                vector=vector,
                 filter={
                     "id": {"$eq": id}  # Guild id
                 },
-                top_k=top_k,
+                top_k=LOCAL_VECTOR_SYNC_SIZE,
+                include_values=True,
                 include_metadata=True,
             )
-            vectors = [vector for vector in results["matches"]]
-        except Exception as e:
-            logging.error(repr(e))
-            vectors = []
+        except Exception:
+            self.local_index.untrack(id, changes)
+            raise
+        entries = [
+            (match["id"], list(match["values"]), dict(match["metadata"]))
+            for match in results["matches"]
+        ]
+        await self.local_index.replace(id, entries, changes)
+        logging.info(f"Synced {len(entries)} vectors of {id} from Pinecone")
 
-        return vectors
+    async def delete_vectors(self, id: int, vector_ids: list[str]) -> None:
+        await asyncio.to_thread(self.index.delete, vector_ids)
+        await self.local_index.delete(id, vector_ids)
 
 
 memory = Memory()
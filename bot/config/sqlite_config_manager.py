@@ -1,115 +1,317 @@
-import sqlite3
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
-from typing import Set, Dict, Literal, Optional
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, FrozenSet, Literal, Optional, Tuple, TypeVar
 
 from config import DB_PATH
 
-DATABASE_TABLE_SCHEMAS = {
-    "chatbot_emotes": " (name TEXT PRIMARY KEY, emote_value TEXT NOT NULL)",
-    "onsei_servers": " (server_id INTEGER PRIMARY KEY)",
-    "chatbot_ids": " (server_id INTEGER PRIMARY KEY)",
-    "gemini_servers": " (server_id INTEGER PRIMARY KEY)",
-}
+T = TypeVar("T")
+
+# Schema changes, applied in order on the first connection.
+# `PRAGMA user_version` is the number of migrations already applied:
+# add new ones at the end, never edit the previous ones.
+MIGRATIONS = [
+    # 1: tables of the first versions of the bot
+    """
+    CREATE TABLE IF NOT EXISTS chatbot_emotes
+        (name TEXT PRIMARY KEY, emote_value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS onsei_servers (server_id INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS chatbot_ids (server_id INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS gemini_servers (server_id INTEGER PRIMARY KEY);
+    """,
+    # 2: single row, incremented on each write to reload the other processes
+    """
+    CREATE TABLE IF NOT EXISTS config_version
+        (id INTEGER PRIMARY KEY, version INTEGER NOT NULL);
+    """,
+]
+
+WHITELIST_TABLES = ("onsei_servers", "chatbot_ids", "gemini_servers")
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version in range(current + 1, len(MIGRATIONS) + 1):
+        conn.executescript(
+            f"BEGIN IMMEDIATE; {MIGRATIONS[version - 1]} "
+            f"PRAGMA user_version = {version}; COMMIT;"
+        )
+        logging.info(f"Config database migrated to version {version}")
+
+
+class ConfigStore:
+    """Config database, used by a single thread with a persistent connection
+    (in WAL mode, with its prepared statements kept by sqlite3).
+    The writes queued while the thread is busy are committed in one
+    transaction, so admin commands never block the event loop."""
+
+    def __init__(self, path: Path = DB_PATH) -> None:
+        self.path = path
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="config-db"
+        )
+        self.conn: Optional[sqlite3.Connection] = None  # Only used by the thread
+        # Queued writes and their futures
+        self.pending: list[Tuple[Callable[[sqlite3.Connection], Any], Future]] = []
+        self.pending_lock = threading.Lock()
+        self.flush_scheduled = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, in the database thread
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA busy_timeout = 5000")
+            migrate(conn)
+            self.conn = conn
+            logging.info(f"Config database opened at {self.path}")
+        return self.conn
+
+    def _run(self, query: Callable[[sqlite3.Connection], T]) -> T:
+        return query(self._connect())
+
+    async def read(self, query: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.wrap_future(self.executor.submit(self._run, query))
+
+    def read_blocking(self, query: Callable[[sqlite3.Connection], T]) -> T:
+        return self.executor.submit(self._run, query).result()
+
+    async def write(self, query: Callable[[sqlite3.Connection], T]) -> T:
+        """Queue a write, committed with the other pending ones."""
+        future: Future = Future()
+        with self.pending_lock:
+            self.pending.append((query, future))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                self.executor.submit(self._flush)
+        return await asyncio.wrap_future(future)
+
+    def _flush(self) -> None:
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+            self.flush_scheduled = False
 
+        results: list[Tuple[Future, Any, Optional[Exception]]] = []
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            for query, future in batch:
+                # A failed write doesn't cancel the others
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, query(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((future, None, e))
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.conn and self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
 
-def initialize_database():
+        if len(batch) > 1:
+            logging.info(f"Committed {len(batch)} config writes")
+        for future, result, error in results:
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _close(self) -> None:
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self) -> None:
+        await asyncio.wrap_future(self.executor.submit(self._close))
+
+
+config_store = ConfigStore()
+
+
+def read_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT version FROM config_version WHERE id = 0").fetchone()
+    return row[0] if row else 0
+
+
+def bump_version(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """Increment the config version, in the transaction of a write.
+    Return the previous and the new version."""
+    previous = read_version(conn)
+    conn.execute(
+        "INSERT INTO config_version (id, version) VALUES (0, 1) "
+        "ON CONFLICT(id) DO UPDATE SET version = version + 1"
+    )
+    return previous, read_version(conn)
+
+
+def read_config(
+    conn: sqlite3.Connection,
+) -> Tuple[int, Dict[str, FrozenSet[int]], Dict[str, str]]:
+    """Return the version, whitelists and emotes, in a single transaction."""
+    conn.execute("BEGIN")
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            for table_name, schema in DATABASE_TABLE_SCHEMAS.items():
-                cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name}{schema}")
-            conn.commit()
-        logging.info(f"Database initialized/checked at {DB_PATH}")
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error during initialization: {e}", exc_info=True)
-        raise
+        version = read_version(conn)
+        whitelists = {
+            table: frozenset(
+                row[0] for row in conn.execute(f"SELECT server_id FROM {table}")
+            )
+            for table in WHITELIST_TABLES
+        }
+        emotes = dict(conn.execute("SELECT name, emote_value FROM chatbot_emotes"))
+    finally:
+        conn.execute("COMMIT")
+    return version, whitelists, emotes
+
+
+class ConfigCache:
+    """Whitelists and emotes kept in memory, so reading them (on every message)
+    doesn't touch the database. Loaded when the bot is ready, updated by the
+    write functions below, and reloaded by `check_version()` when another
+    process changed the database."""
+
+    def __init__(self) -> None:
+        self.whitelists: Dict[str, FrozenSet[int]] = {}  # Table: server IDs
+        self.emotes: Dict[str, str] = {}  # Name: emote
+        self.version: Optional[int] = None  # Version of the cached data
+
+    @property
+    def loaded(self) -> bool:
+        return self.version is not None
+
+    def set(
+        self, config: Tuple[int, Dict[str, FrozenSet[int]], Dict[str, str]]
+    ) -> None:
+        self.version, self.whitelists, self.emotes = config
 
+    async def load(self) -> None:
+        try:
+            self.set(await config_store.read(read_config))
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error loading the config: {e}", exc_info=True)
 
-# Initialize database on module load
-initialize_database()
+    def load_blocking(self) -> None:
+        """Only if the config is needed before the bot is ready."""
+        try:
+            self.set(config_store.read_blocking(read_config))
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error loading the config: {e}", exc_info=True)
+
+    def after_write(
+        self, versions: Tuple[int, int], update: Callable[[], None]
+    ) -> None:
+        """Apply a write to the cache, or reload it if it was already outdated."""
+        previous, version = versions
+        if self.version != previous:
+            asyncio.create_task(self.load())
+            return
+        update()
+        self.version = version
+
+    async def check_version(self) -> bool:
+        """Reload the cache if the config has been changed by another process.
+        Return True if it has been reloaded."""
+        if not self.loaded:
+            return False
+        try:
+            version = await config_store.read(read_version)
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error checking the config version: {e}")
+            return False
+        if version == self.version:
+            return False
+        logging.info(f"Config changed (version {version}), reloading the cache")
+        await self.load()
+        return True
+
+
+config_cache = ConfigCache()
 
 
 # --- CHATBOT_EMOTES ---
-def add_or_update_chatbot_emote(name: str, emote_value: str) -> None:
+async def add_or_update_chatbot_emote(name: str, emote_value: str) -> None:
+    def query(conn: sqlite3.Connection) -> Tuple[int, int]:
+        conn.execute(
+            "INSERT OR REPLACE INTO chatbot_emotes (name, emote_value) VALUES (?, ?)",
+            (name, emote_value),
+        )
+        return bump_version(conn)
+
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO chatbot_emotes (name, emote_value) VALUES (?, ?)",
-                (name, emote_value),
-            )
-            conn.commit()
+        versions = await config_store.write(query)
     except sqlite3.Error as e:
         logging.error(
             f"SQLite error adding/updating chatbot emote '{name}': {e}", exc_info=True
         )
         raise
 
+    # Write-through, the cached dict is replaced as it may be in use
+    def update() -> None:
+        config_cache.emotes = {**config_cache.emotes, name: emote_value}
+
+    config_cache.after_write(versions, update)
+
+
+async def remove_chatbot_emote(name: str) -> bool:
+    def query(conn: sqlite3.Connection) -> Optional[Tuple[int, int]]:
+        cursor = conn.execute("DELETE FROM chatbot_emotes WHERE name = ?", (name,))
+        return bump_version(conn) if cursor.rowcount > 0 else None
 
-def remove_chatbot_emote(name: str) -> bool:
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM chatbot_emotes WHERE name = ?", (name,))
-            conn.commit()
-            return cursor.rowcount > 0
+        versions = await config_store.write(query)
     except sqlite3.Error as e:
         logging.error(
             f"SQLite error removing chatbot emote '{name}': {e}", exc_info=True
         )
         raise
-    return False
+
+    def update() -> None:
+        emotes = dict(config_cache.emotes)
+        emotes.pop(name, None)
+        config_cache.emotes = emotes
+
+    if versions:
+        config_cache.after_write(versions, update)
+    return versions is not None
 
 
 def get_chatbot_emote(name: str) -> Optional[str]:
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT emote_value FROM chatbot_emotes WHERE name = ?", (name,)
-            )
-            row = cursor.fetchone()
-            return row[0] if row else None
-    except sqlite3.Error as e:
-        logging.error(
-            f"SQLite error getting chatbot emote '{name}': {e}", exc_info=True
-        )
-        raise
-    return None
+    return get_all_chatbot_emotes().get(name)
 
 
 def get_all_chatbot_emotes() -> Dict[str, str]:
-    emotes = {}
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name, emote_value FROM chatbot_emotes")
-            for row in cursor.fetchall():
-                emotes[row[0]] = row[1]
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error getting all chatbot emotes: {e}", exc_info=True)
-        # Return what we have, or an empty dict on error
-    return emotes
+    """Emotes of the chatbot, from the cache. The dict should not be modified."""
+    if not config_cache.loaded:
+        config_cache.load_blocking()
+    return config_cache.emotes
 
 
 # --- WHITELISTS (Sets of IDs) ---
 tables = Literal[
-    "onsei_servers", "chatbot_ids", "gemini_server"
+    "onsei_servers", "chatbot_ids", "gemini_servers"
 ]
 
 
-def add_to_whitelist(
+async def add_to_whitelist(
     table_name: tables,
     server_id: int,
 ) -> None:
+    def query(conn: sqlite3.Connection) -> Tuple[int, int]:
+        conn.execute(
+            f"INSERT OR IGNORE INTO {table_name} (server_id) VALUES (?)",
+            (server_id,),
+        )
+        return bump_version(conn)
+
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                f"INSERT OR IGNORE INTO {table_name} (server_id) VALUES (?)",
-                (server_id,),
-            )
-            conn.commit()
+        versions = await config_store.write(query)
     except sqlite3.Error as e:
         logging.error(
             f"SQLite error adding server ID {server_id} to {table_name}: {e}",
@@ -117,42 +319,46 @@ def add_to_whitelist(
         )
         raise
 
+    # Write-through
+    def update() -> None:
+        ids = config_cache.whitelists.get(table_name, frozenset())
+        config_cache.whitelists[table_name] = ids | {server_id}
 
-def remove_from_whitelist(
+    config_cache.after_write(versions, update)
+
+
+async def remove_from_whitelist(
     table_name: tables,
     server_id: int,
 ) -> bool:
+    def query(conn: sqlite3.Connection) -> Optional[Tuple[int, int]]:
+        cursor = conn.execute(
+            f"DELETE FROM {table_name} WHERE server_id = ?", (server_id,)
+        )
+        return bump_version(conn) if cursor.rowcount > 0 else None
+
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                f"DELETE FROM {table_name} WHERE server_id = ?", (server_id,)
-            )
-            conn.commit()
-            return cursor.rowcount > 0
+        versions = await config_store.write(query)
     except sqlite3.Error as e:
         logging.error(
             f"SQLite error removing server ID {server_id} from {table_name}: {e}",
             exc_info=True,
         )
         raise
-    return False
+
+    def update() -> None:
+        ids = config_cache.whitelists.get(table_name, frozenset())
+        config_cache.whitelists[table_name] = ids - {server_id}
+
+    if versions:
+        config_cache.after_write(versions, update)
+    return versions is not None
 
 
 def get_whitelist(
     table_name: tables,
-) -> Set[int]:
-    ids: Set[int] = set()
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT server_id FROM {table_name}")
-            for row in cursor.fetchall():
-                ids.add(row[0])
-    except sqlite3.Error as e:
-        logging.error(
-            f"SQLite error getting whitelist {table_name}: {e}",
-            exc_info=True,
-        )
-        # Return what we have, or an empty set on error
-    return ids
+) -> FrozenSet[int]:
+    """Server IDs of a whitelist, from the cache."""
+    if not config_cache.loaded:
+        config_cache.load_blocking()
+    return config_cache.whitelists.get(table_name, frozenset())
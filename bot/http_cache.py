@@ -0,0 +1,249 @@
+"""Response cache of the shared aiohttp session.
+Each URL is matched to a route of HTTP_CACHE_ROUTES, that sets its expiry
+and max body size. Binary media (audio, video..) is never cached.
+Recently used responses are kept in memory in front of the SQLite cache.
+"""
+
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+import logging
+from typing import AsyncIterable, Optional, Union
+
+from aiohttp import ClientResponse
+from aiohttp_client_cache import CachedResponse, SQLiteBackend
+from aiohttp_client_cache.backends.base import BaseCache, ResponseOrKey
+from aiohttp_client_cache.cache_control import CacheActions, DO_NOT_CACHE
+from yarl import URL
+
+from config import (
+    HTTP_CACHE_ROUTES,
+    HTTP_CACHE_DEFAULT_ROUTE,
+    HTTP_CACHE_BYPASS_MIME_TYPES,
+    HTTP_CACHE_MEMORY_SIZE,
+    HTTP_CACHE_MEMORY_MAX_BODY_SIZE,
+)
+
+
+@dataclass
+class CacheRoute:
+    name: str
+    patterns: tuple[str, ...] = ()
+    expire_after: int = DO_NOT_CACHE
+    max_body_size: Optional[int] = None  # None for no limit
+
+    def matches(self, target: str) -> bool:
+        return any(fnmatchcase(target, pattern) for pattern in self.patterns)
+
+
+routes = [
+    CacheRoute(
+        name,
+        tuple(route["patterns"]),
+        route["expire_after"],
+        route.get("max_body_size"),
+    )
+    for name, route in HTTP_CACHE_ROUTES.items()
+]
+default_route = CacheRoute(
+    "default",
+    expire_after=HTTP_CACHE_DEFAULT_ROUTE["expire_after"],
+    max_body_size=HTTP_CACHE_DEFAULT_ROUTE.get("max_body_size"),
+)
+
+
+def get_route(url: Union[str, URL], params: Optional[dict] = None) -> CacheRoute:
+    url = URL(str(url))
+    if params:
+        url = url.update_query(params)
+    target = f"{url.host}{url.path_qs}"
+    return next((route for route in routes if route.matches(target)), default_route)
+
+
+class RouteStats:
+    def __init__(self) -> None:
+        self.memory_hits = 0
+        self.hits = 0  # Memory or SQLite
+        self.misses = 0
+        self.bypasses = 0  # Not looked up (expire_after=0)
+        self.rejected = 0  # Not stored (binary media or body too large)
+
+    def summary(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "rejected": self.rejected,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+        }
+
+
+class CacheStats:
+    """Per-route cache hit rates."""
+
+    def __init__(self) -> None:
+        self.routes: defaultdict[str, RouteStats] = defaultdict(RouteStats)
+
+    def snapshot(self) -> dict[str, dict]:
+        return {route: stats.summary() for route, stats in self.routes.items()}
+
+    def log(self) -> None:
+        for route, summary in sorted(self.snapshot().items()):
+            logging.info(f"HTTP cache {route}: {summary}")
+
+
+stats = CacheStats()
+
+
+class MemoryTier(BaseCache):
+    """LRU of deserialized responses in front of another cache.
+    Writes go through to the other cache, large bodies are not kept in memory."""
+
+    def __init__(
+        self,
+        store: BaseCache,
+        max_size: int = HTTP_CACHE_MEMORY_SIZE,
+        max_body_size: int = HTTP_CACHE_MEMORY_MAX_BODY_SIZE,
+    ) -> None:
+        super().__init__()
+        self.store = store
+        self.max_size = max_size
+        self.max_body_size = max_body_size
+        self.memory: OrderedDict[str, ResponseOrKey] = OrderedDict()
+        self.last_read_from_memory = False
+
+    def _remember(self, key: str, item: ResponseOrKey) -> None:
+        body = getattr(item, "_body", None)
+        if body is not None and len(body) > self.max_body_size:
+            self.memory.pop(key, None)
+            return
+        self.memory[key] = item
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    async def read(self, key: str) -> ResponseOrKey:
+        item = self.memory.get(key)
+        self.last_read_from_memory = item is not None
+        if item is not None:
+            self.memory.move_to_end(key)
+            # The same object on every hit: its content can be read again
+            if isinstance(item, CachedResponse):
+                item.reset()
+            return item
+        item = await self.store.read(key)
+        if item is not None:
+            self._remember(key, item)
+        return item
+
+    async def write(self, key: str, item: ResponseOrKey) -> None:
+        await self.store.write(key, item)
+        self._remember(key, item)
+
+    async def delete(self, key: str) -> None:
+        self.memory.pop(key, None)
+        await self.store.delete(key)
+
+    async def bulk_delete(self, keys: set) -> None:
+        for key in keys:
+            self.memory.pop(key, None)
+        await self.store.bulk_delete(keys)
+
+    async def clear(self) -> None:
+        self.memory.clear()
+        await self.store.clear()
+
+    async def close(self) -> None:
+        await self.store.close()
+
+    async def contains(self, key: str) -> bool:
+        return key in self.memory or await self.store.contains(key)
+
+    async def keys(self) -> AsyncIterable[str]:
+        async for key in self.store.keys():
+            yield key
+
+    async def size(self) -> int:
+        return await self.store.size()
+
+    async def values(self) -> AsyncIterable[ResponseOrKey]:
+        async for value in self.store.values():
+            yield value
+
+
+class RoutedSQLiteBackend(SQLiteBackend):
+    """SQLite cache backend with per-route policies, a memory tier and stats.
+    An expire_after given to a request still overrides the one of its route."""
+
+    def __init__(self, cache_name: str = "cache", **kwargs) -> None:
+        super().__init__(cache_name, filter_fn=self.is_cacheable_media, **kwargs)
+        self.responses = MemoryTier(self.responses)
+        self._pending_routes: dict[str, CacheRoute] = {}  # Cache key: route
+
+    def create_cache_actions(
+        self, key: str, url, expire_after=None, refresh: bool = False, **kwargs
+    ) -> CacheActions:
+        route = get_route(url, kwargs.get("params"))
+        if expire_after is None:
+            expire_after = route.expire_after
+        self._pending_routes[key] = route
+        return super().create_cache_actions(
+            key, url, expire_after=expire_after, refresh=refresh, **kwargs
+        )
+
+    async def request(self, actions: CacheActions) -> Optional[CachedResponse]:
+        route = self._pending_routes.pop(actions.key, default_route)
+        route_stats = stats.routes[route.name]
+        if actions.skip_read:
+            route_stats.bypasses += 1
+            return None
+
+        response = await super().request(actions)
+        if response is None:
+            route_stats.misses += 1
+        else:
+            route_stats.hits += 1
+            route_stats.memory_hits += self.responses.last_read_from_memory
+        return response
+
+    def is_cacheable_media(
+        self, response: Union[ClientResponse, CachedResponse]
+    ) -> bool:
+        content_type = response.headers.get("Content-Type", "").lower()
+        if any(content_type.startswith(mime) for mime in HTTP_CACHE_BYPASS_MIME_TYPES):
+            stats.routes[get_route(response.url).name].rejected += 1
+            return False
+        return True
+
+    async def is_cacheable(
+        self, response, actions: Optional[CacheActions] = None
+    ) -> bool:
+        if actions and actions.skip_write:
+            return False
+        if not await super().is_cacheable(response, actions):
+            return False
+        if not isinstance(response, ClientResponse):
+            return True  # Already cached
+
+        # Check the announced size before reading the body
+        route = get_route(response.url)
+        content_length = response.content_length
+        if route.max_body_size is not None and content_length is not None:
+            if content_length > route.max_body_size:
+                stats.routes[route.name].rejected += 1
+                return False
+        return True
+
+    async def save_response(
+        self, response: ClientResponse, cache_key=None, expires=None
+    ) -> None:
+        route = get_route(response.url)
+        if route.max_body_size is not None and response.content_length is None:
+            # Chunked response: the size is only known once read
+            body = await response.read()
+            if len(body) > route.max_body_size:
+                stats.routes[route.name].rejected += 1
+                return
+        await super().save_response(response, cache_key, expires)
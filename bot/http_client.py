@@ -1,7 +1,179 @@
+"""Shared HTTP clients.
+Every module should go through these instead of creating its own session,
+so that connection pools, DNS lookups and metrics are shared.
+
+- `session`: aiohttp session with a response cache (see bot.http_cache),
+for cacheable GET requests.
+- `async_client`: httpx client (HTTP/2) for API calls and streams.
+- `sync_client`: httpx client (HTTP/2) for blocking reads in worker threads.
+- `create_async_client()`: httpx client with its own cookies, for a logged in
+service (e.g. Deezer), so they are not sent with the other requests.
+"""
+
+from collections import defaultdict, deque
+import logging
+from time import perf_counter
+from types import SimpleNamespace
 from typing import Optional
-from aiohttp_client_cache import CachedSession, SQLiteBackend
-from config import CACHE_EXPIRY
+from weakref import WeakSet
+
+import aiohttp
+import httpx
+from aiohttp_client_cache import CachedSession
+
+from bot.http_cache import RoutedSQLiteBackend
+from config import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_TIMEOUT,
+)
+
+
+class HostMetrics:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.latencies: deque[float] = deque(maxlen=200)  # Most recent ones
+
+    def record(self, latency: float, error: bool) -> None:
+        self.requests += 1
+        self.errors += error
+        self.total_latency += latency
+        self.latencies.append(latency)
+
+    def summary(self) -> dict:
+        recent = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_ms": round(self.total_latency / self.requests * 1000, 1)
+            if self.requests
+            else 0,
+            "p95_ms": (
+                round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 1)
+                if recent
+                else 0
+            ),
+        }
+
+
+class HttpMetrics:
+    """Per-host latency (time to response headers) and error counts."""
+
+    def __init__(self) -> None:
+        self.hosts: defaultdict[str, HostMetrics] = defaultdict(HostMetrics)
+
+    def record(self, host: Optional[str], latency: float, error: bool = False) -> None:
+        self.hosts[host or "?"].record(latency, error)
+
+    def snapshot(self) -> dict[str, dict]:
+        return {host: metrics.summary() for host, metrics in self.hosts.items()}
+
+    def log(self) -> None:
+        for host, summary in sorted(self.snapshot().items()):
+            logging.info(f"HTTP {host}: {summary}")
+
+
+metrics = HttpMetrics()
+
+
+class _MetricsTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        start = perf_counter()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            metrics.record(request.url.host, perf_counter() - start, error=True)
+            raise
+        metrics.record(
+            request.url.host, perf_counter() - start, response.status_code >= 500
+        )
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _AsyncMetricsTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            metrics.record(request.url.host, perf_counter() - start, error=True)
+            raise
+        metrics.record(
+            request.url.host, perf_counter() - start, response.status_code >= 500
+        )
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _create_trace_config() -> aiohttp.TraceConfig:
+    async def on_request_start(session, context: SimpleNamespace, params) -> None:
+        context.start = perf_counter()
+
+    async def on_request_end(session, context: SimpleNamespace, params) -> None:
+        metrics.record(
+            params.url.host,
+            perf_counter() - context.start,
+            params.response.status >= 500,
+        )
+
+    async def on_request_exception(session, context: SimpleNamespace, params) -> None:
+        metrics.record(params.url.host, perf_counter() - context.start, error=True)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+# With HTTP/2, requests to the same host are multiplexed on a single connection
+limits = httpx.Limits(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+)
+timeout = httpx.Timeout(HTTP_TIMEOUT)
+# Clients still open, closed with the session
+async_clients: "WeakSet[httpx.AsyncClient]" = WeakSet()
+
+
+def create_async_client(**kwargs) -> httpx.AsyncClient:
+    client = httpx.AsyncClient(
+        transport=_AsyncMetricsTransport(
+            httpx.AsyncHTTPTransport(http2=True, limits=limits)
+        ),
+        timeout=timeout,
+        **kwargs,
+    )
+    async_clients.add(client)
+    return client
+
+
+async def close_async_client(client: httpx.AsyncClient) -> None:
+    async_clients.discard(client)
+    await client.aclose()
+
 
+async_client = create_async_client()
+sync_client = httpx.Client(
+    transport=_MetricsTransport(httpx.HTTPTransport(http2=True, limits=limits)),
+    timeout=timeout,
+)
 session: Optional[CachedSession] = None
 
 
@@ -10,7 +182,14 @@ async def init_http_session() -> None:
     if session is None:
         session = CachedSession(
             follow_redirects=True,
-            cache=SQLiteBackend("cache", expire_after=CACHE_EXPIRY),
+            cache=RoutedSQLiteBackend("cache"),
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_MAX_CONNECTIONS,
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            trace_configs=[_create_trace_config()],
         )
 
 
@@ -19,3 +198,6 @@ async def close_http_session() -> None:
     if session is not None:
         await session.close()
         session = None
+    for client in list(async_clients):
+        await close_async_client(client)
+    sync_client.close()
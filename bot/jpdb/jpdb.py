@@ -6,6 +6,8 @@ import time
 from config import DEFAULT_EMBED_COLOR
 
 from bot.jpdb.word_api import word_api
+from bot import http_client
+from bot.sharding import ShardedDict, get_shard_id, shard_metrics
 from bot.utils import split_into_chunks
 
 
@@ -123,16 +125,25 @@ class Jpdb:
     ) -> None:
         self.user_id = user_id
         self.api_key = api_key
-        self.session = httpx.AsyncClient(follow_redirects=True)
-        self.session.headers.update({"Authorization": f"Bearer {self.api_key}"})
+        self.headers = {"Authorization": f"Bearer {self.api_key}"}
         self.base_url = "https://jpdb.io/api/v1/"
         self.vocab = []
         self.review_cards = []
         self.ctx = ctx
         self.init_message = init_message
 
+    async def request(self, method: str, endpoint: str, **kwargs) -> httpx.Response:
+        """Send a request to the jpdb API with the user's API key."""
+        return await http_client.async_client.request(
+            method,
+            f"{self.base_url}{endpoint}",
+            headers=self.headers,
+            follow_redirects=True,
+            **kwargs,
+        )
+
     async def check_api_key(self) -> None:
-        ping = await self.session.get(f"{self.base_url}ping")
+        ping = await self.request("GET", "ping")
         if ping.status_code == 403:
             raise ValueError("Invalid JPDB API key")
 
@@ -152,15 +163,15 @@ class Jpdb:
         """
         # Get the first deck id if not given
         if not deck_id:
-            special_decks_response = await self.session.post(
-                f"{self.base_url}list-user-decks", json={"fields": ["id"]}
+            special_decks_response = await self.request(
+                "POST", "list-user-decks", json={"fields": ["id"]}
             )
             special_decks_response.raise_for_status()
             deck_id = special_decks_response.json()["decks"][0][0]
 
         # First request to '/deck/list-vocabulary'
-        list_vocab_response = await self.session.post(
-            f"{self.base_url}deck/list-vocabulary", json={"id": deck_id}
+        list_vocab_response = await self.request(
+            "POST", "deck/list-vocabulary", json={"id": deck_id}
         )
         list_vocab_response.raise_for_status()
         list_vocab_data = list_vocab_response.json()
@@ -181,8 +192,8 @@ class Jpdb:
             ],
         }
 
-        lookup_response = await self.session.post(
-            f"{self.base_url}lookup-vocabulary", json=lookup_payload
+        lookup_response = await self.request(
+            "POST", "lookup-vocabulary", json=lookup_payload
         )
         lookup_response.raise_for_status()
         lookup_data = lookup_response.json()
@@ -252,14 +263,14 @@ class Jpdb:
 
     async def grade_card(self, vid: int, sid: int, grade: str) -> None:
         """Allowed values: nothing, something, hard, okay, easy (or pass/fail)."""
-        review_response = await self.session.post(
-            f"{self.base_url}review", json={"vid": vid, "sid": sid, "grade": grade}
+        review_response = await self.request(
+            "POST", "review", json={"vid": vid, "sid": sid, "grade": grade}
         )
         review_response.raise_for_status()
 
         # Lookup the card again to get the due date
-        lookup_response = await self.session.post(
-            f"{self.base_url}lookup-vocabulary",
+        lookup_response = await self.request(
+            "POST", "lookup-vocabulary",
             json={
                 "list": [[vid, sid]],
                 "fields": ["due_at"],
@@ -368,7 +379,13 @@ class Jpdb:
 
 class JpdbSessions:
     def __init__(self) -> None:
-        self.jpdb_sessions = {}
+        # User ID: session, in the shard of the server where it was created
+        self.jpdb_sessions: ShardedDict = ShardedDict(
+            lambda user_id, session: get_shard_id(
+                session.ctx.guild_id if session.ctx else None
+            )
+        )
+        shard_metrics.track("jpdb sessions", self.jpdb_sessions)
 
     async def get_session(
         self,
@@ -4,12 +4,15 @@ import re
 import logging
 from typing import Optional
 
-from google.genai import types
-
-from bot.chatbot.gemini_client import client, utils_models_manager
 from config import GEMINI_ENABLED, GEMINI_SAFETY_SETTINGS
 from bot import http_client
 
+if GEMINI_ENABLED:
+    from google.genai import types
+    from bot.chatbot.gemini_client import client, llm_scheduler
+    from bot.chatbot.llm_scheduler import Priority, estimate_tokens
+    from bot.chatbot.prompt_cache import PromptKey, prompt_cache
+
 response_schema = {
     "type": "object",
     "properties": {"jp": {"type": "string"}, "en": {"type": "string"}},
@@ -193,20 +196,31 @@ class JpdbWordApi:
         return types
 
     async def generate_example_sentence(
-        self, word: str, meaning: Optional[list] = [""]
+        self, word: str, meaning: Optional[list] = [""], use_cache: bool = True
     ) -> dict:
-        """Generate a sentence example with Gemini."""
+        """Generate a sentence example with Gemini, or reuse a cached one."""
         sentences = {"jp": "", "en": ""}
         if GEMINI_ENABLED:
-            try:
-                request: types.GenerateContentResponse = await client.aio.models.generate_content(
-                    model=utils_models_manager.pick(),
-                    contents="Send a simple Japanese sentence **in jp** and the "
-                    "English translation **in en**"
-                    f"that includes the word {word} ({meaning[0]})."
-                    "Don't send anything else. "
-                    "Never put romajis, only kana and kanji."
-                    "Put the whole word in bold in the correct language.",
+            key = PromptKey("jpdb_example", f"{word} ({meaning[0]})", "en")
+            cache_model = ",".join(llm_scheduler.models)
+            if use_cache:
+                cached = await prompt_cache.get(key, cache_model)
+                if cached is not None:
+                    return json.loads(cached)
+
+            prompt = (
+                "Send a simple Japanese sentence **in jp** and the "
+                "English translation **in en**"
+                f"that includes the word {word} ({meaning[0]})."
+                "Don't send anything else. "
+                "Never put romajis, only kana and kanji."
+                "Put the whole word in bold in the correct language."
+            )
+
+            async def generate(model: str) -> types.GenerateContentResponse:
+                return await client.aio.models.generate_content(
+                    model=model,
+                    contents=prompt,
                     config=types.GenerateContentConfig(
                         response_mime_type="application/json",
                         response_schema=response_schema,
@@ -218,9 +232,20 @@ class JpdbWordApi:
                         safety_settings=GEMINI_SAFETY_SETTINGS,
                     ),
                 )
-                sentences = json.loads(request.candidates[0].content.parts[0].text)
+
+            try:
+                # As interactive as a translation
+                request = await llm_scheduler.run(
+                    generate, Priority.TRANSLATION, tokens=estimate_tokens(prompt)
+                )
+                text = request.candidates[0].content.parts[0].text
+                sentences = json.loads(text)
             except Exception as e:
                 logging.error(repr(e))
+                return sentences
+            if use_cache:
+                tokens = request.usage_metadata.total_token_count or 0
+                await prompt_cache.put(key, cache_model, text, tokens)
         return sentences
 
 
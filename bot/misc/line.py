@@ -1,6 +1,5 @@
 import aiofiles
 from pathlib import Path
-from PIL import Image
 import asyncio
 import shutil
 import logging
@@ -8,7 +7,6 @@ import os
 
 from discord import ApplicationContext
 from bs4 import BeautifulSoup
-import imageio.v3
 
 from bot.search import url_grabber, is_url
 from bot.utils import sanitize_filename
@@ -21,6 +19,10 @@ def get_url(string: str) -> str:
 
 
 async def convert_to_gif(sticker_count: int, path: Path, loop: int = 0) -> None:
+    # Heavy (numpy), only imported for stickers
+    import imageio.v3
+    from PIL import Image
+
     for i in range(sticker_count):
         png_file = path / f"{i + 1}.png"
         gif_file = path / f"{i + 1}.gif"
@@ -1,5 +1,3 @@
-import requests
-import asyncio
 import urllib.parse
 import logging
 from typing import Optional
@@ -8,9 +6,12 @@ from dotenv import load_dotenv
 
 from config import GEMINI_ENABLED
 from bot.vocal.track_dataclass import Track
+from bot import http_client
 
 if GEMINI_ENABLED:
     from bot.chatbot.gemini import Gembot
+    from bot.chatbot.llm_scheduler import Priority
+    from bot.chatbot.prompt_cache import PromptKey
 
 logger = logging.getLogger(__name__)
 load_dotenv()
@@ -41,7 +42,7 @@ class BotLyrics:
             [f"{key}={urllib.parse.quote(str(value))}" for key, value in params.items()]
         )
 
-        response = await asyncio.to_thread(requests.get, final_url)
+        response = await http_client.async_client.get(final_url, follow_redirects=True)
         response.raise_for_status()
         json = response.json()
         path = [
@@ -65,7 +66,7 @@ class BotLyrics:
         return element
 
     @staticmethod
-    async def convert(lyrics: str, to: str) -> str:
+    async def convert(lyrics: str, to: str, use_cache: bool = True) -> str:
         """Convert lyrics to kana or romaji using Gemini."""
         prompt = f"""
             Convert these lyrics to {to}.
@@ -73,5 +74,7 @@ class BotLyrics:
         """
         response = await Gembot.simple_prompt(
             query=prompt + lyrics,
+            priority=Priority.LYRICS,
+            cache_key=PromptKey("lyrics", lyrics, to) if use_cache else None,
         )
         return response
@@ -0,0 +1,73 @@
+from collections import Counter
+import logging
+from time import time
+from typing import Any, Callable, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import discord
+
+shard_count = 1  # Total number of shards, set when the bot is connected
+
+
+def set_shard_count(count: Optional[int]) -> None:
+    global shard_count
+    shard_count = count or 1
+
+
+def get_shard_id(guild_id: Optional[int]) -> int:
+    """Shard receiving the events of a server (DMs are received by shard 0)."""
+    if not guild_id:
+        return 0
+    return (guild_id >> 22) % shard_count
+
+
+class ShardedDict(dict):
+    """Dict of per server objects, that can be split by Discord shard.
+    Keyed by server ID unless another `shard_of(key, value)` is given."""
+
+    def __init__(
+        self,
+        shard_of: Callable[[Any, Any], int] = lambda key, value: get_shard_id(key),
+    ) -> None:
+        super().__init__()
+        self.shard_of = shard_of
+
+    def shard(self, shard_id: int) -> dict:
+        """Return the entries of a shard."""
+        return {k: v for k, v in self.items() if self.shard_of(k, v) == shard_id}
+
+    def count_by_shard(self) -> Counter:
+        return Counter(self.shard_of(k, v) for k, v in self.items())
+
+
+class ShardMetrics:
+    """Gateway events received by each shard, logged with the shard latencies
+    and the number of sessions per shard."""
+
+    def __init__(self) -> None:
+        self.events: Counter = Counter()  # Shard ID: events since the last log
+        self.since = time()
+        # Name: sharded dict of sessions
+        self.sessions: dict[str, ShardedDict] = {}
+
+    def record_event(self, guild_id: Optional[int]) -> None:
+        self.events[get_shard_id(guild_id)] += 1
+
+    def track(self, name: str, sessions: ShardedDict) -> None:
+        self.sessions[name] = sessions
+
+    def log(self, bot: "discord.AutoShardedBot") -> None:
+        elapsed = max(time() - self.since, 1)
+        counts = {name: d.count_by_shard() for name, d in self.sessions.items()}
+        for shard_id, latency in bot.latencies:
+            sessions = ", ".join(f"{counts[name][shard_id]} {name}" for name in counts)
+            logging.info(
+                f"Shard {shard_id}: {latency * 1000:.0f}ms latency, "
+                f"{self.events[shard_id] / elapsed:.2f} events/s"
+                f"{f', {sessions}' if sessions else ''}"
+            )
+        self.events.clear()
+        self.since = time()
+
+
+shard_metrics = ShardMetrics()
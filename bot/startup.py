@@ -0,0 +1,115 @@
+import csv
+import logging
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional
+
+
+def get_rss() -> Optional[float]:
+    """Resident memory of the process (in MB), None if unknown (Windows)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        return None
+    # Peak memory instead, in kB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+class StartupProfile:
+    """Time spent importing the modules, loading each command extension,
+    and connecting to Discord. Imported first by main.py.
+    For the import time of each module: `python -X importtime main.py`."""
+
+    def __init__(self) -> None:
+        self.start = perf_counter()
+        self.last_mark = self.start
+        self.phases: dict[str, float] = {}  # Name: duration (in seconds)
+        self.extensions: dict[str, float] = {}  # Extension: load time
+        self.recorded = False
+
+    def mark(self, phase: str) -> None:
+        """End a startup phase started at the previous mark."""
+        now = perf_counter()
+        self.phases[phase] = now - self.last_mark
+        self.last_mark = now
+
+    @contextmanager
+    def measure_extension(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.extensions[name] = perf_counter() - start
+
+    def log_extensions(self, slowest: int = 5) -> None:
+        total = sum(self.extensions.values())
+        logging.info(f"Loaded {len(self.extensions)} extensions in {total:.2f}s")
+        ranked = sorted(self.extensions.items(), key=lambda e: e[1], reverse=True)
+        for name, duration in ranked[:slowest]:
+            logging.info(f"Slowest extension: {name} ({duration:.2f}s)")
+
+    def record(self, path: Optional[Path], shards: str = "") -> None:
+        """Log the time to ready and the memory of the idle bot,
+        and append them to the startup benchmark file.
+        Only the first time, on_ready is called again after reconnecting."""
+        if self.recorded:
+            return
+        self.recorded = True
+        self.mark("ready")
+        total = perf_counter() - self.start
+        rss = get_rss()
+        phases = ", ".join(f"{name}: {d:.2f}s" for name, d in self.phases.items())
+        memory = f", {rss:.0f}MB RSS" if rss is not None else ""
+        logging.info(f"Ready in {total:.2f}s ({phases}){memory}")
+
+        if not path:
+            return
+        new_file = not path.is_file()
+        try:
+            with open(path, "a", newline="") as benchmark:
+                writer = csv.writer(benchmark)
+                if new_file:
+                    writer.writerow(
+                        ["date", "commit", "shards", *self.phases, "total", "rss_mb"]
+                    )
+                writer.writerow(
+                    [
+                        datetime.now().isoformat(timespec="seconds"),
+                        get_commit(),
+                        shards,
+                        *(f"{d:.3f}" for d in self.phases.values()),
+                        f"{total:.3f}",
+                        f"{rss:.1f}" if rss is not None else "",
+                    ]
+                )
+        except OSError as e:
+            logging.error(f"Failed to write the startup benchmark: {repr(e)}")
+
+
+startup_profile = StartupProfile()
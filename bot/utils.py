@@ -6,30 +6,25 @@ import hashlib
 import logging
 import os
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
 from io import BytesIO
 from pathlib import Path
 from time import time
 from urllib.parse import urlparse, unquote
-from bs4 import BeautifulSoup
-
-import mutagen
-from PIL import Image
-from mutagen.flac import FLAC
-from mutagen.flac import Picture
-from mutagen.id3 import ID3, APIC
-from mutagen.m4a import M4A
-from mutagen.mp3 import MP3
-from mutagen.mp4 import MP4
-from mutagen.oggopus import OggOpus
-from mutagen.oggvorbis import OggVorbis
-from mutagen.wave import WAVE
-
-from config import TEMP_FOLDER, CACHE_EXPIRY, CACHE_SIZE, PREMIUM_CHANNEL_ID
+
+from config import (
+    TEMP_FOLDER,
+    CACHE_EXPIRY,
+    CACHE_SIZE,
+    CLUSTER_COUNT,
+    PREMIUM_CHANNEL_ID,
+)
 from bot.search import url_grabber, is_url
 from bot import http_client
 
+# bs4, mutagen and PIL are imported when needed, to start faster
 if TYPE_CHECKING:
+    import mutagen
     from bot.vocal.spotify import Spotify
     from bot.vocal.server_session import ServerSession
 
@@ -123,6 +118,8 @@ def get_accent_color(image_bytes: bytes, threshold: int = 50) -> Tuple[int, int,
     Returns:
         Tuple[int, int, int]: The RGB values of the extracted accent color.
     """
+    from PIL import Image
+
     image = Image.open(BytesIO(image_bytes))
     image = image.convert("RGB")  # Ensure image RGB
 
@@ -160,13 +157,25 @@ def get_accent_color(image_bytes: bytes, threshold: int = 50) -> Tuple[int, int,
     return accent_color
 
 
+# Image URL: accent color, most recent last
+dominant_rgb_cache: OrderedDict[str, Tuple[int, int, int]] = OrderedDict()
+
+
 async def get_dominant_rgb_from_url(image_url: str) -> Tuple[int, int, int]:
-    """Fetch an image from a URL and extract its accent color."""
+    """Fetch an image from a URL and extract its accent color.
+    Colors are kept in memory, since tracks of a same album share their cover."""
+    if dominant_rgb := dominant_rgb_cache.get(image_url):
+        dominant_rgb_cache.move_to_end(image_url)
+        return dominant_rgb
+
     async with http_client.session.get(image_url) as response:
         response.raise_for_status()
         cover_bytes = await response.read()
-        dominant_rgb = get_accent_color(cover_bytes)
+    dominant_rgb = await asyncio.to_thread(get_accent_color, cover_bytes)
 
+    dominant_rgb_cache[image_url] = dominant_rgb
+    while len(dominant_rgb_cache) > 256:
+        dominant_rgb_cache.popitem(last=False)
     return dominant_rgb
 
 
@@ -192,16 +201,23 @@ async def cleanup_cache() -> None:
     Clean up the cache directory by removing old and excess files.
 
     This function removes files that exceed the cache size limit and deletes expired files.
+    With launcher.py, each process only cleans its own cache folder.
     """
+    from bot.vocal.audio_download import growing_files
+
+    cache_size = CACHE_SIZE // CLUSTER_COUNT if os.getenv("CLUSTER_ID") else CACHE_SIZE
+
+    # Files still being downloaded are kept
+    downloading = {path.resolve() for path in growing_files}
     files = sorted(
-        list(TEMP_FOLDER.glob("*.cache")) + list(TEMP_FOLDER.glob("*.json")),
+        (f for f in TEMP_FOLDER.glob("*.cache") if f.resolve() not in downloading),
         key=lambda f: f.stat().st_mtime,
     )
 
     remove_tasks = []
 
     # Remove files that exceed the cache size limit
-    while len(files) > CACHE_SIZE:
+    while len(files) > cache_size:
         oldest_file = files.pop(0)
         logging.info(f"Removed {oldest_file} from cache")
         remove_tasks.append(asyncio.to_thread(os.remove, oldest_file))
@@ -218,17 +234,31 @@ async def cleanup_cache() -> None:
         await asyncio.gather(*remove_tasks, return_exceptions=True)
 
 
-def extract_cover_art(file_path) -> Optional[bytes]:
+def extract_cover_art(
+    file_path, audio_file: Optional["mutagen.FileType"] = None
+) -> Optional[bytes]:
     """
     Extract cover art from an audio file.
 
     Args:
         file_path: The path to the audio file.
+        audio_file: The file already parsed by mutagen, if any.
 
     Returns:
         Optional[bytes]: The cover art image data, or None if no cover art is found.
     """
-    audio_file = mutagen.File(file_path)
+    import mutagen
+    from mutagen.flac import FLAC, Picture
+    from mutagen.id3 import ID3, APIC
+    from mutagen.m4a import M4A
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4
+    from mutagen.oggopus import OggOpus
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.wave import WAVE
+
+    if audio_file is None:
+        audio_file = mutagen.File(file_path)
 
     # For files using ID3 tags (mp3, sometimes WAV)
     if isinstance(audio_file, (MP3, ID3, WAVE)) and audio_file.tags:
@@ -263,17 +293,26 @@ def extract_cover_art(file_path) -> Optional[bytes]:
                 return img
 
 
-def get_metadata(file_path: Path) -> Dict[str, List[str]]:
+def get_metadata(
+    file_path: Path, audio_file: Optional["mutagen.FileType"] = None
+) -> Dict[str, List[str]]:
     """
     Extract metadata from an audio file.
 
     Args:
         file_path: The path to the audio file.
+        audio_file: The file already parsed by mutagen, if any.
 
     Returns:
         Dict[str, List[str]]: A dictionary containing the extracted metadata.
     """
-    audio_file = mutagen.File(file_path)
+    import mutagen
+    from mutagen.id3 import ID3
+    from mutagen.mp3 import MP3
+    from mutagen.wave import WAVE
+
+    if audio_file is None:
+        audio_file = mutagen.File(file_path)
 
     if not audio_file:
         return {}
@@ -309,6 +348,9 @@ async def tag_ogg_file(
         artist: Artist name.
         album_cover_url: URL of the album cover image (JPEG or PNG).
     """
+    from mutagen.flac import Picture
+    from mutagen.oggvorbis import OggVorbis
+
     audio = OggVorbis(file_path)
 
     # Set title and artist tags
@@ -682,6 +724,8 @@ async def process_song_query(
 
 
 async def tenor_view_url_to_direct_url(url: str) -> str:
+    from bs4 import BeautifulSoup
+
     try:
         async with http_client.session.get(url) as response:
             content = await response.read()
@@ -0,0 +1,191 @@
+import asyncio
+import io
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+from typing import Optional, Union
+
+import aiofiles
+
+from bot import http_client
+from bot.http_cache import DO_NOT_CACHE
+from bot.utils import get_cache_path
+from config import CUSTOM_AUDIO_MAX_SIZE, CUSTOM_AUDIO_BUFFER_SIZE
+
+
+class GrowingFile:
+    """Cache file being written, that can be read while it fills with `open_reader()`.
+    Registered in `growing_files` until it is complete."""
+
+    def __init__(self, buffer_size: int = CUSTOM_AUDIO_BUFFER_SIZE) -> None:
+        self.path: Optional[Path] = None
+        self.buffer_size = buffer_size
+        self.size = 0  # Bytes written
+        self.complete = False  # True when finished (or failed)
+        self.error: Optional[Exception] = None
+        self.buffered = asyncio.Event()  # Enough data to start playing
+        self.finished = asyncio.Event()
+        self._condition = threading.Condition()  # Wakes up the readers
+
+    def set_path(self, path: Path) -> None:
+        self.path = path
+        growing_files[path] = self
+
+    @property
+    def data_path(self) -> Path:
+        """File being written, opened by the readers."""
+        return self.path
+
+    def _notify(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait_for_data(self, timeout: float = 1) -> None:
+        """Block the calling thread until new data is written."""
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def written(self, size: int) -> None:
+        """Called (in the event loop) after each write."""
+        self.size += size
+        self._notify()
+        if self.size >= self.buffer_size and not self.buffered.is_set():
+            logging.info(f"Buffered {self.size} bytes of {self.path}")
+            self.buffered.set()
+
+    def set_complete(self, error: Optional[Exception] = None) -> None:
+        self.error = error
+        self.complete = True
+        if growing_files.get(self.path) is self:
+            del growing_files[self.path]
+        self.buffered.set()
+        self.finished.set()
+        self._notify()
+
+    def open_reader(self) -> "GrowingFileReader":
+        return GrowingFileReader(self)
+
+
+class AudioDownload(GrowingFile):
+    """Audio file downloaded from a URL to the cache folder.
+    Written to a .part file, moved to its cache path (a hash of the URL) once
+    complete: a file at the cache path is always complete."""
+
+    def __init__(self, url: str) -> None:
+        super().__init__()
+        self.url = url
+        path = get_cache_path(url)
+        self.part_path = path.with_suffix(".part")
+        self.moved = False  # True once the complete file is at its cache path
+        self.set_path(path)
+
+    @property
+    def data_path(self) -> Path:
+        return self.path if self.moved else self.part_path
+
+    async def run(self) -> None:
+        try:
+            await self._download()
+        except Exception as e:
+            # Don't keep a truncated file
+            await asyncio.to_thread(self.part_path.unlink, True)
+            self.set_complete(e)
+        else:
+            self.set_complete()
+        finally:
+            # Once finished, the cache file is checked by the next download
+            if downloads.get(self.url) is self:
+                del downloads[self.url]
+
+    async def _download(self) -> None:
+        # Already downloaded, even if the server doesn't give the size
+        if self.path.is_file():
+            self.size = self.path.stat().st_size
+            self.moved = True
+            return
+
+        async with http_client.session.get(
+            self.url, expire_after=DO_NOT_CACHE
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to fetch audio: {response.status}")
+
+            content_length = response.content_length
+            if content_length is not None and content_length > CUSTOM_AUDIO_MAX_SIZE:
+                raise Exception(f"Audio file too large: {content_length} bytes")
+
+            # Write the chunks to the part file as they arrive
+            async with aiofiles.open(self.part_path, "wb") as part_file:
+                async for chunk in response.content.iter_chunked(65536):
+                    if self.size + len(chunk) > CUSTOM_AUDIO_MAX_SIZE:
+                        raise Exception(f"Audio file too large: > {self.size} bytes")
+                    await part_file.write(chunk)
+                    await part_file.flush()
+                    self.written(len(chunk))
+
+        await asyncio.to_thread(self._move_part_file)
+        self.moved = True
+        logging.info(f"Downloaded {self.path} ({self.size} bytes)")
+
+    def _move_part_file(self) -> None:
+        try:
+            os.replace(self.part_path, self.path)
+        except PermissionError:
+            # Windows: can't be moved while a reader has it open
+            shutil.copyfile(self.part_path, self.path)
+            try:
+                self.part_path.unlink()
+            except OSError:
+                pass
+
+
+class GrowingFileReader(io.RawIOBase):
+    """File-like reader of a file being written, meant to be piped to FFmpeg.
+    Reads block until more data is written, or the file is complete."""
+
+    def __init__(self, growing_file: GrowingFile) -> None:
+        self.growing_file = growing_file
+        self._file = open(growing_file.data_path, "rb")
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.closed:
+            complete = self.growing_file.complete
+            data = self._file.read(size)
+            if data or complete:
+                return data
+            self.growing_file.wait_for_data()
+        return b""
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+# Shared between servers
+growing_files: dict[Path, GrowingFile] = {}
+downloads: dict[str, AudioDownload] = {}  # URL: running download
+
+
+async def download_audio(url: str) -> AudioDownload:
+    """Start downloading an audio file, or join the download of the same URL.
+    Return once enough data is buffered to start playing."""
+    download = downloads.get(url)
+    if download is None:
+        download = AudioDownload(url)
+        downloads[url] = download
+        asyncio.create_task(download.run())
+
+    await download.buffered.wait()
+    if download.error:
+        raise download.error
+    return download
+
+
+def get_download(path: Union[Path, str, None]) -> Optional[GrowingFile]:
+    """Return the unfinished download writing a file, if any."""
+    return growing_files.get(path) if isinstance(path, Path) else None
@@ -0,0 +1,96 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import logging
+import os
+from pathlib import Path
+import threading
+from time import perf_counter
+from typing import Optional
+
+from bot.utils import extract_cover_art, get_metadata
+from config import METADATA_WORKERS, METADATA_CACHE_SIZE
+
+
+@dataclass
+class AudioMetadata:
+    tags: dict[str, list[str]] = field(default_factory=dict)
+    cover: Optional[bytes] = None
+    duration: Optional[float] = None  # In seconds
+
+
+def get_file_hash(path: Path, sample_size: int = 65536) -> str:
+    """Quick fingerprint of a file: its size, first and last bytes."""
+    size = os.path.getsize(path)
+    md5 = hashlib.md5(str(size).encode())
+    with open(path, "rb") as file:
+        md5.update(file.read(sample_size))
+        if size > sample_size:
+            file.seek(max(sample_size, size - sample_size))
+            md5.update(file.read())
+    return md5.hexdigest()
+
+
+def parse_audio_file(path: Path) -> AudioMetadata:
+    """Parse an audio file once, for its tags, cover and duration."""
+    import mutagen
+
+    audio_file = mutagen.File(path)
+    if audio_file is None:
+        return AudioMetadata()
+
+    return AudioMetadata(
+        tags=get_metadata(path, audio_file),
+        cover=extract_cover_art(path, audio_file),
+        duration=getattr(audio_file.info, "length", None),
+    )
+
+
+class MetadataService:
+    """Parse audio files in a worker pool.
+    Results are memoised by file hash, so the same file is only parsed once."""
+
+    def __init__(
+        self, workers: int = METADATA_WORKERS, cache_size: int = METADATA_CACHE_SIZE
+    ) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="metadata"
+        )
+        self.cache_size = cache_size
+        # File hash: metadata
+        self.cache: OrderedDict[str, AudioMetadata] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _read(self, path: Path, memoise: bool) -> tuple[AudioMetadata, bool]:
+        file_hash = get_file_hash(path)
+        with self.lock:
+            if metadata := self.cache.get(file_hash):
+                self.cache.move_to_end(file_hash)
+                return metadata, True
+
+        metadata = parse_audio_file(path)
+        if memoise:
+            with self.lock:
+                self.cache[file_hash] = metadata
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return metadata, False
+
+    async def read(self, path: Path, memoise: bool = True) -> AudioMetadata:
+        """Return the tags, cover and duration of an audio file.
+        Set memoise to False for incomplete files."""
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        metadata, cached = await loop.run_in_executor(
+            self.executor, self._read, path, memoise
+        )
+        logging.info(
+            f"Read metadata of {path.name} in {(perf_counter() - start) * 1000:.1f}ms"
+            f"{' (cached)' if cached else ''}"
+        )
+        return metadata
+
+
+metadata_service = MetadataService()
@@ -6,9 +6,11 @@ from aiohttp.client_exceptions import ClientResponseError, InvalidUrlClientError
 import discord
 from spotipy.exceptions import SpotifyException
 
+from bot.vocal.audio_download import get_download
+from bot.vocal.audio_metadata import metadata_service
 from bot.vocal.custom import fetch_audio_stream, upload_cover
 from bot.vocal.server_session import ServerSession
-from bot.utils import get_metadata, extract_cover_art, extract_number, respond, edit
+from bot.utils import extract_number, respond, edit
 from bot.search import is_url
 from bot.vocal.session_manager import onsei
 from bot.vocal.track_dataclass import Track
@@ -109,33 +111,49 @@ async def play_custom(
         await respond(*response_params)
         return
 
+    # Tags, cover and duration, parsed in a worker thread
+    download = get_download(audio_path)
+    try:
+        metadata = await metadata_service.read(
+            download.data_path if download else audio_path, memoise=not download
+        )
+    except Exception:
+        # Tags not downloaded yet (e.g. MP4 with the index at the end)
+        if not download:
+            raise
+        await download.finished.wait()
+        metadata = await metadata_service.read(audio_path)
+
     # Convert to list to sync with ID3 tags
-    metadata = get_metadata(audio_path)
-    titles = list(metadata.get("title", "?"))
-    artists = list(metadata.get("artist", "?"))
-    albums = list(metadata.get("album", "?"))
+    titles = list(metadata.tags.get("title", "?"))
+    artists = list(metadata.tags.get("artist", "?"))
+    albums = list(metadata.tags.get("album", "?"))
 
     # Remove blank fields
     for field in titles, artists, albums:
         if not field[0].strip():
             field[0] = "?"
 
-    # Extract the cover art
-    cover_bytes = extract_cover_art(audio_path)
+    # Upload the cover art
+    cover_bytes = metadata.cover
     cover_url = None
+    cover_hash = 0
     dominant_rgb = DEFAULT_EMBED_COLOR
     if cover_bytes and (cover_dict := await upload_cover(cover_bytes)):
         cover_url = cover_dict.get("url")
+        cover_hash = cover_dict.get("cover_hash")
         dominant_rgb = cover_dict.get("dominant_rgb")
 
     track = Track(
         service="custom",
+        id=cover_hash,  # Key of the cover store
         title=titles[0] if titles[0] != "?" else audio_path.stem,
         album=albums[0],
         source_url=query,
         stream_source=audio_path,
         cover_url=cover_url or "",
         dominant_rgb=dominant_rgb,
+        duration=round(metadata.duration) if metadata.duration else "?",
     )
     track.set_artists(artists)
     track.create_embed()
@@ -0,0 +1,152 @@
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from time import time
+from typing import Iterable, Optional
+
+from config import COVER_DB_PATH, COVER_STORE_SIZE
+
+# Cover files of the older versions: {md5}.json in the temp folder
+legacy_cover_file = re.compile(r"[0-9a-f]{32}\.json")
+
+
+@dataclass
+class CoverEntry:
+    url: Optional[str]  # None if the cover couldn't be uploaded
+    dominant_rgb: tuple[int, int, int]
+
+
+class CoverStore:
+    """Cover arts of custom tracks, keyed by the MD5 hash of the image.
+    Kept in a single SQLite table, the least recently used covers
+    are evicted above `max_size` entries."""
+
+    def __init__(self, path: Path = COVER_DB_PATH, max_size: int = COVER_STORE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, in a worker thread
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Shared by the processes started by launcher.py
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA busy_timeout = 5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS covers ("
+                "cover_hash TEXT PRIMARY KEY, url TEXT, "
+                "red INTEGER, green INTEGER, blue INTEGER, "
+                "last_access REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS covers_last_access ON covers (last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _get_many(self, cover_hashes: list[str]) -> dict[str, CoverEntry]:
+        with self._lock:
+            conn = self._connect()
+            placeholders = ", ".join("?" * len(cover_hashes))
+            rows = conn.execute(
+                "SELECT cover_hash, url, red, green, blue FROM covers "
+                f"WHERE cover_hash IN ({placeholders})",
+                cover_hashes,
+            ).fetchall()
+            if rows:
+                now = time()
+                conn.executemany(
+                    "UPDATE covers SET last_access = ? WHERE cover_hash = ?",
+                    [(now, row[0]) for row in rows],
+                )
+                conn.commit()
+        return {
+            cover_hash: CoverEntry(url, (red, green, blue))
+            for cover_hash, url, red, green, blue in rows
+        }
+
+    def _put_many(self, entries: dict[str, CoverEntry]) -> None:
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO covers "
+                "(cover_hash, url, red, green, blue, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (cover_hash, entry.url, *entry.dominant_rgb, now)
+                    for cover_hash, entry in entries.items()
+                ],
+            )
+            # Evict the least recently used covers
+            conn.execute(
+                "DELETE FROM covers WHERE cover_hash IN ("
+                "SELECT cover_hash FROM covers ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            conn.commit()
+
+    async def get_many(self, cover_hashes: Iterable[str]) -> dict[str, CoverEntry]:
+        """Return the stored covers among the given hashes, in a single query."""
+        cover_hashes = list(dict.fromkeys(h for h in cover_hashes if h))
+        if not cover_hashes:
+            return {}
+        try:
+            return await asyncio.to_thread(self._get_many, cover_hashes)
+        except sqlite3.Error as e:
+            logging.error(f"SQLite error getting covers: {e}", exc_info=True)
+            return {}
+
+    async def get(self, cover_hash: str) -> Optional[CoverEntry]:
+        return (await self.get_many([cover_hash])).get(cover_hash)
+
+    async def put(self, cover_hash: str, entry: CoverEntry) -> None:
+        try:
+            await asyncio.to_thread(self._put_many, {cover_hash: entry})
+        except sqlite3.Error as e:
+            logging.error(
+                f"SQLite error storing cover {cover_hash}: {e}", exc_info=True
+            )
+
+    def _import_legacy_files(self, folder: Path) -> int:
+        entries = {}
+        files = [
+            file
+            for file in folder.glob("*.json")
+            if legacy_cover_file.fullmatch(file.name)
+        ]
+        for file in files:
+            try:
+                data = json.loads(file.read_text(encoding="utf-8"))
+                entries[file.stem] = CoverEntry(
+                    data.get("url"), tuple(data["dominant_rgb"])
+                )
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning(f"Skipped the legacy cover file {file}: {e}")
+        if entries:
+            self._put_many(entries)
+        for file in files:
+            file.unlink(missing_ok=True)
+        return len(entries)
+
+    async def import_legacy_files(self, folder: Path) -> None:
+        """Move the cover files of the older versions into the store.
+        Called once at startup."""
+        try:
+            count = await asyncio.to_thread(self._import_legacy_files, folder)
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"Failed to import the legacy cover files: {e}")
+            return
+        if count:
+            logging.info(f"Imported {count} legacy cover files in the cover store")
+
+
+cover_store = CoverStore()
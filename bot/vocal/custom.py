@@ -1,17 +1,16 @@
-import aiofiles
-import cgi
+import asyncio
 import discord
 from dotenv import load_dotenv
-import json
 import hashlib
 import logging
 import os
 from pathlib import Path
 from typing import Optional
-from urllib.parse import unquote
 
-from bot.utils import get_accent_color, get_display_name_from_query
-from config import TEMP_FOLDER, DEFAULT_EMBED_COLOR
+from bot.utils import get_accent_color
+from bot.vocal.audio_download import download_audio
+from bot.vocal.cover_store import CoverEntry, cover_store
+from config import DEFAULT_EMBED_COLOR
 from bot import http_client
 
 
@@ -25,94 +24,64 @@ async def upload_cover(cover_bytes: bytes) -> dict:
     # Step 1: Hash the cover bytes
     cover_hash = hashlib.md5(cover_bytes).hexdigest()
 
-    # Step 2: Check if the hash already exists in the cache
-    cache_file_path: Path = TEMP_FOLDER / f"{cover_hash}.json"
-    if cache_file_path.is_file():
-        # Step 3: If cached, read and return the stored dict
-        with open(cache_file_path, "r") as cache_file:
-            cached_data: dict = json.load(cache_file)
-            return {
-                "url": cached_data.get("url"),
-                "cover_hash": cover_hash,
-                "dominant_rgb": cached_data.get("dominant_rgb"),
-            }
-
-    # Step 4: If not cached, upload to Imgur (If IMGUR_CLIENT_ID id valid)
-    if not IMGUR_CLIENT_ID:
-        return {}
-
-    url = "https://api.imgur.com/3/upload"
-    headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
-
-    data = {
-        "image": cover_bytes,
-        "type": "file",  # Imgur expects the file type
-    }
-    async with http_client.session.post(url, headers=headers, data=data) as response:
-        if response.status != 200:
-            logging.error(f"Upload failed with status {response.status}")
-            return
-
-        json_response = await response.json()
-        image_url = json_response["data"]["link"]
-
-        # Step 5: Cache the uploaded image URL and
-        # the dominant RGB. Prevent additional future requests
-        dominant_rgb = get_accent_color(cover_bytes)
-        with open(cache_file_path, "w") as cache_file:
-            json.dump({"url": image_url, "dominant_rgb": dominant_rgb}, cache_file)
-
+    # Step 2: Check if the hash already exists in the cover store
+    entry = await cover_store.get(cover_hash)
+    if entry and (entry.url or not IMGUR_CLIENT_ID):
         return {
-            "url": image_url,
+            "url": entry.url,
             "cover_hash": cover_hash,
-            "dominant_rgb": dominant_rgb,
+            "dominant_rgb": entry.dominant_rgb,
         }
 
-
-async def get_cover_data_from_file(filename: str) -> dict[str, discord.Colour]:
-    """Retrieve cover art data for a given JSON file.
-    Returns a dict with the 'url' and 'dominant_rgb' of the latter."""
-    cache_file_path = Path(TEMP_FOLDER) / f"{filename}.json"
-
-    # Returns the default embed color
-    if not cache_file_path.exists():
-        return {
-            "url": "",
-            "dominant_rgb": discord.Colour.from_rgb(*DEFAULT_EMBED_COLOR),
+    # Step 3: If not stored, upload to Imgur (If IMGUR_CLIENT_ID id valid)
+    image_url = None
+    if IMGUR_CLIENT_ID:
+        url = "https://api.imgur.com/3/upload"
+        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
+        data = {
+            "image": cover_bytes,
+            "type": "file",  # Imgur expects the file type
         }
+        async with http_client.session.post(
+            url, headers=headers, data=data
+        ) as response:
+            if response.status == 200:
+                json_response = await response.json()
+                image_url = json_response["data"]["link"]
+            else:
+                # Still stored without URL, for the color (uploaded next time)
+                logging.error(f"Upload failed with status {response.status}")
+
+    # Step 4: Store the uploaded image URL and the dominant RGB.
+    # Prevent additional future requests
+    dominant_rgb = await asyncio.to_thread(get_accent_color, cover_bytes)
+    await cover_store.put(cover_hash, CoverEntry(image_url, dominant_rgb))
+
+    return {
+        "url": image_url,
+        "cover_hash": cover_hash,
+        "dominant_rgb": dominant_rgb,
+    }
 
-    with open(cache_file_path, "r") as cache_file:
-        cached_data: dict = json.load(cache_file)
-        cover_url = cached_data.get("url")
-        dominant_rgb = cached_data.get("dominant_rgb")
 
+async def get_cover_data(cover_hash: str) -> dict:
+    """Retrieve the cover art data of a cover.
+    Returns a dict with the 'cover_url' and 'dominant_rgb' of the latter."""
+    entry = await cover_store.get(cover_hash)
+    if entry is None:
         return {
-            "url": cover_url,
-            "dominant_rgb": discord.Colour.from_rgb(*dominant_rgb),
+            "cover_url": "",
+            "dominant_rgb": discord.Colour.from_rgb(*DEFAULT_EMBED_COLOR),
         }
+    return {
+        "cover_url": entry.url or "",
+        "dominant_rgb": discord.Colour.from_rgb(*entry.dominant_rgb),
+    }
 
 
 async def fetch_audio_stream(url: Optional[str] = None) -> Path:
-    """Fetch an audio file from a URL and cache it locally.
-    Returns the file path."""
-    async with http_client.session.get(url) as response:
-        if response.status != 200:
-            raise Exception(f"Failed to fetch audio: {response.status}")
-        audio_data = await response.read()
-        cd_header = response.headers.get("Content-Disposition", "")
-        content_length = response.headers.get("Content-Length", 0)
-        _, params = cgi.parse_header(cd_header)
-
-    # Get the file name from headers
-    if f := (params.get("filename*") or params.get("filename")):
-        filename = unquote(f).replace("UTF-8''", "")
-    else:
-        filename = get_display_name_from_query(url)
-
-    # Write the fetched audio to the cache file
-    cache_path = Path(f"{TEMP_FOLDER}/{filename}.{content_length}")
-    if not cache_path.is_file():
-        async with aiofiles.open(cache_path, "wb") as cache_file:
-            await cache_file.write(audio_data)
-
-    return cache_path
+    """Download an audio file from a URL to the cache folder.
+    Returns the file path as soon as enough data is buffered to start playing,
+    the rest is downloaded in the background."""
+    download = await download_audio(url)
+    return download.path
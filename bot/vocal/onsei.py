@@ -1,13 +1,21 @@
 import asyncio
+from collections import OrderedDict
 import json
 import os
-from typing import Literal, Union, Optional
+from time import time
+from typing import Any, Iterator, Literal, Union, Optional
 import logging
 from pathlib import Path
 from bot.vocal.track_dataclass import Track
 from bot import http_client
+from bot.single_flight import SingleFlight
 from bot.utils import get_dominant_rgb_from_url
-from config import ONSEI_BLACKLIST, ONSEI_WHITELIST, DEFAULT_EMBED_COLOR
+from config import (
+    ONSEI_BLACKLIST,
+    ONSEI_WHITELIST,
+    ONSEI_API_CACHE_SIZE,
+    ONSEI_API_CACHE_TTL,
+)
 
 
 class Onsei:
@@ -15,13 +23,33 @@ class Onsei:
     A class to interact with the Onsei API and process audio track information.
     """
 
+    def __init__(self) -> None:
+        # (api, work_id): (time, parsed JSON)
+        self.api_cache: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self.requests = SingleFlight("Onsei request")
+
     @staticmethod
     def get_cover(work_id: str) -> str:
         return f"https://api.asmr-200.com/api/cover/{str(int(work_id))}.jpg?type=main"
 
+    async def request(self, work_id: str, api: Literal["tracks", "workInfo"]) -> list:
+        """Make an asynchronous HTTP GET request to the Onsei API.
+        Responses are kept in memory per work ID."""
+        key = (api, str(work_id))
+        cached = self.api_cache.get(key)
+        if cached and time() - cached[0] < ONSEI_API_CACHE_TTL:
+            self.api_cache.move_to_end(key)
+            return cached[1]
+
+        content = await self.requests.run(key, lambda: self._request(work_id, api))
+        self.api_cache[key] = (time(), content)
+        self.api_cache.move_to_end(key)
+        while len(self.api_cache) > ONSEI_API_CACHE_SIZE * 2:  # Tracks and work info
+            self.api_cache.popitem(last=False)
+        return content
+
     @staticmethod
-    async def request(work_id: str, api: Literal["tracks", "workInfo"]) -> list:
-        """Make an asynchronous HTTP GET request to the Onsei API."""
+    async def _request(work_id: str, api: Literal["tracks", "workInfo"]) -> list:
         url = f"https://api.asmr.one/api/{api}/{work_id}"
         logging.info(f"Requesting URL: {url}")
 
@@ -36,120 +64,99 @@ class Onsei:
     async def get_work_api(self, work_id: str) -> dict:
         return await self.request(work_id, "workInfo")
 
-    def process_file(
-        self,
-        track_api: dict,
-        work_api: dict,
-        path: Path,
-        ignore_whitelist: bool = False,
-        track_number: int = 1,
-        dominant_rgb: tuple = DEFAULT_EMBED_COLOR,
-    ) -> dict[dict]:
-        # track_api
-        file_type = track_api.get("type")
-        duration = track_api.get("duration")
+    @staticmethod
+    def walk(tracks_api: Union[list, dict]) -> Iterator[tuple[dict, Path]]:
+        """Iterate over the files of the tracks tree, in order,
+        with the path of their folder."""
+        stack = [(tracks_api, Path("."))]
+        while stack:
+            node, path = stack.pop()
+            if isinstance(node, list):
+                stack.extend((element, path) for element in reversed(node))
+            elif isinstance(node, dict):
+                if node.get("type") == "folder":
+                    folder_name = node.get("title", "Unknown Folder")
+                    stack.append((node.get("children", []), path / folder_name))
+                else:
+                    yield node, path
+
+    @staticmethod
+    def classify(
+        track_api: dict, path: Path
+    ) -> Optional[Literal["whitelisted", "fallback"]]:
+        """Whitelisted files are played first.
+        If a work has none, all of its (non blacklisted) audio files are played."""
+        if track_api.get("type") != "audio":
+            return
+
         title = os.path.splitext(track_api.get("title", ""))[0]
-        media_stream_url = track_api.get("mediaStreamUrl")
+        if any(word.lower() in title.lower() for word in ONSEI_BLACKLIST):
+            return
+
         media_download_url = track_api.get("mediaDownloadUrl", "")
         extension = os.path.splitext(media_download_url)[1][1:].lower()
+        has_valid_path = any(
+            word.lower() in path.name.lower() for word in ONSEI_WHITELIST
+        )
+        if extension in ONSEI_WHITELIST and has_valid_path:
+            return "whitelisted"
+        return "fallback"
+
+    def create_track(self, track_api: dict, work_api: dict, track_number: int) -> Track:
+        media_stream_url = track_api.get("mediaStreamUrl")
+        id = work_api.get("id", 0)
+        track = Track(
+            service="onsei",
+            id=id,
+            cover_url=self.get_cover(id),
+            title=os.path.splitext(track_api.get("title", ""))[0],
+            album=work_api.get("title", "?"),
+            duration=track_api.get("duration"),
+            stream_source=media_stream_url,
+            source_url=media_stream_url,
+            track_number=track_number,
+            unloaded_embed=True,  # Created when needed
+        )
+        track.set_artists([i["name"] for i in work_api["vas"]])
+        return track
+
+    def get_tracks(self, tracks_api: Union[list, dict], work_api: dict) -> list[Track]:
+        """Retrieve the tracks of a work, walking its tree once."""
+        if "error" in tracks_api:
+            logging.error(tracks_api["error"])
+            return []
+
+        files = {"whitelisted": [], "fallback": []}
+        for track_api, path in self.walk(tracks_api):
+            if category := self.classify(track_api, path):
+                files[category].append(track_api)
 
-        def is_valid_file_type() -> bool:
-            if ignore_whitelist:
-                return file_type == "audio"
-            return file_type == "audio" and extension in ONSEI_WHITELIST
-
-        def has_valid_path() -> bool:
-            if ignore_whitelist:
-                return True
-            return any(word.lower() in path.name.lower() for word in ONSEI_WHITELIST)
-
-        def is_not_blacklisted() -> bool:
-            return not any(word.lower() in title.lower() for word in ONSEI_BLACKLIST)
-
-        if is_valid_file_type() and has_valid_path() and is_not_blacklisted():
-            id = work_api.get("id", 0)
-            track = Track(
-                service="onsei",
-                id=id,
-                cover_url=self.get_cover(id),
-                title=title,
-                album=work_api.get("title", "?"),
-                duration=duration,
-                stream_source=media_stream_url,
-                source_url=media_stream_url,
-                track_number=track_number,
-                dominant_rgb=dominant_rgb,
+        if not files["whitelisted"]:
+            logging.info("No tracks found with whitelist filters. Using all tracks.")
+
+        return [
+            self.create_track(track_api, work_api, track_number)
+            for track_number, track_api in enumerate(
+                files["whitelisted"] or files["fallback"], start=1
             )
-            track.set_artists([i["name"] for i in work_api["vas"]])
-            track.create_embed()
-            return track
-
-        return None
-
-    def get_tracks(
-        self,
-        track_api: Union[list, dict],
-        work_api: dict,
-        final_tracks: Optional[list] = None,
-        ignore_whitelist: bool = False,
-        dominant_rgb: tuple = DEFAULT_EMBED_COLOR,
-        path: Path = Path("."),
-    ) -> list:
-        """Recursively retrieve tracks from API data."""
-        if final_tracks is None:
-            final_tracks = []
-
-        params = (work_api, final_tracks, ignore_whitelist, dominant_rgb)
-
-        if "error" in track_api:
-            logging.error(track_api["error"])
-            return final_tracks
-
-        if isinstance(track_api, list):
-            for element in track_api:
-                self.get_tracks(element, *params, path)
-
-        elif isinstance(track_api, dict):
-            if track_api.get("type") == "folder":
-                folder_name = track_api.get("title", "Unknown Folder")
-                folder_path = path / folder_name
-                self.get_tracks(
-                    track_api.get("children", []),
-                    *params,
-                    folder_path,
-                )
-            else:
-                file_info = self.process_file(
-                    track_api,
-                    work_api,
-                    path,
-                    ignore_whitelist,
-                    len(final_tracks) + 1,
-                    dominant_rgb,
-                )
-                if file_info:
-                    final_tracks.append(file_info)
-
-        return final_tracks
+        ]
+
+    async def load_cover_color(self, work_id: str) -> None:
+        """Warm up the dominant RGB of the cover, used by the embeds."""
+        try:
+            await get_dominant_rgb_from_url(self.get_cover(work_id))
+        except Exception as e:
+            logging.error(f"Failed to load the cover of {work_id}: {repr(e)}")
 
     async def get_all_tracks(self, work_id: str, can_play_nsfw: bool = False) -> list:
-        tracks_api, work_api, dominant_rgb = await asyncio.gather(
+        tracks_api, work_api = await asyncio.gather(
             self.get_tracks_api(work_id),
             self.get_work_api(work_id),
-            get_dominant_rgb_from_url(self.get_cover(work_id)),
-            return_exceptions=False,
         )
         if work_api.get("nsfw") and not can_play_nsfw:
             return []
 
-        tracks = self.get_tracks(tracks_api, work_api, dominant_rgb=dominant_rgb)
-
-        if not tracks:
-            logging.info(
-                "No tracks found with whitelist filters. Retrying without whitelist."
-            )
-            tracks = self.get_tracks(
-                tracks_api, work_api, dominant_rgb=dominant_rgb, ignore_whitelist=True
-            )
+        # Playback doesn't wait for the cover
+        asyncio.create_task(self.load_cover_color(work_id))
 
-        return tracks
+        return self.get_tracks(tracks_api, work_api)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+from time import time
+from typing import Optional
+from weakref import WeakSet
+
+import aiofiles
+import aiohttp
+
+from bot import http_client
+from bot.http_cache import DO_NOT_CACHE
+from bot.utils import get_cache_path
+from bot.vocal.audio_download import GrowingFile, GrowingFileReader
+from config import ONSEI_CHUNK_SIZE, ONSEI_READ_AHEAD, ONSEI_IDLE_TIMEOUT
+
+
+class OnseiStream(GrowingFile):
+    """Onsei track fetched with HTTP range requests into the cache folder.
+    The download stays `ONSEI_READ_AHEAD` bytes ahead of the furthest reader.
+    Without open readers, it pauses after `ONSEI_IDLE_TIMEOUT` seconds and
+    resumes where it stopped the next time the track is played."""
+
+    def __init__(self, url: str) -> None:
+        super().__init__()
+        self.url = url
+        self.total_size: Optional[int] = None
+        self.readers: WeakSet[OnseiStreamReader] = WeakSet()
+        self.last_read = time()
+        self.set_path(get_cache_path(f"onsei{url}"))
+
+    @property
+    def valid_flag_path(self):
+        return self.path.with_suffix(".valid")
+
+    async def run(self) -> None:
+        try:
+            await self._download()
+        except Exception as e:
+            logging.error(f"Failed to stream {self.url}: {repr(e)}")
+            self.set_complete(e)
+        else:
+            self.set_complete()
+
+    def start(self) -> None:
+        if self.valid_flag_path.is_file() and self.path.is_file():
+            # Already in cache
+            self.size = self.total_size = self.path.stat().st_size
+            self.set_complete()
+            return
+        asyncio.create_task(self.run())
+
+    def set_complete(self, error: Optional[Exception] = None) -> None:
+        super().set_complete(error)
+        if onsei_streams.get(self.url) is self:
+            del onsei_streams[self.url]
+
+    async def _download(self) -> None:
+        # Resume a previous download
+        if self.valid_flag_path.is_file():
+            await asyncio.to_thread(self.valid_flag_path.unlink)
+        if self.path.is_file():
+            # Not buffered until the total size is known, for seeking
+            self.size = self.path.stat().st_size
+
+        while self.total_size is None or self.size < self.total_size:
+            # The first request gives the total size
+            if self.total_size is not None and not await self._wait_for_readers():
+                # No reader left: resumed by the next `get_onsei_stream()`
+                logging.info(f"Paused the stream of {self.url} at {self.size} bytes")
+                return
+            await self._fetch_chunk()
+
+        async with aiofiles.open(self.valid_flag_path, "w"):
+            pass
+        logging.info(f"Cached {self.url} ({self.size} bytes)")
+
+    async def _wait_for_readers(self) -> bool:
+        """Wait until a reader is close enough to the end of the written data.
+        Return False if no reader has been open for `ONSEI_IDLE_TIMEOUT` seconds.
+        A paused playback keeps its reader open, so the stream stays incomplete."""
+        while True:
+            readers = [reader for reader in self.readers if not reader.closed]
+            position = max((reader.position for reader in readers), default=0)
+            if self.size - position <= ONSEI_READ_AHEAD:
+                return True
+            if readers:
+                self.last_read = max(reader.last_read for reader in readers)
+            elif time() - self.last_read > ONSEI_IDLE_TIMEOUT:
+                return False
+            await asyncio.sleep(0.5)
+
+    async def _fetch_chunk(self, retries: int = 3) -> None:
+        """Request the next `ONSEI_CHUNK_SIZE` bytes, retrying on network errors."""
+        for attempt in range(retries):
+            try:
+                await self._request_range(self.size, self.size + ONSEI_CHUNK_SIZE - 1)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == retries - 1:
+                    raise
+                logging.error(
+                    f"Range request of {self.url} failed ({repr(e)}), retrying"
+                )
+                await asyncio.sleep(2**attempt)
+
+    async def _request_range(self, start: int, end: int) -> None:
+        async with http_client.session.get(
+            self.url,
+            headers={"Range": f"bytes={start}-{end}"},
+            expire_after=DO_NOT_CACHE,
+        ) as response:
+            if response.status == 416:
+                # Nothing left to read
+                self.total_size = self.size
+                return
+            response.raise_for_status()
+
+            if response.status == 206:
+                # Content-Range: bytes start-end/total
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                if total.isdigit():
+                    self.total_size = int(total)
+                mode = "ab"
+            else:
+                # Ranges not supported: the whole file is sent
+                self.total_size = response.content_length
+                self.size = 0
+                mode = "wb"
+
+            async with aiofiles.open(self.path, mode) as cache_file:
+                async for chunk in response.content.iter_chunked(65536):
+                    await cache_file.write(chunk)
+                    await cache_file.flush()
+                    self.written(len(chunk))
+
+            if self.total_size is None:
+                self.total_size = self.size
+
+    def open_reader(self) -> "OnseiStreamReader":
+        reader = OnseiStreamReader(self)
+        self.readers.add(reader)
+        self.last_read = time()
+        return reader
+
+    def is_mp3(self) -> bool:
+        with open(self.path, "rb") as file:
+            header = file.read(3)
+        # ID3 tag, or the sync word of an MPEG audio frame
+        return header[:3] == b"ID3" or (
+            len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0
+        )
+
+    def offset_of(self, position: float, duration: Optional[float]) -> Optional[int]:
+        """Approximate byte of a position (in seconds), assuming a constant
+        bitrate. None if the size of the track is not known yet."""
+        if not (self.total_size and duration):
+            return None
+        return int(self.total_size * min(position / duration, 1))
+
+    def is_downloaded(self, position: float, duration: Optional[float]) -> bool:
+        """Whether a position (in seconds) is likely in the written data."""
+        if self.complete:
+            return not self.error
+        offset = self.offset_of(position, duration)
+        return offset is not None and offset < self.size
+
+
+class OnseiStreamReader(GrowingFileReader):
+    """Reader of an Onsei stream, reporting its position to the download."""
+
+    growing_file: OnseiStream
+
+    def __init__(self, growing_file: OnseiStream) -> None:
+        super().__init__(growing_file)
+        self.position = 0  # Last byte read
+        self.last_read = time()
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if not self.closed:
+            self.position = self._file.tell()
+            self.last_read = time()
+        return data
+
+    def seek_to(self, position: float, duration: Optional[float]) -> bool:
+        """Jump to the byte of a position (in seconds) in an MP3 file, where
+        FFmpeg resyncs on the next audio frame. Return False for the other
+        formats, or if the position is not downloaded yet."""
+        stream = self.growing_file
+        offset = stream.offset_of(position, duration)
+        if offset is None or offset >= stream.size or not stream.is_mp3():
+            return False
+        self._file.seek(offset)
+        self.position = offset
+        self.last_read = time()
+        return True
+
+
+# URL: unfinished stream, shared between servers
+onsei_streams: dict[str, OnseiStream] = {}
+
+
+def get_onsei_stream(url: str) -> OnseiStream:
+    """Start streaming an Onsei track, or join its running stream."""
+    stream = onsei_streams.get(url)
+    if stream is None:
+        stream = OnseiStream(url)
+        onsei_streams[url] = stream
+        stream.start()
+    return stream
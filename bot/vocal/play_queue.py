@@ -0,0 +1,295 @@
+from collections import deque
+import heapq
+from itertools import islice
+import random
+from typing import Generic, Iterable, Iterator, Optional, TypeVar, Union
+
+from bot.vocal.queue_search import QueueSearchIndex
+
+T = TypeVar("T")
+
+
+class PlayQueue(Generic[T]):
+    """Ordered queue of tracks backed by a deque.
+
+    - Popping the current track and inserting after it are O(1).
+    - Membership is identity based (order keys of each track by `id()`),
+    so it doesn't rely on `Track.__eq__`. A track can be queued several times.
+    - Every entry keeps an order key next to its track, so the original order
+    can be restored after shuffling without keeping a copy of the queue.
+    - The search index is built on the first search, then updated incrementally.
+    Its matches are sorted by order key, without walking the queue.
+    - `render_cache` can be used to store rendered pages,
+    it is cleared on every mutation.
+    """
+
+    def __init__(self, tracks: Iterable[T] = ()) -> None:
+        self._entries: deque[tuple[float, T]] = deque()  # (order key, track)
+        self._keys: dict[int, list[float]] = {}  # id(track): keys of its entries
+        self._tracks: dict[int, T] = {}  # id(track): track
+        self._last_key: float = 0
+        self.shuffled: bool = False  # True if the play order differs from the keys
+        self.version: int = 0  # Incremented on every mutation
+        self.render_cache: dict = {}
+        self._search_index: Optional[QueueSearchIndex] = None
+        self.extend(tracks)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[T]:
+        return (track for _, track in self._entries)
+
+    def __contains__(self, track: T) -> bool:
+        return id(track) in self._keys
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[T, list[T]]:
+        if not isinstance(index, slice):
+            return self._entries[index][1]
+        start, stop, step = index.indices(len(self._entries))
+        if step == 1:
+            # No copy of the whole queue for the usual forward slices
+            entries = islice(self._entries, start, max(start, stop))
+            return [track for _, track in entries]
+        return list(self)[index]
+
+    def __repr__(self) -> str:
+        return f"PlayQueue({list(self)!r})"
+
+    def _touch(self) -> None:
+        self.version += 1
+        self.render_cache.clear()
+
+    def _added(self, key: float, track: T) -> None:
+        keys = self._keys.get(id(track))
+        if keys is None:
+            self._keys[id(track)] = [key]
+            self._tracks[id(track)] = track
+            if self._search_index is not None:
+                self._search_index.add(track)
+        else:
+            keys.append(key)
+        self._touch()
+
+    def _removed(self, key: float, track: T) -> None:
+        keys = self._keys[id(track)]
+        keys.remove(key)
+        if not keys:
+            del self._keys[id(track)]
+            del self._tracks[id(track)]
+            if self._search_index is not None:
+                self._search_index.remove(track)
+        self._touch()
+
+    def _new_key(self) -> float:
+        self._last_key += 1
+        return self._last_key
+
+    def _renumber(self) -> None:
+        """Reassign evenly spaced keys, following the current key order."""
+        positions = sorted(range(len(self._entries)), key=lambda i: self._entries[i][0])
+        ranks = {position: rank for rank, position in enumerate(positions, start=1)}
+        self._entries = deque(
+            (ranks[i], track) for i, (_, track) in enumerate(self._entries)
+        )
+        self._keys = {}
+        for key, track in self._entries:
+            self._keys.setdefault(id(track), []).append(key)
+        self._last_key = len(self._entries)
+
+    def append(self, track: T) -> None:
+        key = self._new_key()
+        self._entries.append((key, track))
+        self._added(key, track)
+
+    def appendleft(self, track: T) -> None:
+        """Put a track back in front of the queue (e.g. previous track),
+        right before the current one in the original order."""
+        if not self._entries:
+            self.append(track)
+            return
+        first_key = self._entries[0][0]
+        if not self.shuffled:
+            # The current track has the smallest key
+            key = first_key - 1
+        else:
+            lower = max(
+                (k for k, _ in self._entries if k < first_key), default=first_key - 1
+            )
+            key = (lower + first_key) / 2
+            if not lower < key < first_key:
+                # Float precision exhausted after many insertions
+                self._renumber()
+                return self.appendleft(track)
+        self._entries.appendleft((key, track))
+        self._added(key, track)
+
+    def extend(self, tracks: Iterable[T], shuffle: bool = False) -> None:
+        """Add tracks at the end of the queue.
+        If shuffle is True, each track is inserted at a random position
+        after the current one instead."""
+        for track in tracks:
+            entry = (self._new_key(), track)
+            if shuffle and len(self._entries) > 1:
+                self._entries.insert(random.randint(1, len(self._entries)), entry)
+                self.shuffled = True
+            else:
+                self._entries.append(entry)
+            self._added(*entry)
+
+    def insert_next(self, tracks: Iterable[T]) -> None:
+        """Insert tracks right after the current one, keeping their order."""
+        tracks = list(tracks)
+        if not self._entries:
+            self.extend(tracks)
+            return
+        if not tracks:
+            return
+
+        # Keys between the current track and the following one in the original order
+        current_key = self._entries[0][0]
+        if not self.shuffled:
+            upper = (
+                self._entries[1][0] if len(self._entries) > 1 else current_key + 1
+            )
+        else:
+            upper = min(
+                (key for key, _ in self._entries if key > current_key),
+                default=current_key + 1,
+            )
+        step = (upper - current_key) / (len(tracks) + 1)
+        keys = [current_key + step * i for i in range(1, len(tracks) + 1)]
+        in_bounds = current_key < keys[0] and keys[-1] < upper
+        if not in_bounds or len(set(keys)) != len(keys):
+            # Float precision exhausted after many insertions
+            self._renumber()
+            return self.insert_next(tracks)
+
+        current = self._entries.popleft()
+        self._entries.extendleft(reversed(list(zip(keys, tracks))))
+        self._entries.appendleft(current)
+        for key, track in zip(keys, tracks):
+            self._added(key, track)
+        self._last_key = max(self._last_key, keys[-1])
+
+    def popleft(self) -> T:
+        key, track = self._entries.popleft()
+        self._removed(key, track)
+        return track
+
+    def pop(self, index: int = -1) -> T:
+        key, track = self._entries[index]
+        del self._entries[index]
+        self._removed(key, track)
+        return track
+
+    def remove_range(self, start: int, stop: int) -> list[T]:
+        """Remove and return the tracks in [start, stop)."""
+        start, stop, _ = slice(start, stop).indices(len(self._entries))
+        if start >= stop:
+            return []
+
+        if stop == len(self._entries):
+            removed = [self._entries.pop() for _ in range(stop - start)]
+            removed.reverse()
+        else:
+            self._entries.rotate(-start)
+            removed = [self._entries.popleft() for _ in range(stop - start)]
+            self._entries.rotate(start)
+
+        for key, track in removed:
+            self._removed(key, track)
+        return [track for _, track in removed]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._keys.clear()
+        self._tracks.clear()
+        self._last_key = 0
+        self.shuffled = False
+        if self._search_index is not None:
+            self._search_index.clear()
+            self._search_index = None
+        self._touch()
+
+    def shuffle(self) -> None:
+        """Shuffle the tracks after the current one."""
+        self._touch()
+        if len(self._entries) <= 2:
+            self.shuffled = True
+            return
+        current = self._entries.popleft()
+        upcoming = list(self._entries)
+        random.shuffle(upcoming)
+        self._entries = deque(upcoming)
+        self._entries.appendleft(current)
+        self.shuffled = True
+
+    def unshuffle(self) -> None:
+        """Restore the original order of the tracks after the current one."""
+        if self.shuffled and len(self._entries) > 2:
+            current = self._entries.popleft()
+            self._entries = deque(sorted(self._entries, key=lambda entry: entry[0]))
+            self._entries.appendleft(current)
+        self.shuffled = False
+        self._touch()
+
+    def search(self, query: str, limit: int = 25) -> list[T]:
+        """Return the first tracks matching the query, in the original order
+        of the queue (the play order if not shuffled)."""
+        if self._search_index is None:
+            self._search_index = QueueSearchIndex(self._tracks.values())
+
+        ids = self._search_index.match(query)
+        if ids is None:
+            return self[:limit]
+        if not ids:
+            # Inside words, or languages without spaces
+            ids = self._search_index.match_substring(query)
+
+        # Each track once, at its first order key
+        first = heapq.nsmallest(limit, ((min(self._keys[i]), i) for i in ids))
+        return [self._tracks[i] for _, i in first]
+
+
+if __name__ == "__main__":
+    # Benchmark: queue then skip through 10k tracks,
+    # compared to the plain list implementation it replaces.
+    # Run with `python -m bot.vocal.play_queue`
+    from time import perf_counter
+
+    class _Track: ...
+
+    count = 10_000
+    tracks = [_Track() for _ in range(count)]
+
+    start = perf_counter()
+    queue, to_loop = [], []
+    queue[len(queue) : len(queue)] = tracks
+    while queue:
+        played = queue.pop(0)
+        played in to_loop + queue
+    list_time = perf_counter() - start
+
+    start = perf_counter()
+    queue, to_loop = PlayQueue(), PlayQueue()
+    queue.extend(tracks)
+    while queue:
+        played = queue.popleft()
+        played in to_loop or played in queue
+    play_queue_time = perf_counter() - start
+
+    # Each entry has its own order key: shuffle, go back to the previous
+    # tracks (new keys between the existing ones), then restore the order
+    start = perf_counter()
+    queue = PlayQueue(tracks)
+    queue.shuffle()
+    previous = [queue.popleft() for _ in range(100)]
+    for track in reversed(previous):
+        queue.appendleft(track)
+    queue.unshuffle()
+    shuffle_time = perf_counter() - start
+
+    print(f"list:      {list_time * 1000:.1f}ms for {count} tracks")
+    print(f"PlayQueue: {play_queue_time * 1000:.1f}ms for {count} tracks")
+    print(f"Shuffle, 100 previous tracks and unshuffle: {shuffle_time * 1000:.1f}ms")
@@ -0,0 +1,127 @@
+from collections import defaultdict
+import re
+from typing import Iterable, Optional
+from weakref import WeakSet, finalize
+
+MAX_PREFIX_LENGTH = 16
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased word tokens of a string."""
+    return token_pattern.findall(text.lower())
+
+
+# id(track): indexes containing the track
+indexes_of: dict[int, "WeakSet[QueueSearchIndex]"] = {}
+
+
+def reindex(track) -> None:
+    """Update the label of a track in the indexes containing it,
+    when its title or artist changes."""
+    indexes = indexes_of.get(id(track))
+    if indexes is None:
+        return
+    for index in list(indexes):
+        index.update(track)
+
+
+def forget_unused(keys: Iterable[int]) -> None:
+    """Remove the tracks that are no longer in any index."""
+    for key in list(keys):
+        indexes = indexes_of.get(key)
+        if indexes is not None and not any(True for _ in indexes):
+            del indexes_of[key]
+
+
+class QueueSearchIndex:
+    """Prefix index of the tokens of the tracks in a queue (title and artists).
+    Updated incrementally when tracks are added or removed, or renamed."""
+
+    def __init__(self, tracks: Iterable = ()) -> None:
+        self._prefixes: defaultdict[str, set[int]] = defaultdict(set)
+        self._labels: dict[int, str] = {}  # id(track): lower-cased display name
+        for track in tracks:
+            self.add(track)
+        # When the queue is dropped without being cleared
+        finalize(self, forget_unused, self._labels)
+
+    @staticmethod
+    def _prefixes_of(label: str) -> set[str]:
+        return {
+            token[:i]
+            for token in tokenize(label)
+            for i in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1)
+        }
+
+    def add(self, track) -> None:
+        key = id(track)
+        if key in self._labels:
+            return
+        label = str(track).lower()
+        self._labels[key] = label
+        for prefix in self._prefixes_of(label):
+            self._prefixes[prefix].add(key)
+        indexes_of.setdefault(key, WeakSet()).add(self)
+
+    def remove(self, track) -> None:
+        label = self._labels.pop(id(track), None)
+        if label is None:
+            return
+        for prefix in self._prefixes_of(label):
+            ids = self._prefixes.get(prefix)
+            if ids is not None:
+                ids.discard(id(track))
+                if not ids:
+                    del self._prefixes[prefix]
+        self._unregister(id(track))
+
+    def _unregister(self, key: int) -> None:
+        indexes = indexes_of.get(key)
+        if indexes is not None:
+            indexes.discard(self)
+            if not indexes:
+                del indexes_of[key]
+
+    def clear(self) -> None:
+        for key in self._labels:
+            self._unregister(key)
+        self._labels.clear()
+        self._prefixes.clear()
+
+    def update(self, track) -> None:
+        label = self._labels.get(id(track))
+        if label is not None and label != str(track).lower():
+            self.remove(track)
+            self.add(track)
+
+    def match(self, query: str) -> Optional[set[int]]:
+        """Return the ids of the tracks matching all the words of the query
+        as token prefixes. Return None if the query is empty."""
+        query = query.lower().strip()
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+
+        # Intersect from the smallest set
+        id_sets = sorted(
+            (self._prefixes.get(token[:MAX_PREFIX_LENGTH], set()) for token in tokens),
+            key=len,
+        )
+        result = id_sets[0].intersection(*id_sets[1:])
+
+        long_tokens = [token for token in tokens if len(token) > MAX_PREFIX_LENGTH]
+        if result and long_tokens:
+            result = {
+                key
+                for key in result
+                if all(token in self._labels[key] for token in long_tokens)
+            }
+        return result
+
+    def match_substring(self, query: str) -> set[int]:
+        """Return the ids of the tracks containing the query
+        (e.g. for languages without spaces, or inside words).
+        Linear in the number of tracks: only used when `match` finds none."""
+        query = query.lower().strip()
+        return {key for key, label in self._labels.items() if query in label}
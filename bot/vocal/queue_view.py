@@ -1,11 +1,10 @@
 import asyncio
-from typing import List
-
 import discord
 from discord.ui import View
 
-from bot.vocal.custom import get_cover_data_from_file
+from bot.vocal.custom import get_cover_data
 from bot.utils import split_into_chunks
+from bot.vocal.play_queue import PlayQueue
 from bot.vocal.track_dataclass import Track
 from config import DEFAULT_EMBED_COLOR
 
@@ -13,8 +12,8 @@ from config import DEFAULT_EMBED_COLOR
 class QueueView(View):
     def __init__(
         self,
-        queue: List[dict],
-        to_loop: List[dict],
+        queue: PlayQueue[Track],
+        to_loop: PlayQueue[Track],
         bot: discord.Bot,
         is_playing: bool,
         page: int = 1,
@@ -74,7 +73,7 @@ class QueueView(View):
         # Get cover and colors of the NOW PLAYING song
         track: Track = self.queue[0]
         if track.service == "custom":
-            cover_data = await get_cover_data_from_file(track.id)
+            cover_data = await get_cover_data(track.id)
         else:
             if track.unloaded_embed:
                 await track.generate_embed()
@@ -102,6 +101,21 @@ class QueueView(View):
             inline=False,
         )
 
+        # Queue and loop sections
+        for name, value in self.get_page_fields():
+            embed.add_field(name=name, value=value, inline=False)
+
+        return embed
+
+    def get_page_fields(self) -> list[tuple[str, str]]:
+        """Return the (name, value) fields of the queue and loop sections of the page.
+        Pages are cached in the queue until it is modified."""
+        cache_key = ("page", self.page, self.max_per_page, self.to_loop.version)
+        fields = self.queue.render_cache.get(cache_key)
+        if fields is not None:
+            return fields
+
+        fields = []
         # Queue section
         start_index = (self.page - 1) * self.max_per_page
         end_index = min(start_index + self.max_per_page, len(self.queue))
@@ -109,26 +123,31 @@ class QueueView(View):
         if len(self.queue) > 1:
             if start_index < end_index:
                 queue_details = "\n".join(
-                    f"{i}. {self.queue[i]:markdown}"
-                    for i in range(start_index + 1, end_index)
+                    f"{i}. {track:markdown}"
+                    for i, track in enumerate(
+                        self.queue[start_index + 1 : end_index], start=start_index + 1
+                    )
                 )
                 # Split the queue (if too long)
                 splitted: list = split_into_chunks(queue_details)
-                embed.add_field(name="Queue", value=splitted[0], inline=False)
+                fields.append(("Queue", splitted[0]))
                 for part in splitted[1:]:
-                    embed.add_field(name="", value=part, inline=False)
+                    fields.append(("", part))
 
         # Songs in loop section
         end_index = min(start_index + self.max_per_page, len(self.to_loop))
 
         if self.to_loop:
             loop_details = "\n".join(
-                f"{i + 1}. {self.to_loop[i]:markdown}"
-                for i in range(start_index, end_index)
+                f"{i}. {track:markdown}"
+                for i, track in enumerate(
+                    self.to_loop[start_index:end_index], start=start_index + 1
+                )
             )
-            embed.add_field(name="Songs in Loop", value=loop_details, inline=False)
+            fields.append(("Songs in Loop", loop_details))
 
-        return embed
+        self.queue.render_cache[cache_key] = fields
+        return fields
 
     async def display(
         self, ctx: discord.ApplicationContext, defer_task: asyncio.Task
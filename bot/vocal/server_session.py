@@ -1,22 +1,24 @@
 import asyncio
 from collections import deque
-from datetime import datetime, timedelta
+from datetime import datetime
 import itertools
 import logging
-import random
+from dataclasses import dataclass, field
 from time import perf_counter, time
-from typing import Optional, List, Union
+from typing import Literal, Optional, List, Union
 
 import discord
 from librespot.audio import AbsChunkedInputStream
 
 from bot.utils import get_cache_path, respond, send_response
+from bot.vocal.audio_download import GrowingFileReader, get_download
+from bot.vocal.onsei_stream import get_onsei_stream
 from bot.vocal.queue_view import QueueView
 from bot.vocal.now_playing_view import nowPlayingView
+from bot.vocal.play_queue import PlayQueue
 from bot.vocal.wrong_track_view import WrongTrackView
 from bot.vocal.track_dataclass import Track
 from config import (
-    AUTO_LEAVE_DURATION,
     DEFAULT_AUDIO_VOLUME,
     DEFAULT_ONSEI_VOLUME,
     DEFAULT_EMBED_COLOR,
@@ -44,6 +46,19 @@ class AudioEffect:
         self.volume_multiplier = 1
 
 
+@dataclass
+class Transition:
+    """Playback event, processed in order by the session."""
+
+    kind: Literal["finished", "skip", "seek", "previous"]
+    ctx: discord.ApplicationContext
+    error: Optional[Exception] = None
+    position: int = 0  # Seek
+    quiet: bool = False  # Seek
+    posted_at: float = field(default_factory=perf_counter)
+    done: Optional[asyncio.Future] = None
+
+
 class ServerSession:
     """Represents an audio session for a Discord server.
     This class manages the audio playback for a specific server."""
@@ -63,15 +78,14 @@ class ServerSession:
         self.guild_id: int = guild_id
         self.voice_channel_id: int = voice_channel_id
         self.voice_client: Optional[discord.VoiceClient] = voice_client
-        self.queue: List[Track] = []
-        self.to_loop: List[Track] = []
+        self.queue: PlayQueue[Track] = PlayQueue()
+        self.to_loop: PlayQueue[Track] = PlayQueue()
         self.last_played_time: datetime = datetime.now()
         self.start_time: datetime = datetime.now()  # Meaningless at initialization
         self.loop_current: bool = False
         self.loop_queue: bool = False
         self.skipped: bool = False
         self.shuffle: bool = False
-        self.original_queue: List[Track] = []
         self.deezer_blacklist: set[Union[str, int]] = set()
         self.previous: bool = False
         self.stack_previous: deque[Track] = deque([])
@@ -80,9 +94,6 @@ class ServerSession:
         self.now_playing_message: Optional[discord.Message] = None
         self.old_message: Optional[discord.Message] = None
         self.session_manager: SessionManager = session_manager
-        self.cleanup_task: asyncio.Task = asyncio.create_task(
-            self.create_cleanup_task()
-        )
         self.last_context: discord.ApplicationContext = ctx
         self.volume = DEFAULT_AUDIO_VOLUME
         self.onsei_volume = DEFAULT_ONSEI_VOLUME
@@ -93,6 +104,15 @@ class ServerSession:
         self.wrong_track_views: list[WrongTrackView] = []
         self.ffmpeg_sources: deque[discord.FFmpegOpusAudio] = deque([])
         self.dummy_load = None
+        self.closed = False
+
+        # Playback transitions, processed one at a time in the event loop
+        self.loop = asyncio.get_running_loop()
+        self.transitions: asyncio.Queue[Transition] = asyncio.Queue()
+        self.transition_task = asyncio.create_task(self.process_transitions())
+
+        # Leave if nothing is played
+        self.session_manager.schedule_leave(self)
 
     async def wait_for_connect_task(self) -> None:
         if self.connect_task:
@@ -202,6 +222,11 @@ class ServerSession:
 
     async def seek(self, position: int, quiet: bool = False) -> None:
         """Seeks to a specific position in the current track."""
+        await self.post_transition(
+            Transition("seek", self.last_context, position=position, quiet=quiet)
+        )
+
+    async def _seek(self, position: int, quiet: bool = False) -> None:
         # No audio is playing
         if not (self.voice_client and self.queue):
             return
@@ -239,6 +264,9 @@ class ServerSession:
         if not self.queue:
             await self.update_now_playing(self.last_context, edit_only=True)
             logging.info(f"Playback stopped in {self.guild_id}")
+            self.session_manager.schedule_leave(self)
+            # Ffmpeg garbage cleaner
+            asyncio.get_running_loop().call_later(3, self.clean_ffmpeg_sources)
             return
 
         # Cache
@@ -270,15 +298,42 @@ class ServerSession:
             return
         self.clean_ffmpeg_sources()
 
+        # Cache file still downloading: pipe what has been written so far
+        stream_source = track.stream_source
+        seek_input = False
+        if download := get_download(stream_source):
+            stream_source = download.open_reader()
+        elif track.service == "onsei" and isinstance(stream_source, str):
+            # Streamed to the cache folder, seek locally
+            stream = get_onsei_stream(stream_source)
+            await stream.buffered.wait()
+            if stream.error:
+                pass
+            elif stream.complete:
+                stream_source = stream.path
+            elif not start_position or stream.is_downloaded(
+                start_position, track.duration
+            ):
+                stream_source = stream.open_reader()
+                # MP3 only, the other formats are decoded until the position
+                if start_position and stream_source.seek_to(
+                    start_position, track.duration
+                ):
+                    start_position = 0
+            else:
+                # Not downloaded yet: FFmpeg seeks with its own range requests
+                seek_input = True
+
         # Play !
         source = discord.FFmpegOpusAudio(
-            track.stream_source,
+            stream_source,
             pipe=isinstance(
-                track.stream_source, (AbsChunkedInputStream, DeezerChunkedInputStream)
+                stream_source,
+                (AbsChunkedInputStream, DeezerChunkedInputStream, GrowingFileReader),
             ),
             bitrate=self.bitrate,
             **self.get_ffmpeg_options(
-                track.stream_source, track.service, start_position
+                track.stream_source, track.service, start_position, seek_input
             ),
         )
         self.ffmpeg_sources.append(source)
@@ -286,6 +341,7 @@ class ServerSession:
             source,
             after=lambda e=None: self.after_playing(ctx, e),
         )
+        self.session_manager.cancel_leave(self)
         self.start_time = datetime.now()
 
         # Log
@@ -322,13 +378,21 @@ class ServerSession:
         self.previous = False
 
     def get_ffmpeg_options(
-        self, stream_source, service: str, start_position: int
+        self,
+        stream_source,
+        service: str,
+        start_position: int,
+        seek_input: bool = False,
     ) -> dict[str, str]:
         # Volume
         volume = (self.volume if service != "onsei" else self.onsei_volume) / 100
 
         # Stream options
         stream_options = "-thread_queue_size 4 -fflags +discardcorrupt "
+        if seek_input:
+            # Applied to the stream (the last input) before opening it
+            stream_options += f"-ss {start_position} "
+            start_position = 0
 
         # Audio effects
         ae = self.audio_effect
@@ -379,7 +443,7 @@ class ServerSession:
         for i, track in enumerate(self.queue[1 : preload_tracks + 1], start=1):
             if i == 1:
                 tasks.append(track.load_stream(self))
-            if track.unloaded_embed:  # Spotify/Deezer
+            if track.unloaded_embed:  # Spotify/Deezer, Onsei
                 tasks.append(track.generate_embed(sp))
 
         if not tasks:
@@ -400,31 +464,12 @@ class ServerSession:
         """Adds tracks to the queue and starts playback if not already playing."""
 
         # Add elements to the queue
+        # If shuffling, new tracks are inserted at random positions
         original_length = len(self.queue)
-        self.queue[(i := 1 if play_next else len(self.queue)) : i] = tracks
-
-        # Shuffle if enabled
-        if self.shuffle:
-            if play_next and self.queue:
-                try:
-                    current_index = self.original_queue.index(self.queue[0])
-                    insert_index_orig = current_index + 1
-                except (ValueError, IndexError):
-                    # If first track or original queue not synced
-                    insert_index_orig = len(self.original_queue)
-            else:
-                insert_index_orig = len(self.original_queue)
-
-            self.original_queue[insert_index_orig:insert_index_orig] = tracks
-
-            if play_next:
-                shuffled_part = self.queue[1 + len(tracks) :]
-                random.shuffle(shuffled_part)
-                self.queue[1 + len(tracks) :] = shuffled_part
-            else:
-                shuffled_part = self.queue[1:]
-                random.shuffle(shuffled_part)
-                self.queue[1:] = shuffled_part
+        if play_next:
+            self.queue.insert_next(tracks)
+        else:
+            self.queue.extend(tracks, shuffle=self.shuffle)
 
         # Tell the user what has been added
         c = len(tracks)
@@ -474,15 +519,23 @@ class ServerSession:
             await self.load_next_tracks()
 
     async def play_previous(self, ctx: discord.ApplicationContext) -> None:
+        await self.post_transition(Transition("previous", ctx))
+
+    async def skip(self, ctx: discord.ApplicationContext) -> None:
+        await self.post_transition(Transition("skip", ctx))
+
+    async def _play_previous(self, ctx: discord.ApplicationContext) -> None:
         self.previous = True
         await self.stop_playback()
         if self.queue:
             await self.post_process()
-        self.queue.insert(0, self.stack_previous.pop())
+        self.queue.appendleft(self.stack_previous.pop())
         await self.start_playing(ctx)
 
     async def stop_playback(self) -> None:
-        """Stop the playback and cancel the after_playing callback."""
+        """Stop the playback and cancel the after_playing callback.
+        The stopped track is post-processed before returning, so within the
+        transition calling this method."""
         if (
             not self.voice_client
             or not self.voice_client.is_playing()
@@ -503,6 +556,10 @@ class ServerSession:
         await self.stop_event.wait()  # ... Until its completely stopped
         self.last_played_time = datetime.now()
         self.stop_event = None
+        if self.queue:
+            await self.post_process(
+                self.queue[0], close_stream=self.should_close_stream
+            )
 
     async def post_process(
         self, track: Optional[Track] = None, close_stream: bool = True
@@ -522,7 +579,7 @@ class ServerSession:
             old_track: Track = self.stack_previous.popleft()
             # The removed track should not be in the queue
             # I check nonetheless to avoid weird issues
-            if old_track not in self.to_loop + self.queue:
+            if old_track not in self.to_loop and old_track not in self.queue:
                 tasks.append(old_track.close())
 
         if tasks:
@@ -535,25 +592,17 @@ class ServerSession:
             # No need to shuffle if the queue has 0 or 1 song
             return True
 
-        current_song = self.queue[0]
-
         if self.shuffle:
             # Restore the original order
-            current_index = self.original_queue.index(current_song)
-            self.queue = [current_song] + self.original_queue[current_index + 1 :]
+            self.queue.unshuffle()
 
             # Reset the previous stack
             await self.close_streams(
                 tracks=list(self.stack_previous), clear_queues=False
             )
             self.stack_previous.clear()
-            self.original_queue.clear()
         else:
-            # Grab all the incoming tracks
-            self.original_queue = self.queue
-            shuffled_queue = self.queue[1:]
-            random.shuffle(shuffled_queue)
-            self.queue = [current_song] + shuffled_queue
+            self.queue.shuffle()
 
         self.shuffle = not self.shuffle
         asyncio.create_task(self.update_now_playing(self.last_context, edit_only=True))
@@ -564,28 +613,91 @@ class ServerSession:
         ctx: discord.ApplicationContext,
         error: Optional[Exception] = None,
     ) -> None:
-        """Callback function executed after a track finishes playing."""
+        """Callback function executed after a track finishes playing.
+        Called in the audio player thread: only posts the event to the event loop."""
+        self.loop.call_soon_threadsafe(
+            self.on_track_finished, ctx, error, perf_counter()
+        )
+
+    def on_track_finished(
+        self,
+        ctx: discord.ApplicationContext,
+        error: Optional[Exception],
+        finished_at: float,
+    ) -> None:
         self.last_played_time = datetime.now()
 
         self.clean_ffmpeg_sources()
         if error:
             logging.error(repr(error))
 
-        # POST PROCESSING
-        played_track: Track = self.queue[0]
-        close_stream = not (self.loop_current or self.previous or self.is_seeking)
+        if self.stop_event:
+            # Stopped by stop_playback(): the waiting transition goes on
+            self.stop_event.set()
+            return
+
+        self.transitions.put_nowait(
+            Transition("finished", ctx, error=error, posted_at=finished_at)
+        )
+
+    @property
+    def should_close_stream(self) -> bool:
         # Will take more time to regenerate the stream,
         # But the user is more likely to not play this track again
-        asyncio.run_coroutine_threadsafe(
-            self.post_process(played_track, close_stream=close_stream), self.bot.loop
-        )
+        return not (self.loop_current or self.previous or self.is_seeking)
 
-        # Stop the play_next call
-        if self.is_seeking or self.stop_event:
-            self.stop_event.set()
+    async def post_transition(self, transition: Transition) -> None:
+        """Queue a transition and wait until it is processed."""
+        transition.done = self.loop.create_future()
+        self.transitions.put_nowait(transition)
+        await transition.done
+
+    async def process_transitions(self) -> None:
+        """State machine of the session: finished tracks, skips, seeks and
+        previous tracks are processed serially, in the order they happened."""
+        while True:
+            transition = await self.transitions.get()
+            try:
+                if transition.kind == "finished":
+                    await self.finish_track(transition.ctx)
+                elif transition.kind == "skip":
+                    await self._skip(transition.ctx)
+                elif transition.kind == "seek":
+                    await self._seek(transition.position, transition.quiet)
+                elif transition.kind == "previous":
+                    await self._play_previous(transition.ctx)
+                logging.info(
+                    f"Processed {transition.kind} in {self.guild_id} in "
+                    f"{(perf_counter() - transition.posted_at) * 1000:.1f}ms"
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(
+                    f"Error processing {transition.kind} in {self.guild_id}: "
+                    f"{repr(e)}",
+                    exc_info=True,
+                )
+            finally:
+                if transition.done and not transition.done.done():
+                    transition.done.set_result(None)
+
+    async def finish_track(self, ctx: discord.ApplicationContext) -> None:
+        if not self.queue:
+            await self.start_playing(ctx)
             return
+        await self.post_process(self.queue[0], close_stream=self.should_close_stream)
+        await self.play_next(ctx)
 
-        asyncio.run_coroutine_threadsafe(self.play_next(ctx), self.bot.loop)
+    async def _skip(self, ctx: discord.ApplicationContext) -> None:
+        self.skipped = True
+        self.loop_current = False
+
+        if not len(self.queue) == 1 and not self.voice_client.is_playing():
+            # Retrigger the play loop if paused/stopped for whatever reasons
+            await self.finish_track(ctx)
+        else:
+            self.voice_client.stop()
 
     async def play_next(
         self, ctx: discord.ApplicationContext, force_remove: bool = False
@@ -604,7 +716,7 @@ class ServerSession:
                 self.to_loop.append(played_track)
 
         if force_remove or not self.loop_current:
-            self.queue.pop(0)
+            self.queue.popleft()
             if force_remove:
                 send_response(
                     self.last_context.send,
@@ -615,7 +727,7 @@ class ServerSession:
         # After pop
         if not self.queue:
             if self.loop_queue:
-                self.queue, self.to_loop = self.to_loop, []
+                self.queue, self.to_loop = self.to_loop, PlayQueue()
             else:
                 # Can reset the skipped status if there are no more tracks
                 self.skipped = False
@@ -637,40 +749,22 @@ class ServerSession:
                 source = self.ffmpeg_sources.popleft()
                 source.cleanup()
 
-    async def create_cleanup_task(self) -> None:
-        """Checks for inactivity and automatically disconnects from the voice channel if inactive.
-        Check for residual FFmpeg sources"""
-        await asyncio.sleep(1)
+    async def leave_if_inactive(self) -> None:
+        """Called by the session manager when the auto leave deadline is reached,
+        or right away if the bot has been disconnected."""
+        if self.closed:
+            return
         await self.wait_for_connect_task()
 
-        while True:
-            connected = self.voice_client.is_connected()
-            if not self.voice_client.is_playing():
-                if not connected:
-                    # Kill the session right away if the bot has been kicked
-                    time_until_disconnect = timedelta(seconds=0)
-                else:
-                    time_since_last_played = datetime.now() - self.last_played_time
-                    time_until_disconnect = (
-                        timedelta(seconds=AUTO_LEAVE_DURATION) - time_since_last_played
-                    )
-
-                if time_until_disconnect <= timedelta(seconds=0):
-                    if connected:
-                        await self.voice_client.disconnect()
-                        channel = self.last_context.channel
-                        if channel:
-                            await channel.send("Baibai~")
-                    await self.clean_session()
-                    break
-
-            # Ffmpeg garbage cleaner
-            if self.ffmpeg_sources and not self.voice_client.is_playing():
-                await asyncio.sleep(3)
-                if self.ffmpeg_sources and not self.voice_client.is_playing():
-                    self.clean_ffmpeg_sources()
-
-            await asyncio.sleep(5)
+        connected = self.voice_client and self.voice_client.is_connected()
+        if connected:
+            if self.voice_client.is_playing():
+                return
+            await self.voice_client.disconnect()
+            channel = self.last_context.channel
+            if channel:
+                await channel.send("Baibai~")
+        await self.clean_session()
 
     async def close_streams(
         self,
@@ -692,11 +786,15 @@ class ServerSession:
 
         if clear_queues:
             self.queue.clear()
-            self.original_queue.clear()
             self.to_loop.clear()
             self.stack_previous.clear()
 
     async def clean_session(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.session_manager.server_sessions.get(self.guild_id) is self:
+            self.session_manager.cancel_leave(self)
         await self.stop_playback()
 
         if self.now_playing_message:
@@ -713,7 +811,7 @@ class ServerSession:
             await self.voice_client.disconnect()
             self.voice_client.cleanup()
 
-        for task in (self.cleanup_task, self.connect_task, self.dummy_load):
+        for task in (self.connect_task, self.dummy_load, self.transition_task):
             if task and not task.done():
                 task.cancel()
                 try:
@@ -721,7 +819,15 @@ class ServerSession:
                 except asyncio.CancelledError:
                     ...
 
-        self.session_manager.server_sessions.pop(self.guild_id)
+        # Release the callers waiting for a transition
+        while not self.transitions.empty():
+            transition = self.transitions.get_nowait()
+            if transition.done and not transition.done.done():
+                transition.done.set_result(None)
+
+        # A new session may have been created for the guild
+        if self.session_manager.server_sessions.get(self.guild_id) is self:
+            del self.session_manager.server_sessions[self.guild_id]
 
         await self.close_streams()
         self.clean_ffmpeg_sources()
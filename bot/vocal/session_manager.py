@@ -1,10 +1,13 @@
 import asyncio
+import heapq
 import logging
 import discord
 
 from typing import Optional
+from bot.sharding import ShardedDict, shard_metrics
 from bot.vocal.onsei import Onsei
 from bot.vocal.server_session import ServerSession
+from config import AUTO_LEAVE_DURATION
 
 onsei = Onsei()
 
@@ -16,9 +19,16 @@ class SessionManager:
         """
         Initialize the SessionManager.
 
-        This constructor creates an empty dictionary to store server sessions.
+        This constructor creates an empty dictionary to store server sessions,
+        split by Discord shard, and the deadlines after which inactive sessions
+        are closed.
         """
-        self.server_sessions = {}
+        self.server_sessions: ShardedDict = ShardedDict()
+        shard_metrics.track("voice sessions", self.server_sessions)
+        # Min-heap of (deadline, guild ID), entries not in `deadlines` are stale
+        self.deadline_heap: list[tuple[float, int]] = []
+        self.deadlines: dict[int, float] = {}  # Guild ID: deadline (loop time)
+        self.timer: Optional[asyncio.TimerHandle] = None
 
     def connect(
         self, ctx: discord.ApplicationContext, bot: discord.Bot
@@ -64,5 +74,61 @@ class SessionManager:
         self.server_sessions[guild_id].last_context = ctx
         return self.server_sessions[guild_id]
 
+    def schedule_leave(
+        self, session: ServerSession, delay: float = AUTO_LEAVE_DURATION
+    ) -> None:
+        """Close a session after `delay` seconds, unless it is cancelled before.
+        Called when the playback stops or is paused."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        self.deadlines[session.guild_id] = deadline
+        heapq.heappush(self.deadline_heap, (deadline, session.guild_id))
+
+        # Drop the stale entries once in a while
+        if len(self.deadline_heap) > 2 * len(self.deadlines) + 64:
+            self.deadline_heap = [(d, g) for g, d in self.deadlines.items()]
+            heapq.heapify(self.deadline_heap)
+        self.arm_timer()
+
+    def cancel_leave(self, session: ServerSession) -> None:
+        """Called when the playback starts or resumes."""
+        self.deadlines.pop(session.guild_id, None)
+
+    def arm_timer(self) -> None:
+        """Wake up at the earliest deadline, only one timer for all sessions."""
+        heap = self.deadline_heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+        if self.timer:
+            if heap and self.timer.when() <= heap[0][0]:
+                return
+            self.timer.cancel()
+            self.timer = None
+
+        if heap:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_at(heap[0][0], self.expire_deadlines)
+
+    def expire_deadlines(self) -> None:
+        self.timer = None
+        now = asyncio.get_running_loop().time()
+        heap = self.deadline_heap
+        while heap and heap[0][0] <= now:
+            deadline, guild_id = heapq.heappop(heap)
+            if self.deadlines.get(guild_id) != deadline:
+                continue  # Cancelled or rescheduled
+            del self.deadlines[guild_id]
+            session: Optional[ServerSession] = self.server_sessions.get(guild_id)
+            if session:
+                asyncio.create_task(session.leave_if_inactive())
+        self.arm_timer()
+
+    def on_voice_disconnect(self, guild_id: int) -> None:
+        """Close the session right away if the bot has been disconnected."""
+        session: Optional[ServerSession] = self.server_sessions.get(guild_id)
+        if session:
+            self.schedule_leave(session, delay=0)
+
 
 session_manager = SessionManager()
@@ -13,7 +13,11 @@ from deezer_decryption.chunked_input_stream import DeezerChunkedInputStream
 from librespot.audio import AbsChunkedInputStream
 import spotipy
 
+from bot.single_flight import SingleFlight
 from bot.utils import get_dominant_rgb_from_url, get_cache_path
+from bot.vocal.audio_download import GrowingFile, get_download
+from bot.vocal.onsei_stream import get_onsei_stream
+from bot.vocal.queue_search import reindex
 from deezer_decryption.api import Deezer
 from config import (
     DEFAULT_EMBED_COLOR,
@@ -25,6 +29,9 @@ from config import (
 if TYPE_CHECKING:
     from bot.vocal.server_session import ServerSession
 
+# Keyed by (service, track id), shared between servers
+track_loads = SingleFlight("track load")
+
 
 class Timer:
     def __init__(self):
@@ -74,11 +81,16 @@ class Track:
     timer: Timer = Timer()
     stream_generator: Optional[Callable] = None
     file_extension: Optional[str] = None  # Needed for Yt-dlp
-    cache_event: Optional[asyncio.Event] = None
 
     def __eq__(self, other):
         return self.stream_source == other.stream_source
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ("title", "artist"):
+            # Label of the track in the queue search indexes
+            reindex(self)
+
     def __repr__(self):
         return f"{self.artist} - {self.title}"
 
@@ -138,7 +150,7 @@ class Track:
         album_url = None
         artist_urls = None
 
-        if sp:
+        if sp and self.service == "spotify/deezer":
             track_api: dict = await asyncio.to_thread(sp.track, self.id)
             album: str = track_api["album"]
             album_url: str = album["external_urls"]["spotify"]
@@ -176,32 +188,20 @@ class Track:
             await asyncio.to_thread(self.stream_source.set_chunks)
             return True
 
-        # Try to get native track API (to grab the song from irsc)
-        native_track_api = await deezer.parse_spotify_track(
-            self.source_url, session.bot.spotify.sessions.sp
+        # Resolved once for all the servers loading the track at the same time
+        resolved = await track_loads.run(
+            ("deezer", self.id), lambda: self.resolve_deezer_stream(session)
         )
-
-        # Load the stream
-        stream_loaded = False
-        if native_track_api:
-            gw_track_api = await deezer.get_track(native_track_api["id"])
-            if gw_track_api:
-                stream_urls = await deezer.get_stream_urls(
-                    [gw_track_api["TRACK_TOKEN"]]
-                )
-                stream_url = stream_urls[0]
-                if stream_url:
-                    stream_loaded = True
-
-        if not stream_loaded:
+        if not resolved:
             session.deezer_blacklist.add(self.id)
             return False
 
+        native_id, stream_url, track_token = resolved
         self.stream_source = DeezerChunkedInputStream(
-            native_track_api["id"],
+            native_id,
             stream_url,
-            gw_track_api["TRACK_TOKEN"],
-            session.bot.deezer,
+            track_token,
+            deezer,
             str(self),
             self.timer,
         )
@@ -209,6 +209,29 @@ class Track:
         logging.info(f"Loaded Deezer stream of {self}")
         return True
 
+    async def resolve_deezer_stream(
+        self, session: "ServerSession"
+    ) -> Optional[tuple[int, str, str]]:
+        """Return the Deezer track ID, stream URL and track token, if available."""
+        deezer: Deezer = session.bot.deezer
+
+        # Try to get native track API (to grab the song from irsc)
+        native_track_api = await deezer.parse_spotify_track(
+            self.source_url, session.bot.spotify.sessions.sp
+        )
+        if not native_track_api:
+            return
+
+        gw_track_api = await deezer.get_track(native_track_api["id"])
+        if not gw_track_api:
+            return
+
+        stream_urls = await deezer.get_stream_urls([gw_track_api["TRACK_TOKEN"]])
+        if not stream_urls[0]:
+            return
+
+        return native_track_api["id"], stream_urls[0], gw_track_api["TRACK_TOKEN"]
+
     async def load_spotify_stream(self, session: "ServerSession") -> bool:
         if not SPOTIFY_ENABLED:
             if isinstance(self.stream_generator, Callable):
@@ -223,6 +246,23 @@ class Track:
             else:
                 return True
 
+        # If agressive caching is enabled, the stream is downloaded to a cache file
+        # once, and read from it by all the servers playing the track
+        if AGRESSIVE_CACHING and callable(self.stream_generator):
+            file_path = get_cache_path(f"spotify{self.id}")
+            is_cached = file_path.with_suffix(".valid").is_file()
+            if not (is_cached or get_download(file_path)):
+                try:
+                    await track_loads.run(
+                        ("spotify", self.id),
+                        lambda: self.store_spotify_stream(file_path),
+                    )
+                except Exception as e:
+                    logging.error(repr(e))
+                    return False
+            self.stream_source = file_path
+            return True
+
         # Handle Spotify stream generators
         if callable(self.stream_generator):
             try:
@@ -232,70 +272,64 @@ class Track:
                 return False
             logging.info(f"Loaded Spotify stream of {self}")
 
-        # If agressive caching is enabled, save the stream to a cache file
-        if AGRESSIVE_CACHING:
-            cache_id = f"spotify{self.id}"
-            file_path = get_cache_path(cache_id)
-
-            if not file_path.with_suffix(".valid").is_file():
-                self.cache_event = asyncio.Event()
-                asyncio.create_task(self.store_spotify_stream(file_path))
-
-                # Wait for the first write
-                await self.cache_event.wait()
-                self.cache_event = None
-
-            self.stream_source = file_path
-
-        else:
-            # Skip non-audio content in Spotify streams
-            await asyncio.to_thread(self.stream_source.seek, 167)
-
+        # Skip non-audio content in Spotify streams
+        await asyncio.to_thread(self.stream_source.seek, 167)
         return True
 
     @staticmethod
     def _sync_download(
-        stream, path: Path, loop: asyncio.AbstractEventLoop, cache_event: Optional[asyncio.Event]
-    ):
+        stream, cache_file: GrowingFile, loop: asyncio.AbstractEventLoop
+    ) -> None:
         """Cache Spotify stream"""
-        with open(path, "wb") as file:
-            first_data = stream.read(4096)
-            if first_data:
-                file.write(first_data)
+        with open(cache_file.path, "wb") as file:
+            # Small first read to start playing early while caching the rest
+            data = stream.read(4096)
+            while data:
+                file.write(data)
                 file.flush()
-
-                # Unblock event loop early for quicker play while caching the rest
-                if cache_event:
-                    loop.call_soon_threadsafe(cache_event.set)
-
-            while True:
+                loop.call_soon_threadsafe(cache_file.written, len(data))
                 data = stream.read(65536)
-                if not data:
-                    break
-                file.write(data)
-
-        with open(path.with_suffix(".valid"), "w"):
-            ...
 
     async def store_spotify_stream(self, file_path: Path) -> bool:
-        if not SPOTIFY_ENABLED:
-            return False
+        """Open a Spotify stream and download it to a cache file.
+        Return after the first write, the rest is downloaded in the background."""
+        stream = await self.stream_generator()
+        logging.info(f"Loaded Spotify stream of {self}")
+
+        cache_file = GrowingFile(buffer_size=1)
+        cache_file.set_path(file_path)
+        asyncio.create_task(self._download_spotify_stream(stream, cache_file))
+
+        await cache_file.buffered.wait()
+        if cache_file.error:
+            raise cache_file.error
+        return True
 
-        # Download
+    @staticmethod
+    async def _download_spotify_stream(stream, cache_file: GrowingFile) -> None:
         loop = asyncio.get_running_loop()
-        await asyncio.to_thread(
-            Track._sync_download, self.stream_source, file_path, loop, self.cache_event
-        )
+        try:
+            await asyncio.to_thread(Track._sync_download, stream, cache_file, loop)
+        except Exception as e:
+            logging.error(f"Failed to cache {cache_file.path}: {repr(e)}")
+            cache_file.set_complete(e)
+            return
+        finally:
+            asyncio.create_task(asyncio.to_thread(stream.close))
 
         # If the download is sucessful, create a "valid" marker
-        async with aiofiles.open(file_path.with_suffix(".valid"), "w"):
+        async with aiofiles.open(cache_file.path.with_suffix(".valid"), "w"):
             ...
-
-        return True
+        cache_file.set_complete()
 
     async def load_stream(
         self, session: Optional["ServerSession"] = None
     ) -> Optional[Union[AbsChunkedInputStream, DeezerChunkedInputStream]]:
+        if self.service == "onsei" and isinstance(self.stream_source, str):
+            # Buffer the start of the track in cache
+            await get_onsei_stream(self.stream_source).buffered.wait()
+            return
+
         if (
             isinstance(self.stream_source, (Path, str))
             or self.service != "spotify/deezer"
@@ -316,6 +350,10 @@ class Track:
             else:
                 self.stream_source = cache_path
                 return
+        elif get_download(cache_path):
+            # Being downloaded for another server
+            self.stream_source = cache_path
+            return
 
         # Load from Deezer first if possible
         if not await self.load_deezer_stream(session):
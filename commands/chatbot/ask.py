@@ -1,15 +1,16 @@
 import asyncio
 import discord
 from discord.ext import commands
-from google.genai.errors import APIError
 import logging
 
-from bot.utils import split_into_chunks
-from config import GEMINI_ENABLED, OPENAI_ENABLED
+from config import GEMINI_ENABLED, OPENAI_ENABLED, CHATBOT_STREAMING
 
 if GEMINI_ENABLED:
+    from google.genai.errors import APIError
     from bot.chatbot.chat_dataclass import ChatbotMessage
     from bot.chatbot.gemini import Gembot, active_chats
+    from bot.chatbot.llm_scheduler import ModelsExhausted
+    from bot.chatbot.streaming import StreamedReply
 
 
 class Ask(commands.Cog):
@@ -55,7 +56,7 @@ class Ask(commands.Cog):
 
         # Create/Use a chat
         if id_ not in active_chats:
-            chat = Gembot(id_, ugoku_chat=True)
+            chat = Gembot(id_, ugoku_chat=True, guild_id=ctx.guild_id)
         chat: Gembot = active_chats.get(id_)
 
         # Remove continuous chat notice (if enabled the msg before)
@@ -66,23 +67,37 @@ class Ask(commands.Cog):
         params = await chat.get_params(ctx, query, ctx.bot, api=api)
         await chat.interact(ctx, query, self.bot.user.id, ask_command=True)
 
+        async def send(content: str) -> discord.Message:
+            await defer_task
+            return await ctx.respond(content, ephemeral=ephemeral)
+
+        header = f"-# {ctx.author.name}: {query}\n"
+        reply = StreamedReply(send, max_messages=1)
+
+        def on_text(text: str) -> None:
+            reply.update(header + chat.format_response(text, final=False))
+
         try:
-            chatbot_message: ChatbotMessage = await chat.send_message(*params)
+            chatbot_message: ChatbotMessage = await chat.send_message(
+                *params, on_text=on_text if CHATBOT_STREAMING else None
+            )
         except APIError as e:
-            await defer_task
-            await ctx.respond("*filtered*", ephemeral=ephemeral)
+            await reply.finish("*filtered*")
             logging.error(f"Response blocked by Gemini in {chat.id_}: {e.message}")
             return
+        except ModelsExhausted:
+            await reply.finish("*filtered*")
+            logging.error(f"Chat model rate limited in {chat.id_}")
+            return
+        except Exception:
+            # The reply would be left pending
+            await reply.finish("*filtered*")
+            raise
 
         # Response
         formatted_response = chat.format_response(chatbot_message.response)
-        formatted_reply = f"-# {ctx.author.name}: {query}\n{formatted_response}"
-        chunked_reply = split_into_chunks(formatted_reply, 2000)
-        tasks = []
-        tasks.append(ctx.respond(chunked_reply[0], ephemeral=ephemeral))
-        tasks.append(chat.memory.store(chat.history))
-        await defer_task
-        await asyncio.gather(*tasks, return_exceptions=True)
+        chat.memory.queue_store(chat.history)
+        await reply.finish(header + formatted_response)
 
 
 def setup(bot):
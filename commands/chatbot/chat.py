@@ -1,14 +1,17 @@
+import asyncio
 import logging
 
 import discord
 from discord.ext import commands
 
-from config import GEMINI_ENABLED, CHATBOT_PREFIX
-from google.genai.errors import APIError
+from config import GEMINI_ENABLED, CHATBOT_PREFIX, CHATBOT_STREAMING
 
 if GEMINI_ENABLED:
+    from google.genai.errors import APIError
     from bot.chatbot.chat_dataclass import ChatbotMessage
     from bot.chatbot.gemini import Gembot, active_chats
+    from bot.chatbot.llm_scheduler import ModelsExhausted
+    from bot.chatbot.streaming import StreamedReply
     from bot.utils import split_into_chunks
 
     class Chatbot(commands.Cog):
@@ -52,6 +55,7 @@ if GEMINI_ENABLED:
                 chat = Gembot(
                     id_,
                     ugoku_chat=True,
+                    guild_id=message.guild.id if message.guild else None,
                 )
             chat: Gembot = active_chats.get(id_)
 
@@ -67,25 +71,36 @@ if GEMINI_ENABLED:
             ):
                 return
 
+            # Max the number of successive message to 4
+            reply = StreamedReply(message.channel.send, max_messages=4)
+
+            def on_text(text: str) -> None:
+                reply.update(chat.format_response(text, final=False))
+
             async with message.channel.typing():
                 params = await chat.get_params(message, message.content, self.bot)
                 try:
-                    chatbot_message: ChatbotMessage = await chat.send_message(*params)
+                    chatbot_message: ChatbotMessage = await chat.send_message(
+                        *params, on_text=on_text if CHATBOT_STREAMING else None
+                    )
                 except APIError as e:
-                    await message.channel.send("*filtered*")
+                    await reply.finish("*filtered*")
                     logging.error(
                         f"Response blocked by Gemini in {chat.id_}: {e.message}"
                     )
                     return
+                except ModelsExhausted:
+                    await reply.finish("*filtered*")
+                    logging.error(f"Chat model rate limited in {chat.id_}")
+                    return
+                except Exception:
+                    # The reply would be left pending
+                    await reply.finish("*filtered*")
+                    raise
 
             # Add chat status, remove default emoticons
             formatted_response = chat.format_response(chatbot_message.response)
-            chunked_message = split_into_chunks(formatted_response, 2000)
-
-            # Max the number of successive message to 5
-            first_msg = await message.channel.send(chunked_message[0])
-            for i in range(1, min(len(chunked_message), 4)):
-                await message.channel.send(chunked_message[i])
+            messages = await reply.finish(formatted_response)
 
             # Send the sources if any
             if chatbot_message.sources:
@@ -93,11 +108,17 @@ if GEMINI_ENABLED:
                 for chunk in source_chunks:
                     await message.channel.send(chunk)
 
-            # Memory
-            # if await chat.memory.store(chatbot_message):
-            if await chat.memory.store(chat.history):
-                await first_msg.edit(
-                    f"-# Ugoku will remember that. \n{chunked_message[0]}"
+            # Memory, stored in the background
+            stored = chat.memory.queue_store(chat.history)
+            if messages:
+                asyncio.create_task(self.show_remembered(stored, reply))
+
+        async def show_remembered(
+            self, stored: asyncio.Future, reply: StreamedReply
+        ) -> None:
+            if await stored:
+                await reply.messages[0].edit(
+                    f"-# Ugoku will remember that. \n{reply.contents[0]}"
                 )
 else:
 
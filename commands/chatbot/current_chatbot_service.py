@@ -34,7 +34,7 @@ class CurrentChatbotService(commands.Cog):
 
         # Create/Use a chat
         if id_ not in active_chats:
-            chat = Gembot(id_, ugoku_chat=True)
+            chat = Gembot(id_, ugoku_chat=True, guild_id=ctx.guild_id)
         chat: Gembot = active_chats.get(id_)
 
         await ctx.respond(
@@ -60,7 +60,7 @@ class ForgetView(discord.ui.View):
             vector for vector in self.vectors if vector["id"] not in removed_vector_ids
         ]
 
-        await asyncio.to_thread(memory.index.delete, removed_vector_ids)
+        await memory.delete_vectors(self.id_, removed_vector_ids)
         self.update()
         await self.webhook_msg.edit(
             content=f"Removed {len(removed_vector_ids)} vector{'s' if len(removed_vector_ids) > 1 else ''} !",
@@ -38,7 +38,7 @@ class SwitchChatbotService(commands.Cog):
 
         # Create/Use a chat
         if id_ not in active_chats:
-            chat = Gembot(id_, ugoku_chat=True)
+            chat = Gembot(id_, ugoku_chat=True, guild_id=ctx.guild_id)
         chat: Gembot = active_chats.get(id_)
 
         if chat.default_api == "openai":
@@ -60,7 +60,7 @@ class DatabaseSettingsCog(commands.Cog):
                     ephemeral=True,
                 )
                 return
-            sqlite_config_manager.add_or_update_chatbot_emote(name, emote_value)
+            await sqlite_config_manager.add_or_update_chatbot_emote(name, emote_value)
             await ctx.respond(
                 f"Added `{emote_value}` in the database !",
                 ephemeral=True,
@@ -84,7 +84,7 @@ class DatabaseSettingsCog(commands.Cog):
         name: discord.Option(str, description="The keyword of the emote to remove."),  # type: ignore
     ):
         try:
-            if sqlite_config_manager.remove_chatbot_emote(name):
+            if await sqlite_config_manager.remove_chatbot_emote(name):
                 await ctx.respond(
                     f"Chatbot emote '{name}' has been removed from the database.",
                     ephemeral=True,
@@ -122,7 +122,8 @@ class DatabaseSettingsCog(commands.Cog):
         ),  # type: ignore
     ):
         try:
-            sqlite_config_manager.add_to_whitelist(
+            id = int(id)
+            await sqlite_config_manager.add_to_whitelist(
                 list_name, id
             )  # list_name is now a string from whitelist_choice
             display_list_name = WHITELIST_DISPLAY_NAMES.get(
@@ -167,7 +168,7 @@ class DatabaseSettingsCog(commands.Cog):
             display_list_name = WHITELIST_DISPLAY_NAMES.get(
                 list_name, list_name.replace("_", " ").title()
             )
-            if sqlite_config_manager.remove_from_whitelist(
+            if await sqlite_config_manager.remove_from_whitelist(
                 list_name, id
             ):  # list_name is a string
                 await ctx.respond(
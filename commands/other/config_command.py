@@ -23,6 +23,7 @@ from config import (
     CHATBOT_EMOTE_FREQUENCY,
     CHATBOT_TIMEZONE,
     CHATBOT_HISTORY_SIZE,
+    CHATBOT_HISTORY_TOKENS,
     PINECONE_RECALL_WINDOW,
     PREMIUM_CHANNEL_ID,
     IMPULSE_RESPONSE_PARAMS,
@@ -74,7 +75,8 @@ class ConfigCommand(commands.Cog):
                 f"{e['misc']} Chatbot OpenAI model: {OPENAI_MODEL}",
                 f"{e['misc']} Chatbot temperature: {CHATBOT_TEMPERATURE}",
                 f"{e['misc']} Chatbot emote frequency: {CHATBOT_EMOTE_FREQUENCY:.1f}",
-                f"{e['misc']} Chatbot history size: {CHATBOT_HISTORY_SIZE}",
+                f"{e['misc']} Chatbot history size: {CHATBOT_HISTORY_SIZE} messages, "
+                f"~{CHATBOT_HISTORY_TOKENS} tokens",
                 f"{e['misc']} Chatbot timezone: {CHATBOT_TIMEZONE}",
                 f"{e['misc']} Max output token per message: {CHATBOT_MAX_OUTPUT_TOKEN}",
                 f"{e['misc']} Max number of recalled messages per response: {PINECONE_RECALL_WINDOW}",
@@ -25,6 +25,7 @@ class Pause(commands.Cog):
         session: ServerSession
         session.voice_client.pause()
         session.last_played_time = datetime.now()
+        sm.schedule_leave(session)
         track = session.queue[0]
         track.timer.stop()
 
@@ -15,16 +15,8 @@ async def autocomplete(ctx: discord.AutocompleteContext) -> list:
     if not session:
         return []
 
-    song = ctx.options["song"].lower()
-    songs = [str(element) for element in session.queue]
-    if song:
-        search = []
-        for s in songs:
-            if song in s.lower():
-                search.append(s)
-        return search
-    else:
-        return songs
+    song = ctx.options["song"] or ""
+    return [str(track) for track in session.queue.search(song)]
 
 
 class RemoveSong(commands.Cog):
@@ -72,13 +64,11 @@ class RemoveSong(commands.Cog):
 
         elif mode == "Before (included)":
             if not index <= 0:  # -1 is not appropriate here
-                removed_tracks.extend(queue[1 : index + 1])
-            session.queue = [queue[0]] + queue[index + 1 :]
+                removed_tracks.extend(queue.remove_range(1, index + 1))
 
         elif mode == "After (included)":
             index = max(min(index, len(queue)), 1)  # Don't kill the playing song
-            removed_tracks.extend(queue[index:])
-            session.queue = queue[:index]
+            removed_tracks.extend(queue.remove_range(index, len(queue)))
 
         # Clear old tracks and preload the following ones
         tasks = []
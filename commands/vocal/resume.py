@@ -22,6 +22,7 @@ class Resume(commands.Cog):
         if voice_client.is_paused():
             voice_client.resume()
             session.last_played_time = datetime.now()
+            session_manager.cancel_leave(session)
             send_response(ctx.respond, "Resumed!", guild_id, silent)
         else:
             send_response(ctx.respond, "The audio is not paused.", guild_id, silent)
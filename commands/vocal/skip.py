@@ -25,20 +25,12 @@ class Skip(commands.Cog):
         session: ServerSession
         send_response(ctx.respond, "Skipping!", session.guild_id, silent)
 
-        # SKIP
-        session.skipped = True
-        if session.loop_current:
-            session.loop_current = False
-
         if resend_now_playing_embed:
             session.old_message = session.now_playing_message
             session.now_playing_message = None
 
-        if not len(session.queue) == 1 and not session.voice_client.is_playing():
-            # Retrigger the play loop if paused/stopped for whatever reasons
-            session.after_playing(ctx)
-        else:
-            session.voice_client.stop()
+        # SKIP
+        await session.skip(ctx)
 
     @commands.slash_command(name="skip", description="Skip the current song.")
     async def skip(self, ctx: discord.ApplicationContext) -> None:
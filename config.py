@@ -1,6 +1,6 @@
-from google.genai.types import SafetySetting, HarmCategory, HarmBlockThreshold
 from pathlib import Path
 import logging
+import os
 import sys
 from dotenv import load_dotenv
 
@@ -31,6 +31,7 @@ GEMINI_UTILS_MODELS = [
     'gemini-2.5-flash',
     'gemini-2.0-flash',
 ] # Used lyrics, example sentences and memory management
+GEMINI_MODEL_LIMITS = {} # Model: (requests, input tokens) per minute. Learned from the rate limit errors if missing
 OPENAI_MODEL = 'gpt-4.1-mini-2025-04-14'
 
 # Display names
@@ -40,15 +41,74 @@ OPENAI_MODEL_DISPLAY_NAME = "GPT-4.1 mini"
 #  ===SETTINGS===
 # Paths
 COMMANDS_FOLDER = Path('./commands')
-TEMP_FOLDER = Path('.') / 'temp'
+BASE_TEMP_FOLDER = Path('.') / 'temp' # Holds the folders of the processes started by launcher.py
+TEMP_FOLDER = BASE_TEMP_FOLDER
+if os.getenv("CLUSTER_ID"):
+    # Set by launcher.py: each process writes and cleans its own cache files
+    TEMP_FOLDER = TEMP_FOLDER / f"cluster{os.getenv('CLUSTER_ID')}"
 PREMIUM_CHANNEL_ID = None # Upload files too big to a channel in a boosted server instead
 DB_PATH = Path("config.sqlite")
+COVER_DB_PATH = Path("covers.sqlite") # Uploaded cover arts of custom tracks
+PROMPT_CACHE_PATH = Path("prompt_cache.sqlite") # Results of translations, lyrics conversions and example sentences
 
 # Cache control & preloading
 AGRESSIVE_CACHING = True # Download Spotify streams on disk before and when playing. Can be useful if Spotify often closes the connection with Librespot.
 PRELOAD_TRACKS = 1 # Number of tracks to preload
-CACHE_SIZE = 100  # Cache size limit (in number of files)
+CACHE_SIZE = 100  # Cache size limit (in number of files), split between the processes started by launcher.py
 CACHE_EXPIRY = 2592000  # Cache expiry time (in seconds). Default is one month
+COVER_STORE_SIZE = 2000 # Number of cover arts (URL and color) kept in COVER_DB_PATH
+
+# Shared HTTP clients
+HTTP_MAX_CONNECTIONS = 100 # Total number of connections kept by each client
+HTTP_LIMIT_PER_HOST = 10 # Simultaneous connections per host (HTTP/1.1 pool, HTTP/2 uses a single connection)
+HTTP_KEEPALIVE_EXPIRY = 30 # Time before closing an idle connection (in seconds)
+HTTP_DNS_CACHE_TTL = 300 # How long DNS lookups are cached (in seconds)
+HTTP_TIMEOUT = 30 # Connect/read/write timeout of the httpx clients, unless a request sets its own (in seconds)
+HTTP_METRICS_LOG_INTERVAL = 3600 # How often per-host HTTP metrics are logged (in seconds)
+
+# HTTP response cache
+# Routes are matched in order against "host/path?query" (fnmatch patterns), the first one wins.
+# expire_after: cache expiry (in seconds), 0 to never cache
+# max_body_size: bigger responses are not cached (in bytes)
+HTTP_CACHE_ROUTES = {
+    'danbooru random': {
+        'patterns': ['danbooru.donmai.us/posts.json?*random=True*'],
+        'expire_after': 0,
+    },
+    'danbooru': {
+        'patterns': ['danbooru.donmai.us/*'],
+        'expire_after': 3600,
+    },
+    'discord attachments': {
+        'patterns': ['cdn.discordapp.com/attachments/*', 'media.discordapp.net/attachments/*'],
+        'expire_after': 0,
+    },
+    'onsei': {
+        'patterns': ['api.asmr.one/*'],
+        'expire_after': 86400,
+    },
+    'covers': {
+        'patterns': ['api.asmr-200.com/api/cover/*', 'i.scdn.co/*', '*.dzcdn.net/*', 'i.imgur.com/*'],
+        'expire_after': CACHE_EXPIRY,
+        'max_body_size': 5000000,
+    },
+    'jpdb': {
+        'patterns': ['jpdb.io/*'],
+        'expire_after': 86400,
+    },
+}
+HTTP_CACHE_DEFAULT_ROUTE = {'expire_after': CACHE_EXPIRY, 'max_body_size': 1000000} # For all the other URLs
+HTTP_CACHE_BYPASS_MIME_TYPES = ['audio/', 'video/', 'application/octet-stream'] # Never cached
+HTTP_CACHE_MEMORY_SIZE = 200 # Number of responses kept in memory in front of the SQLite cache
+HTTP_CACHE_MEMORY_MAX_BODY_SIZE = 500000 # Bigger responses are only cached in SQLite (in bytes)
+
+# Shards and processes
+SHARD_COUNT = None # Total number of Discord shards, None to use the number recommended by Discord (or CLUSTER_COUNT with launcher.py)
+CLUSTER_COUNT = 1 # Number of bot processes started by launcher.py, the shards are split between them with the voice sessions of their servers
+CLUSTER_START_DELAY = 5 # Delay between the start of each process, Discord limits shard logins (in seconds)
+CLUSTER_RESTART_DELAY = 10 # Time before restarting a crashed process (in seconds)
+CONFIG_VERSION_CHECK_INTERVAL = 30 # How often the whitelists and emotes cached in memory are checked for changes made by other processes (in seconds)
+STARTUP_BENCHMARK_PATH = Path("startup_benchmark.csv") # Time to ready and idle memory of each start, None to disable
 
 # VC and audio bot behavior
 AUTO_LEAVE_DURATION = 900 # Duration before killing an audio session (in seconds)
@@ -59,6 +119,10 @@ DEFAULT_EMBED_COLOR = (237, 205, 85) # If the Now playing song doesn't have a co
 DEFAULT_AUDIO_VOLUME = 20 # Linear scale! The recommended value is around 20.
 DEFAULT_ONSEI_VOLUME = 100 # Audio works are generally quieter for a higher dynamic range
 DEFAULT_AUDIO_BITRATE = 320 # From 6 to 510 kbps (opus output)
+CUSTOM_AUDIO_MAX_SIZE = 200000000 # Max size of audio files played from a direct URL (in bytes)
+CUSTOM_AUDIO_BUFFER_SIZE = 1000000 # Downloaded bytes before starting to play a direct URL
+METADATA_WORKERS = 2 # Threads parsing the tags of audio files played from a direct URL
+METADATA_CACHE_SIZE = 50 # Number of parsed audio files (tags and cover) kept in memory
 IMPULSE_RESPONSE_PARAMS = {
     'bass boost (mono)': {
         'left_ir_file': 'bass.wav',
@@ -121,6 +185,11 @@ IMPULSE_RESPONSE_PARAMS = {
 # Onsei filters
 ONSEI_WHITELIST = ['mp3'] # Onsei tracks with one of these extensions and in a folder name containing one of these words will be chosen
 ONSEI_BLACKLIST = ['なし'] # Tracks containing one of these words will be blacklisted
+ONSEI_API_CACHE_SIZE = 50 # Number of works (tracks and info) kept in memory
+ONSEI_API_CACHE_TTL = 3600 # How long the works are kept in memory (in seconds)
+ONSEI_CHUNK_SIZE = 8000000 # Size of the range requests when streaming an Onsei track (in bytes)
+ONSEI_READ_AHEAD = 64000000 # Bytes downloaded ahead of the playback position
+ONSEI_IDLE_TIMEOUT = 600 # Pause a download if no reader has been open for that long (in seconds)
 
 # Chatbot settings
 CHATBOT_CHANNEL_WHITELIST = {} # All channel/thread ids allowed to use the chatbot
@@ -132,7 +201,15 @@ CHATBOT_TIMEZONE = 'Asia/Tokyo'
 CHATBOT_TEMPERATURE = 1.0 # From 0.0 to 2.0. Specifies the randomness/creativity of the chatbot
 CHATBOT_EMOTE_FREQUENCY = 1/5 # How often the emotes generated by gemini, will be shown. 
 CHATBOT_MAX_OUTPUT_TOKEN = 3000 # A too low max output token can result in a None ("filtered") output
-CHATBOT_HISTORY_SIZE = 20 # How many messages (Q+A) to keep in chat history
+CHATBOT_HISTORY_SIZE = 20 # Max messages (Q+A) kept in chat history
+CHATBOT_HISTORY_TOKENS = 6000 # Approximate token budget of the chat history, the oldest messages are removed above it
+CHATBOT_STREAMING = True # Show the replies while they are generated, by editing the messages
+CHATBOT_STREAM_EDIT_INTERVAL = 1.0 # Minimum time between two edits of a streamed reply (in seconds)
+LLM_CONCURRENCY = {"chat": 16, "translation": 4, "lyrics": 2, "memory": 1} # Max LLM requests running at once, by priority
+LLM_MAX_WAIT = {"chat": 30, "translation": 60, "lyrics": 60, "memory": 600} # Max time waiting for a model with capacity (in seconds)
+LLM_GUESSED_LIMIT_TTL = 300 # Time without rate limit before forgetting a requests/min limit guessed after a 429 (in seconds). The limits given by the API are kept
+PROMPT_CACHE_TTL = 30 * 24 * 3600 # Time before a cached translation/conversion/example is generated again (in seconds)
+PROMPT_CACHE_SIZE = 20000 # Number of prompt results kept in PROMPT_CACHE_PATH
 CHATBOT_MAX_CONTENT_SIZE = {
     'text': 200000,
     'audio': 10000000,
@@ -140,28 +217,24 @@ CHATBOT_MAX_CONTENT_SIZE = {
     'application': 2000000
 } # Max length of an attachment, in bytes
 PINECONE_RECALL_WINDOW = 4
+PINECONE_RECALL_BUDGET = 1.5 # Max time to wait for the memories of a message, the recall is skipped if it's late (in seconds)
 PINECONE_INDEX_NAME = 'ugoku2'
+MEMORY_BATCH_SIZE = 5 # Messages of a server classified together to find what to remember
+MEMORY_BATCH_DELAY = 120 # Max time before classifying the buffered messages of a server (in seconds)
+MEMORY_MIN_LENGTH = 10 # Shorter messages are never remembered (not sent to the classification)
+LOCAL_VECTOR_FOLDER = Path("vectors") # Local copy of the Pinecone vectors of each server, for fast recalls
+LOCAL_VECTOR_SYNC_SIZE = 1000 # Max vectors of a server copied from Pinecone (1000 is the max of a query with values)
+EMBEDDING_MODEL = 'multilingual-e5-large' # Pinecone inference model, the index dimension is 1024
+EMBEDDING_DB_PATH = Path("embeddings.sqlite") # Embeddings of the messages, to not compute them again
+EMBEDDING_STORE_SIZE = 50000 # Number of embeddings kept in EMBEDDING_DB_PATH
+EMBEDDING_CACHE_SIZE = 2000 # Number of embeddings kept in memory
+EMBEDDING_BATCH_WINDOW = 0.05 # Time to wait for other texts to embed in the same call (in seconds)
+EMBEDDING_BATCH_SIZE = 96 # Max texts per embedding call (96 for multilingual-e5-large)
 GEMINI_SAFETY_SETTINGS = [
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-        threshold=HarmBlockThreshold.BLOCK_NONE
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-        threshold=HarmBlockThreshold.BLOCK_NONE,
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-        threshold=HarmBlockThreshold.BLOCK_NONE,
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-        threshold=HarmBlockThreshold.BLOCK_NONE,
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-        threshold=HarmBlockThreshold.BLOCK_NONE,
-    ),
+    {'category': 'HARM_CATEGORY_DANGEROUS_CONTENT', 'threshold': 'BLOCK_NONE'},
+    {'category': 'HARM_CATEGORY_HARASSMENT', 'threshold': 'BLOCK_NONE'},
+    {'category': 'HARM_CATEGORY_HATE_SPEECH', 'threshold': 'BLOCK_NONE'},
+    {'category': 'HARM_CATEGORY_SEXUALLY_EXPLICIT', 'threshold': 'BLOCK_NONE'},
 ] # See https://ai.google.dev/gemini-api/docs/safety-settings
 LANGUAGES = [
     # Put any language you want to support in /translate command.
@@ -1,14 +1,13 @@
 import asyncio
 from deezer_decryption.constants import HEADERS
-import httpx
 import logging
 import os
-import requests
 from spotipy.exceptions import SpotifyException
 from spotipy import Spotify
 from typing import Optional, Union, Literal
 
 from config import DEEZER_REFRESH_INTERVAL
+from bot import http_client
 
 DEEZER_ARL = os.getenv("DEEZER_ARL")
 
@@ -18,12 +17,18 @@ DEEZER_ARL = os.getenv("DEEZER_ARL")
 class Deezer:
     def __init__(self):
         self.headers = HEADERS
-        self.session = httpx.AsyncClient(cookies={"arl": DEEZER_ARL}, http2=True)
+        # Own client: the ARL cookie is only sent to Deezer
+        self.session = http_client.create_async_client()
+        if DEEZER_ARL:
+            self.session.cookies.set("arl", DEEZER_ARL, domain=".deezer.com")
         self.base_url = "http://www.deezer.com/ajax/gw-light.php"
         self.params = {}
         self.api_token = None
         self.user_data = None
 
+    async def aclose(self) -> None:
+        await http_client.close_async_client(self.session)
+
     async def refresh_deezer(self) -> None:
         while True:
             await asyncio.sleep(DEEZER_REFRESH_INTERVAL)
@@ -172,7 +177,7 @@ class Deezer:
         if not self.can_stream_lossless() and tracks_format != "MP3_128":
             raise ValueError
 
-        with requests.post(
+        request = http_client.sync_client.post(
             "https://media.deezer.com/v1/get_url",
             json={
                 "license_token": license_token,
@@ -187,10 +192,10 @@ class Deezer:
                 "track_tokens": [track_token],
             },
             headers=self.headers,
-        ) as request:
-            request.raise_for_status()
-            response = request.json()
-            result = response["data"][0]
+        )
+        request.raise_for_status()
+        response = request.json()
+        result = response["data"][0]
 
         if "media" in result and len(result["media"]):
             return result["media"][0]["sources"][0]["url"]
@@ -1,26 +1,17 @@
 import asyncio
 import httpx
-import http.client
 import logging
-import requests
-from requests.exceptions import (
-    ConnectionError as RequestsConnectionError,
-    ReadTimeout,
-    ChunkedEncodingError,
-)
 import struct
 from typing import Union, Optional, TYPE_CHECKING, Iterator
 
 from deezer_decryption.api import Deezer
 from deezer_decryption.constants import HEADERS, CHUNK_SIZE
 from deezer_decryption.crypto import generate_blowfish_key, decrypt_chunk
+from bot import http_client
 
 if TYPE_CHECKING:
     from bot.vocal.track_dataclass import Timer
 
-async_client = httpx.AsyncClient(http2=True)
-client = requests.Session()
-
 
 class DeezerChunkedInputStream:
     def __init__(
@@ -62,7 +53,7 @@ class DeezerChunkedInputStream:
 
     async def set_async_chunks(self) -> None:
         """Set chunks in self.async_chunks for download."""
-        self.async_stream_ctx = async_client.stream(
+        self.async_stream_ctx = http_client.async_client.stream(
             method="GET", url=self.stream_url, headers=self.headers, timeout=10
         )
         self.async_stream = await self.async_stream_ctx.__aenter__()
@@ -92,11 +83,12 @@ class DeezerChunkedInputStream:
         else:
             headers = self.headers
 
-        self.stream = client.get(
-            url=self.stream_url, headers=headers, timeout=10, stream=True
+        request = http_client.sync_client.build_request(
+            "GET", self.stream_url, headers=headers, timeout=10
         )
+        self.stream = http_client.sync_client.send(request, stream=True)
         self.stream.raise_for_status()
-        self.chunks = self.stream.iter_content(self.chunk_size)
+        self.chunks = self.stream.iter_bytes(self.chunk_size)
 
     def set_stream_headers(self, first_bytes: bytes) -> None:
         if first_bytes[:4] != b"fLaC":
@@ -172,15 +164,12 @@ class DeezerChunkedInputStream:
             self.reset_status()
             return b""
 
-        except (RequestsConnectionError, ReadTimeout, ChunkedEncodingError):
+        except httpx.TransportError:
             if self.stream:
                 self.stream.close()
             self.set_chunks(self.current_position, force=True)
             return self.read()
 
-        except http.client.IncompleteRead as e:
-            chunk = e.partial
-
         except Exception as e:
             if self.stream:
                 self.stream.close()
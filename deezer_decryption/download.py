@@ -19,11 +19,16 @@ class Download:
     def __init__(
         self, deezer: Optional[Deezer] = None, bot: Optional[discord.Bot] = None
     ):
-        if deezer is None:
-            deezer = Deezer()
-        self.api = deezer
+        self._api = deezer
         self.bot = bot
 
+    @property
+    def api(self) -> Deezer:
+        """Deezer session of the bot, or its own one created on first use."""
+        if self._api is None:
+            self._api = getattr(self.bot, "deezer", None) or Deezer()
+        return self._api
+
     async def tracks(
         self,
         gw_track_apis: list[dict],
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+import sys
+
+from config import (
+    SHARD_COUNT,
+    CLUSTER_COUNT,
+    CLUSTER_START_DELAY,
+    CLUSTER_RESTART_DELAY,
+)
+
+
+# Each process runs main.py with its own Discord shards.
+# Discord splits the servers between the shards, so the voice sessions,
+# FFmpeg pipes and audio threads of a server all live in its shard's process.
+# A process crashing doesn't stop the others, it is restarted.
+# Each process has its own cache folder, so a file is never downloaded or
+# evicted by two of them at the same time.
+shard_count = max(SHARD_COUNT or CLUSTER_COUNT, CLUSTER_COUNT)
+
+
+async def run_cluster(cluster_id: int) -> None:
+    shard_ids = ",".join(map(str, range(cluster_id, shard_count, CLUSTER_COUNT)))
+    env = {
+        **os.environ,
+        "CLUSTER_ID": str(cluster_id),
+        "SHARD_IDS": shard_ids,
+        "SHARD_COUNT": str(shard_count),
+    }
+    await asyncio.sleep(cluster_id * CLUSTER_START_DELAY)
+
+    while True:
+        logging.info(f"Starting process {cluster_id} (shards {shard_ids})")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "main.py", env=env
+        )
+        return_code = await process.wait()
+        if return_code == 0:
+            logging.info(f"Process {cluster_id} stopped")
+            return
+
+        logging.error(
+            f"Process {cluster_id} exited with code {return_code}, "
+            f"restarting in {CLUSTER_RESTART_DELAY}s"
+        )
+        await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+
+async def main() -> None:
+    await asyncio.gather(*(run_cluster(i) for i in range(CLUSTER_COUNT)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
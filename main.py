@@ -1,3 +1,6 @@
+# Imported first, to measure the startup
+from bot.startup import startup_profile
+
 import asyncio
 import logging
 import os
@@ -10,34 +13,54 @@ from config import (
     PINECONE_INDEX_NAME,
     DEEZER_ENABLED,
     TEMP_FOLDER,
+    BASE_TEMP_FOLDER,
+    HTTP_METRICS_LOG_INTERVAL,
+    SHARD_COUNT,
+    STARTUP_BENCHMARK_PATH,
+    CONFIG_VERSION_CHECK_INTERVAL,
 )
 from bot.misc.quickstart_view import QuickstartView
 from bot.utils import cleanup_cache
 from bot.vocal.spotify import SpotifySessions, Spotify
-from bot.http_client import init_http_session, close_http_session
-
-
-
+from bot.vocal.session_manager import session_manager
+from bot.http_client import init_http_session, close_http_session, metrics
+from bot.http_cache import stats as cache_stats
+from bot.sharding import set_shard_count, shard_metrics
+from bot.config.sqlite_config_manager import config_cache, config_store
+from bot.vocal.cover_store import cover_store
 
 if GEMINI_ENABLED:
     from bot.chatbot.vector_recall import memory
+    from bot.chatbot.gemini_client import llm_scheduler
+    from bot.chatbot.prompt_cache import prompt_cache
 if DEEZER_ENABLED:
     from deezer_decryption.api import Deezer
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Set by launcher.py when running several processes
+SHARD_IDS = os.getenv("SHARD_IDS")
 
 # Init bot
 intents = discord.Intents.default()
 intents.message_content = True
 loop = asyncio.get_event_loop()
-bot = discord.Bot(intents=intents, loop=loop)
+bot = discord.AutoShardedBot(
+    intents=intents,
+    loop=loop,
+    shard_count=int(os.getenv("SHARD_COUNT", 0)) or SHARD_COUNT,
+    shard_ids=[int(i) for i in SHARD_IDS.split(",")] if SHARD_IDS else None,
+)
+background_tasks: list[asyncio.Task] = []
 
 
 @bot.event
 async def on_ready() -> None:
+    set_shard_count(bot.shard_count)
+
     # Cache
     TEMP_FOLDER.mkdir(parents=True, exist_ok=True)
     await init_http_session()
+    await config_cache.load()
 
     tasks = [
         bot.change_presence(
@@ -45,7 +68,6 @@ async def on_ready() -> None:
                 type=discord.ActivityType.listening, name="/help for usage !"
             )
         ),
-        clean_cache_task(),
     ]
     if SPOTIFY_API_ENABLED:
         spotify_sessions = SpotifySessions()
@@ -53,7 +75,8 @@ async def on_ready() -> None:
         tasks.append(spotify_sessions.init_spotify())
         bot.spotify = spotify
 
-        if DEEZER_ENABLED:
+        # Created once, on_ready is called again after reconnecting
+        if DEEZER_ENABLED and getattr(bot, "deezer", None) is None:
             bot.deezer = Deezer()
             tasks.append(bot.deezer.setup(create_refresh_task=True))
 
@@ -61,8 +84,17 @@ async def on_ready() -> None:
         tasks.append(memory.init_pinecone(PINECONE_INDEX_NAME))
     await asyncio.gather(*tasks, return_exceptions=True)
 
+    # Background loops, started once (on_ready is called again after reconnecting)
+    if not background_tasks:
+        # The legacy files are in the shared folder, moved by the first process
+        if os.getenv("CLUSTER_ID", "0") == "0":
+            await cover_store.import_legacy_files(BASE_TEMP_FOLDER)
+        for coro in (clean_cache_task(), metrics_task(), config_version_task()):
+            background_tasks.append(asyncio.create_task(coro))
+
     # Party !
     logging.info(f"{bot.user} is running !")
+    startup_profile.record(STARTUP_BENCHMARK_PATH, shards=SHARD_IDS or "")
 
 
 @bot.event
@@ -78,9 +110,30 @@ async def on_guild_join(guild: discord.Guild) -> None:
         await quickstart_view.display(respond_func=channel.send)
 
 
+@bot.event
+async def on_voice_state_update(
+    member: discord.Member, before: discord.VoiceState, after: discord.VoiceState
+) -> None:
+    shard_metrics.record_event(member.guild.id)
+    # Disconnected (or kicked) from a voice channel
+    if member.id == bot.user.id and before.channel and not after.channel:
+        session_manager.on_voice_disconnect(member.guild.id)
+
+
+@bot.listen()
+async def on_message(message: discord.Message) -> None:
+    shard_metrics.record_event(message.guild.id if message.guild else None)
+
+
+@bot.listen()
+async def on_interaction(interaction: discord.Interaction) -> None:
+    shard_metrics.record_event(interaction.guild_id)
+
+
 @bot.event
 async def on_close() -> None:
     await close_http_session()
+    await config_store.close()
 
 
 async def clean_cache_task() -> None:
@@ -89,11 +142,34 @@ async def clean_cache_task() -> None:
         await asyncio.sleep(60)
 
 
+async def config_version_task() -> None:
+    # Changes made by the other processes started by launcher.py
+    while True:
+        await asyncio.sleep(CONFIG_VERSION_CHECK_INTERVAL)
+        await config_cache.check_version()
+
+
+async def metrics_task() -> None:
+    while True:
+        await asyncio.sleep(HTTP_METRICS_LOG_INTERVAL)
+        metrics.log()
+        cache_stats.log()
+        shard_metrics.log(bot)
+        if GEMINI_ENABLED:
+            memory.embeddings.stats.log()
+            llm_scheduler.stats.log()
+            prompt_cache.stats.log()
+
+
 if __name__ == "__main__":
+    startup_profile.mark("imports")
     for filepath in COMMANDS_FOLDER.rglob("*.py"):
         relative_path = filepath.relative_to(COMMANDS_FOLDER).with_suffix("")
         module_name = f"commands.{relative_path.as_posix().replace('/', '.')}"
         logging.info(f"Loading {module_name}")
-        bot.load_extension(module_name)
+        with startup_profile.measure_extension(module_name):
+            bot.load_extension(module_name)
+    startup_profile.mark("extensions")
+    startup_profile.log_extensions()
 
     bot.run(BOT_TOKEN)